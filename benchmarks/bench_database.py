@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Measure key generation, lookup, claim, purge and the views on a database
+
+Run from the top of the repository::
+
+    python benchmarks/bench_database.py --keys 100000 --output before.json
+
+Seeds a fresh test database with --keys keys: a tenth claimed, a tenth
+expired, the rest available. SQLite is used by default; with
+``--database postgresql`` the connection is read from the usual PGHOST,
+PGPORT, PGUSER, PGPASSWORD and PGDATABASE environment variables, and a
+test database is created next to PGDATABASE. Results are written as
+JSON, compare two runs with::
+
+    python benchmarks/bench_database.py --compare before.json after.json
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(1, os.path.abspath('./src'))
+
+import django
+from django.conf import settings
+
+GENERATORS = ('sms', 'pin', 'username', 'lowercase', 'md5-hex', 'signed')
+
+
+def configure(database, tmpdir):
+    if database == 'postgresql':
+        db = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('PGDATABASE', 'postgres'),
+            'USER': os.environ.get('PGUSER', ''),
+            'PASSWORD': os.environ.get('PGPASSWORD', ''),
+            'HOST': os.environ.get('PGHOST', ''),
+            'PORT': os.environ.get('PGPORT', ''),
+        }
+    else:
+        name = os.path.join(tmpdir, 'bench.sqlite3')
+        db = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': name,
+            'TEST': {'NAME': name},
+        }
+    settings.configure(
+        SECRET_KEY='benchmark',
+        DEBUG=False,
+        ALLOWED_HOSTS=['*'],
+        DATABASES={'default': db},
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.sessions',
+            'verification',
+        ],
+        MIDDLEWARE=[
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+        ],
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [os.path.abspath('./src/demo/templates')],
+            'APP_DIRS': True,
+        }],
+        ROOT_URLCONF='verification.urls',
+        USE_TZ=True,
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    )
+    django.setup()
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def timed(func, args_list):
+    "Call func once per args, return ops/s and latency percentiles in ms"
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        before = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'ops_per_second': len(latencies) / elapsed if elapsed else None,
+        'mean_ms': 1000 * elapsed / len(latencies),
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p95_ms': 1000 * percentile(latencies, 0.95),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+    }
+
+
+def seed(Key, group, user, n, batch_size=10000, samples=5000):
+    """Insert n keys straight, without the checks of generate_keys()
+
+    Returns some available keystrings to look up and claim."""
+    from django.utils.timezone import now as tznow
+
+    generator = group.get_generator_instance()
+    now = tznow()
+    past = now - datetime.timedelta(days=1)
+    future = now + datetime.timedelta(days=1)
+    every = max(1, n // samples)
+    available = []
+    for offset in range(0, n, batch_size):
+        keystrings = generator.generate_many(min(batch_size, n - offset))
+        keys = []
+        for i, keystring in enumerate(keystrings, offset):
+            key = Key(key=keystring, group=group, pub_date=now, expires=future)
+            if i % 10 == 0:
+                key.claimed, key.claimed_by = now, user
+            elif i % 10 == 1:
+                key.expires = past
+            elif i % every == 0:
+                available.append(keystring)
+            keys.append(key)
+        Key.objects.bulk_create(keys, ignore_conflicts=True)
+    return available
+
+
+def bench_generation(KeyGroup, Key, n):
+    results = {}
+    for name in GENERATORS:
+        group = KeyGroup.objects.create(name='gen-%s' % name, generator=name)
+        keyspace = group.get_generator_instance().keyspace()
+        # Stay clear of filling small keyspaces, like that of pins
+        bulk = n * 10 if keyspace is None else min(n * 10, keyspace // 10)
+        one = timed(lambda: Key.generate(group), [()] * min(n, bulk))
+        start = time.perf_counter()
+        made = len(group.generate_keys(Key, bulk, batch_size=1000))
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            'generate': one,
+            'generate_keys': {'keys': made, 'keys_per_second': made / elapsed},
+        }
+    return results
+
+
+def bench_views(client, user, keystrings):
+    from django.urls import reverse
+
+    def url(name, keystring):
+        return reverse(name, kwargs={'group': 'bench', 'key': keystring})
+
+    def get(name, keystring, status):
+        response = client.get(url(name, keystring))
+        assert response.status_code == status, (name, response.status_code)
+
+    quarter = len(keystrings) // 4
+    lookups, claims = keystrings[:quarter], keystrings[quarter:2 * quarter]
+    results = {}
+    results['claim_post_url_get'] = timed(
+        get, [('verification-claim-post-url', k, 200) for k in lookups])
+    results['claim_post_url_missing'] = timed(
+        get, [('verification-claim-post-url', k[::-1], 404) for k in lookups])
+    client.force_login(user)
+    results['claim_get'] = timed(
+        get, [('verification-claim-get', k, 302) for k in claims])
+    results['claim_success'] = timed(
+        get, [('verification-success', k, 200) for k in claims])
+    client.logout()
+    return results
+
+
+def run(options):
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test import Client
+
+    from verification.models import Key, KeyGroup, claim
+
+    results = {}
+    User = get_user_model()
+    user = User.objects.create(username='bench')
+    group = KeyGroup.objects.create(name='bench', generator='sha1-hex')
+
+    start = time.perf_counter()
+    keystrings = seed(Key, group, user, options.keys)
+    elapsed = time.perf_counter() - start
+    results['seed'] = {'keys': options.keys, 'keys_per_second': options.keys / elapsed}
+    print('Seeded %i keys in %.1fs' % (options.keys, elapsed), file=sys.stderr)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    random.shuffle(keystrings)
+    third = len(keystrings) // 3
+    lookups = keystrings[:third]
+    claims = keystrings[third:2 * third]
+    views = keystrings[2 * third:]
+
+    results['lookup'] = timed(
+        lambda k: Key.objects.filter_key(k, group).get(), [(k,) for k in lookups])
+    results['lookup_missing'] = timed(
+        lambda k: Key.objects.filter_key(k, group).exists(), [(k[::-1],) for k in lookups])
+    results['claim'] = timed(
+        lambda k: claim(k, user, group=group), [(k,) for k in claims])
+    results['available_count'] = timed(
+        lambda: Key.objects.filter(group=group).available().count(), [()] * options.repeat)
+    results['views'] = bench_views(Client(), user, views)
+    results['generation'] = bench_generation(KeyGroup, Key, options.generate)
+
+    expired = Key.objects.filter(group=group).expired().count()
+    start = time.perf_counter()
+    deleted = Key.objects.filter(group=group).delete_expired(batch_size=options.batch_size)
+    elapsed = time.perf_counter() - start
+    results['delete_expired'] = {'keys': deleted, 'seconds': elapsed,
+                                 'keys_per_second': deleted / elapsed if elapsed else None}
+    assert deleted == expired, (deleted, expired)
+    return results
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def compare(before_path, after_path):
+    "Print how the ops/s of two runs differ"
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+
+    def rates(results, prefix=''):
+        for name, value in sorted(results.items()):
+            if not isinstance(value, dict):
+                continue
+            for rate in ('ops_per_second', 'keys_per_second'):
+                if rate in value:
+                    yield prefix + name, value[rate]
+                    break
+            else:
+                for item in rates(value, prefix + name + '.'):
+                    yield item
+
+    old = dict(rates(before))
+    print('%-40s %14s %14s %8s' % ('benchmark', 'before/s', 'after/s', 'change'))
+    for name, new_rate in rates(after):
+        if name in old and old[name] and new_rate:
+            print('%-40s %14.0f %14.0f %+7.1f%%' % (name, old[name], new_rate,
+                                                   100 * (new_rate / old[name] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--keys', type=int, default=100000,
+                        help='Keys to seed, 10^5 to 10^7. Default: %(default)s')
+    parser.add_argument('--database', choices=['sqlite', 'postgresql'], default='sqlite')
+    parser.add_argument('--generate', type=int, default=1000,
+                        help='Keys made one by one per generator, ten times that in bulk. '
+                             'Default: %(default)s')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs of available().count(). Default: %(default)s')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Batch size of delete_expired(). Default: %(default)s')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two result files and exit')
+    options = parser.parse_args()
+    if options.compare:
+        return compare(*options.compare)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configure(options.database, tmpdir)
+        from django.db import connection
+
+        old_name = connection.creation.create_test_db(verbosity=0, keepdb=False)
+        try:
+            results = run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'keys': options.keys,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
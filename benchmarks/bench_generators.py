@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Compare keys/sec of the per-character generator loop with generate_many()
+
+Run from the top of the repository::
+
+    python benchmarks/bench_generators.py [number of keys]
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.abspath('./src'))
+
+from verification.generators import registry
+
+NAMES = ('sms', 'pin', 'username', 'lowercase')
+
+
+def keys_per_second(func, n):
+    start = time.perf_counter()
+    func(n)
+    return n / (time.perf_counter() - start)
+
+
+def loop(generator):
+    "The per-character randint() loop, as used by seeded generators"
+    def run(n):
+        return [generator.generate_one_key() for _ in range(n)]
+    return run
+
+
+def main(n=100000):
+    print('%-10s %14s %14s %8s' % ('generator', 'loop keys/s', 'many keys/s', 'speedup'))
+    for name in NAMES:
+        Generator = registry.get(name)
+        before = keys_per_second(loop(Generator(seed=1)), n)
+        after = keys_per_second(Generator().generate_many, n)
+        print('%-10s %14.0f %14.0f %7.1fx' % (name, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
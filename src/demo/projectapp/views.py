@@ -4,7 +4,6 @@ except ImportError:   # Django < 1.9
     from django.core.urlresolvers import reverse
 from django.contrib import messages
 from django.views.generic import CreateView, DeleteView
-from django.core.mail import send_mail
 from django import forms
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
@@ -23,13 +22,6 @@ def create_activate_account_kg():
     return activate_account
 
 
-def send_verification_email(recipient, content):
-    "send_func to be used by verification.Key"
-    subject = 'Activate demo-account for django-verification'
-    recipient = ''.join(recipient.strip().split())
-    send_mail(subject, content, 'noreply@example.com', [recipient])
-
-
 class UserForm(forms.ModelForm):
     class Meta:
         model = get_user_model()
@@ -122,7 +114,6 @@ The link times out in one hour.'''
         self.object.save()
         activate_account = create_activate_account_kg()
         key = Key.generate(activate_account)
-        key.send_func = send_verification_email
         key.claimed_by = self.object
         key.save()
         self.key = key
@@ -2,6 +2,14 @@ import os
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Send keys in the background, signup does not wait for the mail server
+VERIFICATION_DELIVERY_BACKEND = 'verification.delivery.QueuedBackend'
+VERIFICATION_DELIVERY_OPTIONS = {
+    'backend': 'verification.delivery.EmailBackend',
+    'subject': 'Activate demo-account for django-verification',
+    'from_email': 'noreply@example.com',
+}
+
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 
 SECRET_KEY = "af3=14eh#*qlb--zs55)e)^f32e3doc)ske1ve2oeuep7r&up6"
@@ -1,3 +1,5 @@
+import os
+
 SECRET_KEY = 'fififafafofofefe'
 
 DATABASES = {
@@ -8,14 +10,36 @@ DATABASES = {
 }
 
 INSTALLED_APPS = [
+    'django.contrib.admin',
     'django.contrib.contenttypes',
     'django.contrib.auth',
+    'django.contrib.messages',
+    'django.contrib.sessions',
     'verification',
     'demo.projectapp',
     'tests',
 ]
 
-MIDDLEWARE_CLASSES = ()
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+]
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [os.path.join(os.path.dirname(os.path.dirname(__file__)), 'demo', 'templates')],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
 
 ROOT_URLCONF = 'tests.urls'
 
@@ -1,25 +1,57 @@
 from __future__ import unicode_literals
 
 import random
+import gzip
 import hashlib
+import json
+import os
+import tempfile
+import threading
 import datetime
 import sys
 import unittest
+from importlib import import_module
+from io import StringIO
 from unittest import mock
 
+from asgiref.sync import sync_to_async
+
+import django
+
 from django.urls import resolve, reverse
-from django.core.exceptions import ValidationError
-from django import test
-from django.http import HttpRequest
+from django.core.cache import caches
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django import forms, test
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404, HttpRequest
 from django.utils.timezone import now as tznow
 from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models.signals import post_delete
+from django.test.utils import CaptureQueriesContext
 
 from verification.models import *
 from verification.views import *
+from verification.admin import EstimatedCountPaginator, KeyAdmin
+from verification.bloom import BloomFilter, KeyFilterCache, key_filter
+from verification.cache import KeyGroupCache, group_cache
+from verification import delivery
+from verification.counters import counters
+from verification import profiling
+from verification.profiling import ProfilingMiddleware, profile
+from verification.instrumentation import (
+    Histogram, HistogramCollector, PrometheusExporter, TextExporter, instrumentation)
+from verification.signals import key_claimed, keys_claimed
+from verification.throttling import Throttled, parse_rate
 from verification.generators import (
     Registry,
     GeneratorError,
     SMSKeyGenerator,
+    PINCodeGenerator,
+    SHA512HexKeyGenerator,
     AbstractKeyGenerator,
     AbstractAlphabetKeyGenerator,
     HashedHexKeyGenerator,
@@ -62,6 +94,18 @@ class RegistryTest(unittest.TestCase):
         self.assertRaises(GeneratorError, registry.get, 'abstract')
         self.assertFalse(registry.get('abstract', False))
 
+    def test_instance(self):
+        registry = Registry()
+        sms = registry.instance('sms')
+        self.assertIsInstance(sms, SMSKeyGenerator)
+        self.assertIs(registry.instance('sms'), sms)
+        registry.register('sms', SMSKeyGenerator)
+        self.assertIsNot(registry.instance('sms'), sms)
+        gen = AbstractKeyGenerator()
+        registry.register('abstract', gen)
+        self.assertIs(registry.instance('abstract'), gen)
+        self.assertRaises(GeneratorError, registry.instance, 'doesnotexist')
+
     def test_reset(self):
         registry = Registry()
         expected = DEFAULT_GENERATOR_NAMES
@@ -84,6 +128,12 @@ class AbstractKeyGeneratorTest(unittest.TestCase):
         #self.assertEqual(gen.name, '')
         self.assertEqual(gen.seed, None)
 
+    def test_seed_is_private(self):
+        state = random.getstate()
+        gen = AbstractKeyGenerator(seed=12345)
+        self.assertEqual(random.getstate(), state)
+        self.assertIsNot(gen.random, random)
+
     def test_sms_safe(self):
         gen = AbstractKeyGenerator()
         self.assertEqual(gen.sms_safe(), True)
@@ -130,6 +180,7 @@ class AbstractAlphabetKeyGeneratorTest(unittest.TestCase):
         self.assertTrue(gen.valid_key(goodkey))
         badkey = 'abc"123'
         self.assertFalse(gen.valid_key(badkey))
+        self.assertFalse(gen.valid_key(goodkey + '\n'))
 
     @mock.patch('random.random')
     def test_generate_one_key(self, rand_call):
@@ -140,6 +191,32 @@ class AbstractAlphabetKeyGeneratorTest(unittest.TestCase):
         self.assertEqual(expected_key, key)
 
 
+    def test_generate_many(self):
+        for name in ('sms', 'pin', 'username', 'lowercase'):
+            gen = Registry().get(name)()
+            keys = gen.generate_many(500)
+            self.assertEqual(len(keys), 500)
+            self.assertTrue(all(gen.valid_key(key) for key in keys), name)
+            self.assertGreater(len(set(keys)), 1)
+            self.assertTrue(gen.valid_key(gen.generate_one_key()))
+
+    def test_generate_many_seeded(self):
+        keys = AbstractAlphabetKeyGenerator(seed=12345).generate_many(3)
+        self.assertEqual(keys[0], 'BWa221u4')
+        self.assertEqual(keys, AbstractAlphabetKeyGenerator(seed=12345).generate_many(3))
+
+    def test_generate_many_unbiased(self):
+        gen = AbstractAlphabetKeyGenerator(alphabet='abc', length=1)
+        self.assertEqual(gen._reject, b'\xff')
+        self.assertEqual(gen._table[:6], b'abcabc')
+        self.assertEqual(gen._table[254:255], b'c')
+
+    def test_generate_many_not_ascii(self):
+        gen = AbstractAlphabetKeyGenerator(alphabet='æøå', length=4)
+        self.assertIsNone(gen._table)
+        self.assertTrue(all(gen.valid_key(key) for key in gen.generate_many(10)))
+
+
 class HashedHexKeyGeneratorTest(unittest.TestCase):
 
     def test_init(self):
@@ -149,9 +226,26 @@ class HashedHexKeyGeneratorTest(unittest.TestCase):
         self.assertEqual(gen.base, 16)
         self.assertEqual(gen.alphabet, SAFE_ALPHABET[:16])
 
+    def test_valid_key(self):
+        gen = HashedHexKeyGenerator(alphabet=SAFE_ALPHABET)
+        self.assertTrue(gen.valid_key(gen.generate_one_key()))
+        self.assertFalse(gen.valid_key('abc123'))
+        self.assertFalse(gen.valid_key(gen.generate_one_key() + '\n'))
+
+    def test_seeded(self):
+        self.assertEqual(HashedHexKeyGenerator(seed=1).generate_one_key(),
+                         HashedHexKeyGenerator(seed=1).generate_one_key())
+
     @mock.patch('random.random')
-    def test_generate_one_key(self, rand_call):
-        rand_call.return_value = 0.987654321
+    def test_unseeded_uses_system_random(self, rand_call):
+        rand_call.return_value = 0.5
+        gen = HashedHexKeyGenerator()
+        self.assertNotEqual(gen.generate_one_key(), gen.generate_one_key())
+        self.assertFalse(rand_call.called)
+
+    @mock.patch('verification.generators._system_random')
+    def test_generate_one_key(self, system_random):
+        system_random.random.return_value = 0.987654321
         expected_key = '228fd0f62a984ce3c1be4efa031fb9b6842ff4ed'
         gen = HashedHexKeyGenerator()
         key = gen.generate_one_key()
@@ -176,6 +270,21 @@ class KeyGroupTest(test.TestCase):
         kg = KeyGroup.objects.create(name='test3', generator='doesnotexist')
         self.assertIsNone(kg.get_generator())
 
+    def test_valid_key(self):
+        self.assertTrue(self.kg_pin.valid_key('1234'))
+        self.assertFalse(self.kg_pin.valid_key('123'))
+        self.assertFalse(self.kg_pin.valid_key('1234\n'))
+        self.assertFalse(self.kg_sms.valid_key('1234'))
+        kg = KeyGroup.objects.create(name='test3', generator='doesnotexist')
+        self.assertTrue(kg.valid_key('anything goes'))
+
+    def test_get_generator_instance(self):
+        gen = self.kg_sms.get_generator_instance()
+        self.assertIs(self.kg_sms.get_generator_instance(), gen)
+        seeded = self.kg_sms.get_generator_instance(seed=12345)
+        self.assertIsNot(seeded, gen)
+        self.assertEqual(seeded.seed, 12345)
+
     def test_purge_keys(self):
         model = self.kg_sms.keys.model
         for i in range(5):
@@ -205,6 +314,287 @@ class KeyGroupTest(test.TestCase):
         self.assertEqual(k.fact, fact)
 
 
+    def test_generate_keys(self):
+        kg = KeyGroup.objects.create(name='test_ttl', generator='sms', ttl=60)
+        User = get_user_model()
+        u = User.objects.create(username='testuser')
+        facts = ('fact %i' % i for i in range(25))
+        progress = []
+        with self.assertNumQueries(9):
+            made = kg.generate_keys(Key, 25, facts=facts, claimants=[u]*25,
+                                    batch_size=10, progress=progress.append)
+        self.assertEqual(len(made), 25)
+        self.assertEqual(progress, [10, 20, 25])
+        keys = Key.objects.filter(group=kg)
+        self.assertEqual(keys.count(), 25)
+        self.assertEqual(keys.filter(claimed_by=u).count(), 25)
+        self.assertEqual(set(keys.values_list('fact', flat=True)),
+                         set('fact %i' % i for i in range(25)))
+        key = keys[0]
+        self.assertEqual(key.expires, key.pub_date + datetime.timedelta(minutes=60))
+
+    def test_iter_generate_keys(self):
+        kg = KeyGroup.objects.create(name='test_iter', generator='sms')
+        batches = kg.iter_generate_keys(Key, 5, batch_size=2)
+        self.assertFalse(Key.objects.exists())
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(Key.objects.count(), 5)
+
+    def test_generate_keys_keyspace_too_small(self):
+        self.assertRaises(GeneratorError,
+                          self.kg_pin.generate_keys, Key, 10001, batch_size=10001)
+
+
+class KeyCollisionTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='pin', generator='pin')
+        Key.objects.create(key='0001', group=self.kg)
+        counters.reset()
+
+    @mock.patch.object(PINCodeGenerator, 'generate_one_key')
+    def test_generate_one_key_retries(self, generate):
+        generate.side_effect = ['0001', '0001', '0002']
+        key = self.kg.generate_one_key(Key)
+        self.assertEqual(key.key, '0002')
+        self.assertEqual(counters.get(self.kg, 'attempts'), 3)
+        self.assertEqual(counters.get(self.kg, 'collisions'), 2)
+        self.assertEqual(counters.get(self.kg, 'retries'), 2)
+        self.assertAlmostEqual(counters.estimated_fill(self.kg), 2/3.)
+
+    @test.override_settings(VERIFICATION_KEY_RETRIES=2)
+    @mock.patch.object(PINCodeGenerator, 'generate_one_key', return_value='0001')
+    def test_generate_one_key_gives_up(self, generate):
+        self.assertRaises(GeneratorError, self.kg.generate_one_key, Key)
+        self.assertEqual(counters.get(self.kg, 'collisions'), 3)
+        self.assertEqual(counters.get(self.kg, 'retries'), 2)
+        self.assertEqual(Key.objects.count(), 1)
+
+    @mock.patch.object(PINCodeGenerator, 'generate_many')
+    def test_generate_keys_retries(self, generate):
+        generate.side_effect = [['0001', '0002'], ['0003']]
+        keys = self.kg.generate_keys(Key, 2)
+        self.assertEqual(set(key.key for key in keys), set(['0002', '0003']))
+        self.assertEqual(Key.objects.count(), 3)
+        self.assertEqual(counters.get(self.kg, 'collisions'), 1)
+        self.assertEqual(counters.snapshot()['pin']['attempts'], 3)
+
+    def test_keyspace(self):
+        self.assertEqual(self.kg.get_generator()().keyspace(), 10**4)
+
+
+class HashedKeyTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='hashed', generator='sha512-hex', hash_keys=True)
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+
+    def test_generate(self):
+        k = Key.generate(self.kg)
+        self.assertEqual(len(k.key), 128)
+        row = Key.objects.get(pk=k.pk)
+        self.assertIsNone(row.key)
+        self.assertEqual(bytes(row.digest), key_digest(k.key))
+        self.assertEqual(len(row.digest), 32)
+        self.assertEqual(str(row), '')
+
+    def test_generate_keys(self):
+        keys = self.kg.generate_keys(Key, 5)
+        digests = set(bytes(d) for d in Key.objects.values_list('digest', flat=True))
+        self.assertEqual(digests, set(key_digest(k.key) for k in keys))
+        self.assertFalse(Key.objects.exclude(key=None).exists())
+
+    def test_claim(self):
+        k = Key.generate(self.kg)
+        k_claimed = claim(k.key, self.user, group=self.kg)
+        self.assertEqual(k_claimed.key, k.key)
+        self.assertEqual(k_claimed.pk, k.pk)
+        self.assertRaisesRegex(VerificationError, 'already been claimed',
+                               Key.objects.claim, k.key, self.user)
+
+    def test_claim_without_group(self):
+        k = Key.generate(self.kg)
+        k_claimed = Key.objects.claim(k.key, self.user)
+        self.assertEqual(k_claimed.claimed_by, self.user)
+
+    def test_change_hash_keys(self):
+        k = Key.generate(self.kg)
+        self.kg.hash_keys = False
+        self.assertRaises(ValidationError, self.kg.full_clean)
+        self.assertRaises(ValidationError, self.kg.save)
+        claim(k.key, self.user)
+        self.kg.save()
+        self.assertFalse(KeyGroup.objects.get(pk='hashed').hash_keys)
+        self.kg.hash_keys = True
+        self.kg.save()
+
+    def test_claim_loaded_key(self):
+        k = Key.generate(self.kg)
+        other = Key.generate(self.kg)
+        k_claimed = Key.objects.get(pk=k.pk).claim(self.user)
+        self.assertEqual(k_claimed.pk, k.pk)
+        self.assertEqual(k_claimed.claimed_by, self.user)
+        self.assertIsNone(Key.objects.get(pk=other.pk).claimed)
+        self.assertRaisesRegex(VerificationError, 'already been claimed',
+                               Key.objects.get(pk=k.pk).claim, self.user)
+
+    def test_lookup(self):
+        k = Key.generate(self.kg)
+        found = KeyLookupMixin().get_key_from_string(k.key, 'hashed')
+        self.assertEqual(found.pk, k.pk)
+        self.assertEqual(found.key, k.key)
+
+    @mock.patch.object(SHA512HexKeyGenerator, 'generate_one_key')
+    def test_collision(self, generate):
+        generate.side_effect = ['a' * 128, 'a' * 128, 'b' * 128]
+        Key.generate(self.kg)
+        k = Key.generate(self.kg)
+        self.assertEqual(k.key, 'b' * 128)
+
+
+class SignedKeyTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='signed', generator='signed', ttl=60)
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+
+    def test_generate(self):
+        k = Key.generate(self.kg, fact='a@example.com', claimant=self.user)
+        self.assertIsNone(k.pk)
+        self.assertFalse(Key.objects.exists())
+        self.assertTrue(self.kg.valid_key(k.key))
+        self.assertFalse(self.kg.valid_key(k.key + '\n'))
+        self.assertLessEqual(len(k.key), 255)
+        self.assertNotEqual(k.key, Key.generate(self.kg).key)
+        self.assertEqual(len(self.kg.generate_keys(Key, 3, claimants=[self.user]*3)), 3)
+        self.assertFalse(Key.objects.exists())
+
+    def test_load_signed_key(self):
+        k = Key.generate(self.kg, fact='a@example.com', claimant=self.user)
+        with self.assertNumQueries(0):
+            loaded = self.kg.load_signed_key(Key, k.key)
+        self.assertEqual(loaded.claimed_by_id, self.user.pk)
+        self.assertEqual(loaded.expires, k.expires.replace(microsecond=0))
+        self.assertEqual(len(loaded.fact), 16)
+        self.assertRaises(VerificationError, self.kg.load_signed_key, Key, k.key[:-1])
+        other = KeyGroup.objects.create(name='other', generator='signed')
+        self.assertRaises(VerificationError, other.load_signed_key, Key, k.key)
+
+    def test_claim(self):
+        k = Key.generate(self.kg)
+        with CaptureQueriesContext(connections['default']) as queries:
+            k_claimed = claim(k.key, self.user, group=self.kg)
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT')])
+        self.assertEqual(k_claimed.claimed_by, self.user)
+        self.assertEqual(Key.objects.get().claimed_by, self.user)
+        self.assertRaisesRegex(VerificationError, 'already been claimed',
+                               claim, k.key, self.user, self.kg)
+
+    def test_claim_sets_pk(self):
+        features = type(connections['default'].features)
+        with mock.patch.object(features, 'can_return_rows_from_bulk_insert',
+                               new_callable=mock.PropertyMock, return_value=False):
+            k = Key.generate(self.kg)
+            k_claimed = claim(k.key, self.user, group=self.kg)
+            results = Key.objects.claim_many([(Key.generate(self.kg).key, self.user)])
+        self.assertEqual(k_claimed.pk, Key.objects.get(key=k.key).pk)
+        self.assertEqual(k_claimed.pub_date, k.pub_date.replace(microsecond=0))
+        self.assertIsNotNone(results[0].key.pk)
+
+    def test_claim_without_group(self):
+        k = Key.generate(self.kg)
+        self.assertEqual(Key.objects.claim(k.key, self.user).group, self.kg)
+        self.assertEqual(Key.objects.claimed().count(), 1)
+
+    def test_claim_expired(self):
+        earlier = tznow() - datetime.timedelta(minutes=61)
+        k = self.kg._make_signed_key(Key, self.kg.get_generator_instance(), pub_date=earlier)
+        self.assertRaisesRegex(VerificationError, 'expired', claim, k.key, self.user, self.kg)
+
+    def test_claim_hashed(self):
+        self.kg.hash_keys = True
+        k = Key.generate(self.kg)
+        claim(k.key, self.user, group=self.kg)
+        self.assertEqual(bytes(Key.objects.get().digest), key_digest(k.key))
+        self.assertRaises(VerificationError, claim, k.key, self.user, self.kg)
+
+    def test_lookup(self):
+        k = Key.generate(self.kg, claimant=self.user)
+        with self.assertNumQueries(1):
+            found = KeyLookupMixin().get_key_from_string(k.key, 'signed')
+        self.assertEqual(found.claimed_by_id, self.user.pk)
+        self.assertRaises(Http404, KeyLookupMixin().get_key_from_string, k.key + 'x', 'signed')
+
+
+class KeyGroupCacheTest(test.TestCase):
+
+    def setUp(self):
+        group_cache.invalidate()
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms', ttl=5)
+
+    def test_get_cached(self):
+        with self.assertNumQueries(1):
+            kg = KeyGroup.objects.get_cached('sms')
+        with self.assertNumQueries(0):
+            kg2 = KeyGroup.objects.get_cached('sms')
+        self.assertEqual(kg2, self.kg)
+        kg2.ttl = 10
+        self.assertEqual(KeyGroup.objects.get_cached('sms').ttl, 5)
+        self.assertRaises(KeyGroup.DoesNotExist, KeyGroup.objects.get_cached, 'nope')
+
+    def test_invalidated_on_save_and_delete(self):
+        KeyGroup.objects.get_cached('sms')
+        self.kg.ttl = 10
+        self.kg.save()
+        self.assertEqual(KeyGroup.objects.get_cached('sms').ttl, 10)
+        self.kg.delete()
+        self.assertRaises(KeyGroup.DoesNotExist, KeyGroup.objects.get_cached, 'sms')
+
+    @test.override_settings(VERIFICATION_GROUP_CACHE='default')
+    def test_invalidated_on_commit(self):
+        caches['default'].set(KeyGroupCache.version_key, 'before')
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.kg.ttl = 10
+                self.kg.save()
+                version = caches['default'].get(KeyGroupCache.version_key)
+                self.assertEqual(version, 'before')
+        self.assertNotEqual(caches['default'].get(KeyGroupCache.version_key), 'before')
+
+    @test.override_settings(VERIFICATION_GROUP_CACHE_TIMEOUT=0)
+    def test_timeout(self):
+        KeyGroup.objects.get_cached('sms')
+        with self.assertNumQueries(1):
+            KeyGroup.objects.get_cached('sms')
+
+    @test.override_settings(VERIFICATION_GROUP_CACHE='default')
+    def test_shared_version(self):
+        KeyGroup.objects.get_cached('sms')
+        with self.assertNumQueries(0):
+            KeyGroup.objects.get_cached('sms')
+        # Another process changed a group
+        caches['default'].set(KeyGroupCache.version_key, 'changed')
+        with self.assertNumQueries(1):
+            KeyGroup.objects.get_cached('sms')
+        with self.assertNumQueries(0):
+            KeyGroup.objects.get_cached('sms')
+
+    def test_key_save(self):
+        KeyGroup.objects.get_cached('sms')
+        k = Key(key='abcdefgh', group_id='sms')
+        with self.assertNumQueries(1):
+            k.save()
+        self.assertEqual(k.expires, k.pub_date + datetime.timedelta(minutes=5))
+
+    def test_lookup(self):
+        KeyGroup.objects.get_cached('sms')
+        with self.assertNumQueries(0):
+            self.assertEqual(KeyLookupMixin().get_group_from_string('sms'), self.kg)
+        self.assertRaises(Http404, KeyLookupMixin().get_group_from_string, 'nope')
+
+
 class KeyTest(test.TestCase):
 
     def setUp(self):
@@ -227,6 +617,57 @@ class KeyTest(test.TestCase):
         expired_keys = Key.objects.expired()
         self.assertFalse(expired_keys)
 
+    def test_delete_expired_count(self):
+        earlier = tznow() - datetime.timedelta(minutes=5)
+        for i in range(3):
+            Key.objects.create(key=str(i), group=self.kg_sms, expires=earlier)
+        Key.objects.create(key='3', group=self.kg_sms)
+        self.assertEqual(Key.objects.delete_expired(batch_size=2), 3)
+        self.assertEqual(Key.objects.count(), 1)
+
+    def test_purge(self):
+        for i in range(5):
+            Key.objects.create(key=str(i), group=self.kg_sms)
+        Key.objects.create(key='pin', group=self.kg_ttl)
+        keys = Key.objects.filter(group=self.kg_sms)
+        self.assertEqual(list(keys.purge(batch_size=2, dry_run=True)), [2, 2, 1])
+        self.assertEqual(Key.objects.count(), 6)
+        with mock.patch.object(KeyQuerySet, 'delete') as delete:
+            self.assertEqual(list(keys.purge(batch_size=2)), [2, 2, 1])
+            self.assertFalse(delete.called)
+        self.assertEqual(list(Key.objects.values_list('key', flat=True)), ['pin'])
+
+    def test_purge_with_signals(self):
+        deleted = []
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.key)
+        post_delete.connect(receiver, sender=Key)
+        try:
+            for i in range(3):
+                Key.objects.create(key=str(i), group=self.kg_sms)
+            self.assertEqual(sum(Key.objects.purge(batch_size=2)), 3)
+        finally:
+            post_delete.disconnect(receiver, sender=Key)
+        self.assertEqual(sorted(deleted), ['0', '1', '2'])
+
+    @mock.patch('time.sleep')
+    def test_purge_command(self, sleep):
+        earlier = tznow() - datetime.timedelta(minutes=5)
+        for i in range(3):
+            Key.objects.create(key=str(i), group=self.kg_sms, expires=earlier)
+        Key.objects.create(key='3', group=self.kg_sms)
+        Key.objects.create(key='4', group=self.kg_ttl, expires=earlier)
+        out = StringIO()
+        call_command('purge_verification_keys', group=['sms'], dry_run=True, stdout=out)
+        self.assertIn('Would delete 3 keys', out.getvalue())
+        self.assertEqual(Key.objects.count(), 5)
+        call_command('purge_verification_keys', group=['sms'], batch_size=2, sleep=1, stdout=out)
+        self.assertEqual(set(Key.objects.values_list('key', flat=True)), set(['3', '4']))
+        sleep.assert_called_once_with(1)
+        call_command('purge_verification_keys', group=['sms'], all=True, stdout=out)
+        self.assertEqual(list(Key.objects.values_list('key', flat=True)), ['4'])
+        self.assertRaises(CommandError, call_command, 'purge_verification_keys', all=True)
+
     def test_claimed(self):
         now = tznow()
         k = Key.objects.create(group=self.kg_sms, claimed=now)
@@ -333,6 +774,48 @@ class KeyTest(test.TestCase):
         self.assertEqual(k.fact, fact)
 
 
+class MigrationTest(test.TestCase):
+
+    def test_no_missing_migrations(self):
+        out = StringIO()
+        call_command('makemigrations', 'verification', check=True, dry_run=True, stdout=out)
+
+    def test_key_indexes(self):
+        connection = connections['default']
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Key._meta.db_table)
+        self.assertEqual(constraints['verification_key_state']['columns'],
+                         ['group_id', 'claimed', 'expires'])
+        self.assertEqual(constraints['verification_key_pub_date']['columns'], ['pub_date'])
+        if connection.features.supports_partial_indexes:
+            self.assertIn('verification_key_available', constraints)
+
+    def test_abstract_key_indexes(self):
+        self.assertEqual(AbstractKey._meta.indexes, [])
+        names = [index.name for index in key_indexes('a' * 20)]
+        self.assertEqual(max(len(name) for name in names), 30)
+        self.assertEqual([index.name for index in Key._meta.indexes],
+                         [index.name for index in key_indexes('verification_key')])
+
+    def test_add_index_concurrently(self):
+        migration = import_module('verification.migrations.0003_key_indexes')
+        self.assertFalse(migration.Migration.atomic)
+        operation = migration.Migration.operations[0]
+        schema_editor = mock.Mock()
+        schema_editor.connection.vendor = 'postgresql'
+        schema_editor.connection.alias = 'default'
+        state = mock.Mock()
+        operation.database_forwards('verification', schema_editor, state, state)
+        schema_editor.add_index.assert_called_once_with(
+            state.apps.get_model.return_value, operation.index, concurrently=True)
+
+    def test_pooled_index_concurrently(self):
+        migration = import_module('verification.migrations.0007_key_pooled_index')
+        self.assertFalse(migration.Migration.atomic)
+        self.assertEqual([type(operation).__name__ for operation in migration.Migration.operations],
+                         ['AddIndexConcurrently'])
+
+
 class ClaimTest(test.TestCase):
 
     def setUp(self):
@@ -360,6 +843,159 @@ class ClaimTest(test.TestCase):
         k1 = Key.objects.create(key='1', group=self.kg, expires=earlier)
         self.assertRaises(VerificationError, claim, '1', self.user)
 
+    def test_claim_failure_reasons(self):
+        now = tznow()
+        earlier = now - datetime.timedelta(minutes=5)
+        Key.objects.create(key='1', group=self.kg, expires=earlier)
+        Key.objects.create(key='2', group=self.kg, claimed=now)
+        with self.assertRaisesRegex(VerificationError, 'does not exist'):
+            claim('0', self.user)
+        with self.assertRaisesRegex(VerificationError, 'expired'):
+            claim('1', self.user)
+        with self.assertRaisesRegex(VerificationError, 'already been claimed'):
+            claim('2', self.user)
+
+    def test_claim_single_statement(self):
+        Key.objects.create(key='1', group=self.kg)
+        connection = connections[Key.objects.db]
+        queries = 1 if connection.features.can_return_columns_from_insert else 2
+        with self.assertNumQueries(queries):
+            k_claimed = claim('1', self.user, group=self.kg)
+        self.assertEqual(k_claimed.key, '1')
+        self.assertEqual(k_claimed.group, self.kg)
+        self.assertEqual(k_claimed.claimed_by, self.user)
+        self.assertIsNotNone(Key.objects.get(key='1').claimed)
+
+    def test_claim_malformed_key(self):
+        kg = KeyGroup.objects.create(name='pin', generator='pin')
+        Key.objects.create(key='1234', group=kg)
+        counters.reset()
+        with self.assertNumQueries(0):
+            with self.assertRaisesRegex(VerificationError, 'not a valid key'):
+                claim('12345', self.user, group=kg)
+        self.assertEqual(counters.get(kg, 'rejected'), 1)
+        self.assertEqual(claim('1234', self.user, group=kg).key, '1234')
+
+    @mock.patch('verification.models._can_update_returning', return_value=False)
+    def test_claim_without_returning(self, _):
+        Key.objects.create(key='1', group=self.kg)
+        with self.assertNumQueries(2):
+            k_claimed = claim('1', self.user)
+        self.assertEqual(k_claimed.claimed_by, self.user)
+        self.assertRaises(VerificationError, claim, '1', self.user)
+
+    def test_claim_stale_key(self):
+        k1 = Key.objects.create(key='1', group=self.kg)
+        stale = Key.objects.get(key='1')
+        k1.claim(self.user)
+        User = get_user_model()
+        other = User.objects.create(username='otheruser')
+        self.assertRaises(VerificationError, stale.claim, other)
+        self.assertEqual(Key.objects.get(key='1').claimed_by, self.user)
+
+    def test_claim_wrong_group(self):
+        kg = KeyGroup.objects.create(name='other')
+        Key.objects.create(key='1', group=self.kg)
+        self.assertRaises(VerificationError, claim, '1', self.user, kg)
+        self.assertRaises(VerificationError, Key.objects.filter(group=kg).claim, '1', self.user)
+
+
+class KeyLookupMixinTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='pin', generator='pin')
+        self.k = Key.objects.create(key='1234', group=self.kg)
+        counters.reset()
+
+    def test_get_key_from_string(self):
+        self.assertEqual(KeyLookupMixin().get_key_from_string('1234', 'pin'), self.k)
+
+    def test_malformed_key(self):
+        lookup = KeyLookupMixin()
+        with self.assertNumQueries(1):
+            self.assertRaises(Http404, lookup.get_key_from_string, 'x1234', 'pin')
+        self.assertEqual(counters.get(self.kg, 'rejected'), 1)
+
+
+class TestClaimView(AbstractClaimView):
+    keygroup = 'sms'
+
+
+class TestClaimOnPostFormView(AbstractClaimOnPostFormView):
+    form_class = forms.Form
+
+
+class ViewQueryBudgetTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.k = Key.objects.create(key='abcdefgh', group=self.kg, claimed_by=self.user)
+        self.kwargs = {'group': 'sms', 'key': 'abcdefgh'}
+        self.factory = test.RequestFactory()
+        self.anonymous = AnonymousUser()
+        # The KeyGroup cache is warm in steady state
+        KeyGroup.objects.get_cached('sms')
+        connection = connections['default']
+        self.write = 1 if connection.features.can_return_columns_from_insert else 2
+
+    def request(self, method, user, data=None):
+        request = getattr(self.factory, method)('/', data or {})
+        request.user = user
+        return request
+
+    def assertClaimed(self, response):
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Key.objects.claimed().get(), self.k)
+
+    def test_claim_get(self):
+        with self.assertNumQueries(self.write):
+            response = claim_get(self.request('get', self.user), **self.kwargs)
+        self.assertClaimed(response)
+
+    def test_claim_get_prestored_user(self):
+        with self.assertNumQueries(1 + self.write):
+            response = claim_get(self.request('get', self.anonymous), **self.kwargs)
+        self.assertClaimed(response)
+
+    def test_claim_get_malformed_key(self):
+        with self.assertNumQueries(0):
+            self.assertRaises(Http404, claim_get, self.request('get', self.user),
+                              group='sms', key='abc')
+
+    def test_claim_post_url(self):
+        with self.assertNumQueries(1):
+            response = claim_post_url(self.request('get', self.user), **self.kwargs)
+            response.render()
+        self.assertContains(response, 'abcdefgh')
+        with self.assertNumQueries(self.write):
+            response = claim_post_url(self.request('post', self.user), **self.kwargs)
+        self.assertClaimed(response)
+
+    def test_claim_post_form(self):
+        view = TestClaimOnPostFormView.as_view()
+        with self.assertNumQueries(1):
+            view(self.request('get', self.anonymous), **self.kwargs).render()
+        with self.assertNumQueries(1 + self.write):
+            response = view(self.request('post', self.anonymous), **self.kwargs)
+        self.assertClaimed(response)
+
+    def test_claim_view(self):
+        view = TestClaimView.as_view()
+        with self.assertNumQueries(0):
+            view(self.request('get', self.user)).render()
+        with self.assertNumQueries(self.write):
+            response = view(self.request('post', self.user, {'key': 'abcdefgh'}))
+        self.assertClaimed(response)
+
+    def test_claim_success(self):
+        self.k.claim(self.user)
+        with self.assertNumQueries(1):
+            response = claim_success(self.request('get', self.anonymous), **self.kwargs)
+            response.render()
+        self.assertContains(response, 'successfully claimed by testuser')
+
 
 class ClaimSuccessViewTest(test.TestCase):
 
@@ -384,3 +1020,1056 @@ class ClaimSuccessViewTest(test.TestCase):
         request = self.factory.get(reverse('verification-success', kwargs=kwargs))
         response = claim_success(request, **kwargs)
         self.assertNotEqual(response.status_code, 500)
+
+
+@unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+class AsyncClaimTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.k = Key.objects.create(key='1', group=self.kg)
+        self.claims = []
+        key_claimed.connect(self.on_claimed)
+        self.addCleanup(key_claimed.disconnect, self.on_claimed)
+
+    def on_claimed(self, sender, claimant, group, **kwargs):
+        self.claims.append((sender.key, claimant, group))
+
+    async def test_aclaim(self):
+        k_claimed = await aclaim('1', self.user)
+        self.assertEqual(k_claimed.claimed_by, self.user)
+        self.assertEqual(k_claimed.group, self.kg)
+        self.assertTrue(k_claimed.claimed)
+        self.assertEqual(self.claims, [('1', self.user, self.kg)])
+        with self.assertRaisesRegex(VerificationError, 'already been claimed'):
+            await aclaim('1', self.user)
+        with self.assertRaises(KeyDoesNotExist):
+            await aclaim('0', self.user)
+
+    async def test_queryset_aclaim(self):
+        self.assertEqual(await Key.objects.aavailable(), [self.k])
+        k_claimed = await Key.objects.aclaim('1', self.user, group=self.kg)
+        self.assertEqual(k_claimed, self.k)
+        self.assertEqual(await Key.objects.aavailable(), [])
+
+    @mock.patch('verification.models._can_update_returning', return_value=False)
+    async def test_aclaim_without_returning(self, _):
+        k_claimed = await self.k.aclaim(self.user)
+        self.assertEqual(k_claimed.claimed_by, self.user)
+        self.assertEqual(len(self.claims), 1)
+
+    async def test_aclaim_hashed_loaded_key(self):
+        kg = await KeyGroup.objects.acreate(name='hashed', hash_keys=True)
+        k = await Key.objects.acreate(key='2', group=kg)
+        loaded = await Key.objects.aget(pk=k.pk)
+        self.assertIsNone(loaded.key)
+        k_claimed = await loaded.aclaim(self.user)
+        self.assertEqual(k_claimed.pk, k.pk)
+        self.assertTrue(await Key.objects.filter(pk=k.pk).claimed().aexists())
+
+    async def test_aclaim_signed(self):
+        kg = await KeyGroup.objects.acreate(name='signed', generator='signed')
+        k = Key.generate(kg)
+        k_claimed = await aclaim(k.key, self.user)
+        self.assertEqual(k_claimed.group, kg)
+        self.assertTrue(await Key.objects.filter(group=kg).aexists())
+        with self.assertRaisesRegex(VerificationError, 'already been claimed'):
+            await aclaim(k.key, self.user)
+
+
+@unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+class AsyncViewTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.k = Key.objects.create(key='abcdefgh', group=self.kg, claimed_by=self.user)
+        self.kwargs = {'group': 'sms', 'key': 'abcdefgh'}
+        self.factory = test.AsyncRequestFactory()
+
+    def request(self, method, user):
+        request = getattr(self.factory, method)('/')
+        request.user = user
+        return request
+
+    async def assertClaimed(self, response):
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(await Key.objects.claimed().aget(), self.k)
+
+    async def test_aclaim_get(self):
+        response = await aclaim_get(self.request('get', self.user), **self.kwargs)
+        await self.assertClaimed(response)
+
+    async def test_aclaim_get_prestored_user(self):
+        response = await aclaim_get(self.request('get', AnonymousUser()), **self.kwargs)
+        await self.assertClaimed(response)
+
+    async def test_aclaim_get_signed_prestored_user(self):
+        kg = await KeyGroup.objects.acreate(name='signed', generator='signed')
+        k = await sync_to_async(Key.generate)(kg, claimant=self.user)
+        response = await aclaim_get(self.request('get', AnonymousUser()),
+                                    group='signed', key=k.key)
+        self.assertEqual(response.status_code, 302)
+        claimed = await Key.objects.filter(group=kg).aget()
+        self.assertEqual(claimed.claimed_by_id, self.user.pk)
+
+    async def test_aclaim_get_no_such_key(self):
+        with self.assertRaises(Http404):
+            await aclaim_get(self.request('get', self.user), group='sms', key='abcdefgx')
+        with self.assertRaises(Http404):
+            await aclaim_get(self.request('get', self.user), group='nope', key='abcdefgh')
+
+    async def test_aclaim_post_url(self):
+        response = await aclaim_post_url(self.request('get', self.user), **self.kwargs)
+        await sync_to_async(response.render)()
+        self.assertContains(response, 'abcdefgh')
+        response = await aclaim_post_url(self.request('post', self.user), **self.kwargs)
+        await self.assertClaimed(response)
+
+    async def test_aclaim_success(self):
+        await self.k.aclaim(self.user)
+        response = await aclaim_success(self.request('get', AnonymousUser()), **self.kwargs)
+        await sync_to_async(response.render)()
+        self.assertContains(response, 'successfully claimed by testuser')
+
+
+@test.override_settings(VERIFICATION_CLAIM_OUTBOX=True)
+class ClaimOutboxTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.k = Key.objects.create(key='1', group=self.kg)
+        self.claims = []
+        key_claimed.connect(self.on_claimed)
+        self.addCleanup(key_claimed.disconnect, self.on_claimed)
+
+    def on_claimed(self, sender, claimant, group, **kwargs):
+        self.claims.append((sender.pk, claimant, group))
+
+    def test_claim_stores_event(self):
+        k_claimed = claim('1', self.user)
+        self.assertEqual(self.claims, [])
+        event = ClaimEvent.objects.get()
+        self.assertEqual((event.key_model, event.key_pk), ('verification.Key', str(self.k.pk)))
+        self.assertEqual(list(ClaimEvent.objects.process()), [(1, 0)])
+        self.assertEqual(self.claims, [(self.k.pk, self.user, self.kg)])
+        self.assertFalse(ClaimEvent.objects.exists())
+
+    def test_failed_claim_stores_no_event(self):
+        claim('1', self.user)
+        self.assertRaises(VerificationError, claim, '1', self.user)
+        self.assertRaises(VerificationError, claim, '2', self.user)
+        self.assertEqual(ClaimEvent.objects.count(), 1)
+
+    def test_retry(self):
+        def broken(sender, **kwargs):
+            raise ValueError('CRM is down')
+        key_claimed.connect(broken)
+        self.addCleanup(key_claimed.disconnect, broken)
+        claim('1', self.user)
+        with self.assertLogs('verification.models', 'WARNING'):
+            batches = list(ClaimEvent.objects.process(retry_delay=0, max_attempts=2))
+        self.assertEqual(batches, [(0, 1), (0, 1)])
+        event = ClaimEvent.objects.failed(max_attempts=2).get()
+        self.assertEqual(event.attempts, 2)
+        self.assertIn('CRM is down', event.last_error)
+        self.assertEqual(len(self.claims), 2)
+        key_claimed.disconnect(broken)
+        self.assertEqual(list(ClaimEvent.objects.process(max_attempts=3)), [(1, 0)])
+
+    def test_bad_event(self):
+        ClaimEvent.objects.create(key_model='verification.Key', key_pk='None')
+        claim('1', self.user)
+        with self.assertLogs('verification.models', 'WARNING'):
+            batches = list(ClaimEvent.objects.process(retry_delay=0, max_attempts=1))
+        self.assertEqual(batches, [(1, 1)])
+        self.assertEqual(self.claims, [(self.k.pk, self.user, self.kg)])
+        event = ClaimEvent.objects.failed(max_attempts=1).get()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('must be an integer', event.last_error)
+
+    def test_process_batches(self):
+        for i in range(2, 6):
+            Key.objects.create(key=str(i), group=self.kg)
+        for i in range(1, 6):
+            claim(str(i), self.user)
+        Key.objects.filter(key='5').delete()
+        with CaptureQueriesContext(connections['default']) as queries:
+            batches = list(ClaimEvent.objects.process(batch_size=2))
+        # Lease, load keys and delete sent events per batch
+        queries = [q for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(queries), 3 * 4 + 1)
+        self.assertEqual(batches, [(2, 0), (2, 0), (1, 0)])
+        self.assertEqual(len(self.claims), 4)
+
+    def test_command(self):
+        claim('1', self.user)
+        out = StringIO()
+        call_command('process_claim_events', stdout=out)
+        self.assertIn('Sent 1 claim events, 0 failed', out.getvalue())
+        self.assertEqual(len(self.claims), 1)
+
+    @unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+    async def test_aclaim(self):
+        await aclaim('1', self.user)
+        self.assertEqual(self.claims, [])
+        self.assertEqual(await ClaimEvent.objects.acount(), 1)
+
+
+@test.override_settings(VERIFICATION_DELIVERY_BACKEND='verification.delivery.LocmemBackend')
+class DeliveryTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms')
+        self.keys = [Key.objects.create(key=str(i), group=self.kg) for i in range(10)]
+        delivery.outbox[:] = []
+
+    def deliveries(self):
+        return (delivery.Delivery(k, '%s@example.com' % k.key, 'Key: %s' % k.key)
+                for k in self.keys)
+
+    def test_send_key(self):
+        sent = self.keys[0].send_key('a@example.com', 'Key: 0')
+        self.assertEqual(sent.status, delivery.SENT)
+        self.assertEqual(delivery.outbox, [sent])
+        self.assertEqual(sent.key, self.keys[0])
+
+    def test_failure(self):
+        def broken(recipient, content):
+            raise IOError('SMSC is down')
+        backend = delivery.FuncBackend(broken)
+        with self.assertLogs('verification.delivery', 'WARNING'):
+            sent = self.keys[0].deliver('555-1234', 'Key: 0', backend=backend)
+        self.assertEqual(sent.status, delivery.FAILED)
+        self.assertIsInstance(sent.error, IOError)
+
+    def test_no_backend(self):
+        with self.settings(VERIFICATION_DELIVERY_BACKEND=None):
+            self.assertRaises(TypeError, self.keys[0].send_key, 'a@example.com')
+            self.assertRaises(ImproperlyConfigured, delivery.get_backend)
+
+    def test_email_backend_reuses_connection(self):
+        backend = delivery.EmailBackend(subject='Your key')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open') as opened:
+            with backend:
+                for k in self.keys[:3]:
+                    k.deliver(' a@example.com ', 'Key: %s' % k.key, backend=backend)
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].to, ['a@example.com'])
+        self.assertEqual(mail.outbox[0].subject, 'Your key')
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'keys.jsonl')
+            batches = list(delivery.send_many(self.deliveries(),
+                                              'verification.delivery.FileBackend',
+                                              file_path=path))
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[0], {'key': '0', 'group': 'sms',
+                                    'recipient': '0@example.com', 'content': 'Key: 0'})
+
+    def test_send_many(self):
+        opened = []
+
+        class CountingBackend(delivery.LocmemBackend):
+            def open(self):
+                opened.append(self)
+
+        with mock.patch('verification.delivery.LocmemBackend', CountingBackend):
+            batches = list(delivery.send_many(self.deliveries(), batch_size=3, workers=2))
+        self.assertEqual(sorted(len(batch) for batch in batches), [1, 3, 3, 3])
+        self.assertLessEqual(len(opened), 2)
+        self.assertEqual(len(delivery.outbox), 10)
+        statuses = set(d.status for batch in batches for d in batch)
+        self.assertEqual(statuses, set([delivery.SENT]))
+
+    def test_queued(self):
+        backend = delivery.QueuedBackend('verification.delivery.LocmemBackend', workers=1)
+        with backend:
+            queued = self.keys[0].deliver('a@example.com', 'Key: 0', backend=backend)
+        self.assertIn(queued.status, (delivery.QUEUED, delivery.SENT))
+        self.assertEqual(queued.wait(5), delivery.SENT)
+        self.assertEqual(delivery.outbox, [queued])
+
+    @test.override_settings(
+        VERIFICATION_DELIVERY_BACKEND='verification.delivery.QueuedBackend',
+        VERIFICATION_DELIVERY_OPTIONS={'backend': 'verification.delivery.LocmemBackend',
+                                       'workers': 1})
+    def test_queued_shares_backend(self):
+        opened = []
+        queued = threading.Event()
+
+        def open_backend(backend):
+            opened.append(backend)
+            # Hold the worker until all keys are queued
+            queued.wait(5)
+        with mock.patch.object(delivery.LocmemBackend, 'open', open_backend):
+            deliveries = [key.deliver('a@example.com', 'Key') for key in self.keys]
+            queued.set()
+            statuses = [d.wait(5) for d in deliveries]
+        self.assertEqual(statuses, [delivery.SENT] * 10)
+        self.assertLessEqual(len(opened), 2)
+
+
+THROTTLES = {
+    'sms': {
+        'claim_ip': '3/m',
+        'claim_prefix': '5/h',
+        'claim_prefix_length': 2,
+        'issue': '2/h',
+    },
+}
+
+
+@test.override_settings(VERIFICATION_THROTTLES=THROTTLES)
+class ThrottleTest(test.TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        counters.reset()
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.factory = test.RequestFactory()
+
+    def claim_get(self, key, ip='10.0.0.1'):
+        request = self.factory.get('/', REMOTE_ADDR=ip)
+        request.user = self.user
+        try:
+            return claim_get(request, group='sms', key=key)
+        except Http404:
+            return None
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/m'), (10, 60))
+        self.assertEqual(parse_rate('100/5m'), (100, 300))
+        self.assertEqual(parse_rate('1/d'), (1, 86400))
+
+    def test_claim_per_ip(self):
+        for key in ('aaaaaaaa', 'bbbbbbbb', 'cccccccc'):
+            self.assertIsNone(self.claim_get(key))
+        with self.assertNumQueries(0):
+            response = self.claim_get('dddddddd')
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) > 0)
+        self.assertEqual(counters.get('sms', 'throttled_claim_ip'), 1)
+        self.assertIsNone(self.claim_get('dddddddd', ip='10.0.0.2'))
+
+    def test_claim_per_prefix(self):
+        for i in range(5):
+            self.assertIsNone(self.claim_get('aaaaaaaa', ip='10.0.0.%i' % i))
+        self.assertEqual(self.claim_get('aabbbbbb', ip='10.0.1.1').status_code, 429)
+        self.assertIsNone(self.claim_get('bbbbbbbb', ip='10.0.1.1'))
+        self.assertEqual(counters.get('sms', 'throttled_claim_prefix'), 1)
+
+    def test_lookup(self):
+        for key in ('aaaaaaaa', 'bbbbbbbb', 'cccccccc'):
+            request = self.factory.get('/', REMOTE_ADDR='10.0.0.1')
+            request.user = AnonymousUser()
+            self.assertRaises(Http404, claim_success, request, group='sms', key=key)
+        request = self.factory.get('/', REMOTE_ADDR='10.0.0.1')
+        request.user = AnonymousUser()
+        with self.assertNumQueries(0):
+            response = claim_post_url(request, group='sms', key='dddddddd')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(counters.get('sms', 'throttled_claim_ip'), 1)
+
+    def test_other_groups_unlimited(self):
+        kg = KeyGroup.objects.create(name='pin', generator='pin')
+        for i in range(5):
+            Key.generate(kg, claimant=self.user)
+
+    def test_issue(self):
+        Key.generate(self.kg, claimant=self.user)
+        Key.generate(self.kg, claimant=self.user)
+        with self.assertNumQueries(0):
+            self.assertRaises(Throttled, Key.generate, self.kg, claimant=self.user)
+        Key.generate(self.kg, fact='a@example.com')
+        Key.generate(self.kg, fact='a@example.com')
+        self.assertRaises(Throttled, Key.generate, self.kg, fact='a@example.com')
+        self.assertEqual(counters.get('sms', 'throttled_issue'), 2)
+
+    @unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+    async def test_async_claim(self):
+        statuses = []
+        for i in range(4):
+            request = test.AsyncRequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+            request.user = self.user
+            try:
+                response = await aclaim_get(request, group='sms', key='aaaaaaaa')
+            except Http404:
+                continue
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [429])
+
+    @unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+    async def test_async_lookup(self):
+        statuses = []
+        for i in range(4):
+            request = test.AsyncRequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+            request.user = AnonymousUser()
+            try:
+                response = await aclaim_success(request, group='sms', key='aaaaaaaa')
+            except Http404:
+                continue
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [429])
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_membership(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        items = ['key%i' % i for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+        false_positives = sum('other%i' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_bytes(self):
+        bloom = BloomFilter.for_capacity(10)
+        bloom.add(b'\x00\xff')
+        self.assertIn(b'\x00\xff', bloom)
+        self.assertIn(memoryview(b'\x00\xff'), bloom)
+
+
+@test.override_settings(VERIFICATION_KEY_FILTER_CACHE='default')
+class KeyFilterTest(test.TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        key_filter.reset()
+        counters.reset()
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        for key in ('aaaaaaaa', 'bbbbbbbb'):
+            Key.objects.create(key=key, group=self.kg)
+        KeyGroup.objects.get_cached('sms')
+
+    def test_no_filter(self):
+        self.assertTrue(key_filter.might_exist(self.kg, 'cccccccc'))
+        self.assertRaises(KeyDoesNotExist, claim, 'cccccccc', self.user, group=self.kg)
+
+    def test_claim_missing_key(self):
+        self.assertEqual(self.kg.build_key_filter(), 2)
+        with self.assertNumQueries(0):
+            self.assertRaises(KeyDoesNotExist, claim, 'cccccccc', self.user, group=self.kg)
+        self.assertEqual(counters.get('sms', 'filtered'), 1)
+        self.assertEqual(claim('aaaaaaaa', self.user, group=self.kg).key, 'aaaaaaaa')
+
+    def test_view(self):
+        self.kg.build_key_filter()
+        request = test.RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with self.assertNumQueries(0):
+            self.assertRaises(Http404, claim_success, request, group='sms', key='cccccccc')
+
+    def test_new_keys(self):
+        self.kg.build_key_filter()
+        with self.captureOnCommitCallbacks(execute=True):
+            Key.objects.create(key='cccccccc', group=self.kg)
+        with self.captureOnCommitCallbacks(execute=True):
+            batch = self.kg.generate_keys(Key, 3)
+        # Another process, with the filter as built
+        other = KeyFilterCache()
+        for keystring in ['cccccccc'] + [k.key for k in batch]:
+            self.assertTrue(other.might_exist(self.kg, keystring))
+            self.assertTrue(key_filter.might_exist(self.kg, keystring))
+        self.assertFalse(other.might_exist(self.kg, 'dddddddd'))
+
+    def test_new_key_lost(self):
+        self.kg.build_key_filter()
+        with self.captureOnCommitCallbacks(execute=True):
+            Key.objects.create(key='cccccccc', group=self.kg)
+        caches['default'].delete(key_filter._key('sms', 'new', 1))
+        other = KeyFilterCache()
+        self.assertTrue(other.might_exist(self.kg, 'dddddddd'))
+
+    def test_hashed_keys(self):
+        kg = KeyGroup.objects.create(name='hashed', generator='sms', hash_keys=True)
+        Key.objects.create(key='aaaaaaaa', group=kg)
+        kg.build_key_filter()
+        self.assertTrue(KeyFilterCache().might_exist(kg, 'aaaaaaaa'))
+        self.assertFalse(KeyFilterCache().might_exist(kg, 'bbbbbbbb'))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('build_key_filters', stdout=out)
+        self.assertIn('Built the filter of sms from 2 keys', out.getvalue())
+        self.assertFalse(key_filter.might_exist(self.kg, 'cccccccc'))
+        call_command('build_key_filters', '--clear', '--group', 'sms', stdout=out)
+        self.assertTrue(KeyFilterCache().might_exist(self.kg, 'cccccccc'))
+        with self.settings(VERIFICATION_KEY_FILTER_CACHE=None):
+            self.assertRaises(CommandError, call_command, 'build_key_filters')
+
+    @unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+    async def test_aclaim(self):
+        await sync_to_async(self.kg.build_key_filter)()
+        with self.assertRaises(KeyDoesNotExist):
+            await aclaim('cccccccc', self.user, group=self.kg)
+        self.assertFalse(await KeyFilterCache().amight_exist(self.kg, 'cccccccc'))
+        self.assertTrue(await KeyFilterCache().amight_exist(self.kg, 'aaaaaaaa'))
+
+
+class ArchiveTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', archive_after=30)
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        old = tznow() - datetime.timedelta(days=31)
+        recent = tznow() - datetime.timedelta(days=1)
+        Key.objects.create(key='1', group=self.kg, claimed=old, claimed_by=self.user)
+        Key.objects.create(key='2', group=self.kg, expires=old)
+        Key.objects.create(key='3', group=self.kg, claimed=recent, claimed_by=self.user)
+        Key.objects.create(key='4', group=self.kg)
+
+    def test_archivable_keys(self):
+        keys = self.kg.archivable_keys()
+        self.assertEqual(set(keys.values_list('key', flat=True)), set(['1', '2']))
+        kg = KeyGroup.objects.create(name='keep')
+        self.assertFalse(kg.archivable_keys().exists())
+
+    def test_archive(self):
+        self.assertEqual(list(self.kg.archivable_keys().archive(batch_size=1)), [1, 1])
+        self.assertEqual(set(Key.objects.values_list('key', flat=True)), set(['3', '4']))
+        archived = ArchivedKey.objects.filter_key('1', self.kg).get()
+        self.assertEqual(archived.group, 'sms')
+        self.assertEqual(archived.claimant_pk, str(self.user.pk))
+        self.assertIsNotNone(archived.claimed)
+        self.assertTrue(ArchivedKey.objects.filter_key('2').exists())
+
+    def test_archive_hashed(self):
+        kg = KeyGroup.objects.create(name='hashed', hash_keys=True, archive_after=0)
+        Key.objects.create(key='5', group=kg, expires=tznow())
+        self.assertEqual(sum(kg.archivable_keys().archive()), 1)
+        archived = ArchivedKey.objects.filter_key('5').get()
+        self.assertIsNone(archived.key)
+        self.assertEqual(bytes(archived.digest), key_digest('5'))
+
+    def test_archive_signed(self):
+        kg = KeyGroup.objects.create(name='signed', generator='signed', archive_after=0)
+        k = Key.generate(kg)
+        claim(k.key, self.user, group=kg)
+        self.assertFalse(kg.archivable_keys().exists())
+        self.assertEqual(sum(kg.archivable_keys().archive()), 0)
+        self.assertRaisesRegex(VerificationError, 'already been claimed',
+                               claim, k.key, self.user, kg)
+        Key.objects.filter(group=kg).update(expires=tznow())
+        self.assertEqual(sum(kg.archivable_keys().archive()), 1)
+
+    def test_dry_run(self):
+        self.assertEqual(sum(self.kg.archivable_keys().archive(dry_run=True)), 2)
+        self.assertEqual(Key.objects.count(), 4)
+        self.assertFalse(ArchivedKey.objects.exists())
+
+    def test_command(self):
+        out = StringIO()
+        call_command('archive_verification_keys', stdout=out)
+        self.assertIn('Archived 2 keys of sms', out.getvalue())
+        self.assertEqual(ArchivedKey.objects.count(), 2)
+
+    def test_command_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'keys.jsonl.gz')
+            call_command('archive_verification_keys', file=path, stdout=StringIO())
+            with gzip.open(path, 'rt') as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(sorted(line['key'] for line in lines), ['1', '2'])
+        self.assertEqual(lines[0]['group'], 'sms')
+        self.assertFalse(ArchivedKey.objects.exists())
+        self.assertEqual(Key.objects.count(), 2)
+
+
+class InstrumentationTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.collector = HistogramCollector()
+        self.timings = []
+        instrumentation.subscribe(self.collector.record)
+        instrumentation.subscribe(self.on_timing)
+        self.addCleanup(instrumentation.unsubscribe, self.collector.record)
+        self.addCleanup(instrumentation.unsubscribe, self.on_timing)
+
+    def on_timing(self, operation, group, outcome, seconds):
+        self.timings.append((operation, group, outcome))
+        self.assertTrue(seconds >= 0)
+
+    @mock.patch.object(instrumentation, '_callbacks', ())
+    def test_disabled(self):
+        self.assertFalse(instrumentation.enabled)
+        with instrumentation.timer('claim', self.kg) as timer:
+            timer.group = 'other'
+        self.assertEqual(self.timings, [])
+
+    def test_claim(self):
+        key = Key.generate(self.kg)
+        del self.timings[:]
+        claim(key.key, self.user)
+        with self.assertRaises(VerificationError):
+            claim(key.key, self.user)
+        with self.assertRaises(KeyDoesNotExist):
+            claim(key.key[::-1], self.user, group=self.kg)
+        self.assertEqual(self.timings, [
+            ('signal', 'sms', 'ok'),
+            ('claim', 'sms', 'ok'),
+            ('claim', '', 'VerificationError'),
+            ('claim', 'sms', 'KeyDoesNotExist'),
+        ])
+
+    def test_generate_and_send(self):
+        key = Key.generate(self.kg)
+        key.send_func = lambda recipient: None
+        key.send_key('someone')
+        self.assertEqual(self.timings, [('generate', 'sms', 'ok'), ('send', 'sms', 'ok')])
+
+    def test_send_delivery_status(self):
+        key = Key.generate(self.kg)
+        with self.settings(VERIFICATION_DELIVERY_BACKEND='verification.delivery.LocmemBackend'):
+            key.send_key('someone')
+        self.assertEqual(self.timings[-1], ('send', 'sms', delivery.SENT))
+
+    def test_lookup(self):
+        key = Key.generate(self.kg)
+        del self.timings[:]
+        request = test.RequestFactory().get('/')
+        request.user = self.user
+        claim_success(request, group='sms', key=key.key)
+        with self.assertRaises(Http404):
+            claim_success(request, group='sms', key=key.key[::-1])
+        self.assertEqual(self.timings, [('lookup', 'sms', 'ok'), ('lookup', 'sms', 'Http404')])
+
+    def test_failing_callback(self):
+        def fail(*args):
+            raise ValueError
+        instrumentation.subscribe(fail)
+        self.addCleanup(instrumentation.unsubscribe, fail)
+        with self.assertLogs('verification.instrumentation', 'ERROR'):
+            Key.generate(self.kg)
+        self.assertEqual(len(self.timings), 1)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        # Off by at most one bucket, about 19%
+        self.assertTrue(0.050 <= histogram.percentile(0.5) < 0.050 * 1.19)
+        self.assertTrue(0.099 <= histogram.percentile(0.99) < 0.099 * 1.19)
+        self.assertIsNone(Histogram().percentile(0.5))
+
+    def test_exporters(self):
+        self.collector.record('claim', 'sms', 'ok', 0.002)
+        text = TextExporter().export(self.collector)
+        self.assertTrue(text.startswith('claim sms ok count=1 p50='))
+        prometheus = PrometheusExporter().export(self.collector)
+        labels = 'operation="claim",group="sms",outcome="ok"'
+        self.assertIn('# TYPE verification_operation_seconds summary', prometheus)
+        self.assertIn('verification_operation_seconds{%s,quantile="0.99"}' % labels, prometheus)
+        self.assertIn('verification_operation_seconds_count{%s} 1' % labels, prometheus)
+
+    def test_metrics_view(self):
+        response = metrics(test.RequestFactory().get('/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'verification_operation_seconds', response.content)
+
+
+@test.override_settings(MIDDLEWARE=['verification.profiling.ProfilingMiddleware'])
+class ProfilingTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+        self.k = Key.objects.create(key='abcdefgh', group=self.kg)
+        self.url = reverse('verification-claim-post-url', kwargs={'group': 'sms', 'key': 'abcdefgh'})
+
+    def test_profile(self):
+        with profile() as current:
+            claim('abcdefgh', self.user, group=self.kg)
+        self.assertEqual(current.queries, 1)
+        self.assertEqual(set(current.timings), set(['db', 'claim', 'signal']))
+        self.assertTrue(current.total >= current.timings['claim'] >= current.timings['db'])
+        self.assertEqual(current.as_dict()['queries'], 1)
+
+    def test_subscribed_while_profiling(self):
+        subscribed = lambda: profiling._record in instrumentation._callbacks
+        ProfilingMiddleware(lambda request: None)
+        self.assertFalse(subscribed())
+        with profile():
+            with profile():
+                self.assertTrue(subscribed())
+            self.assertTrue(subscribed())
+        self.assertFalse(subscribed())
+
+    def test_middleware(self):
+        with self.assertLogs('verification.profiling', 'INFO') as logs:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        for name in ('verification-db', 'verification-lookup', 'verification-render'):
+            self.assertIn(name + ';dur=', timing)
+        self.assertIn('queries"', timing)
+        data = json.loads(logs.records[0].getMessage())
+        # The group, unless cached, and the key
+        self.assertTrue(1 <= data['queries'] <= 2)
+        self.assertEqual(data['status'], 200)
+        self.assertEqual(data['view'], 'verification.views.ClaimOnPostUrlView')
+
+    def test_other_views(self):
+        response = self.client.get('/nowhere/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @test.override_settings(VERIFICATION_PROFILING_SAMPLE_RATE=0)
+    def test_sampled(self):
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @test.override_settings(VERIFICATION_PROFILING_HEADER=False)
+    def test_no_header(self):
+        with self.assertLogs('verification.profiling', 'INFO'):
+            response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+    async def test_async_middleware(self):
+        request = test.AsyncRequestFactory().get(self.url)
+        request.user = self.user
+        request.resolver_match = resolve(self.url.replace('/post/', '/get/'))
+
+        async def get_response(request):
+            return await aclaim_get(request, group='sms', key='abcdefgh')
+        middleware = ProfilingMiddleware(get_response)
+        with self.assertLogs('verification.profiling', 'INFO'):
+            response = await middleware(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('verification-claim;dur=', response['Server-Timing'])
+        self.assertIn('verification-signal;dur=', response['Server-Timing'])
+
+
+class KeyAdminTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms')
+        self.hashed = KeyGroup.objects.create(name='hashed', hash_keys=True)
+        for key in ('abc1', 'abc2', 'xyz1'):
+            Key.objects.create(key=key, group=self.kg)
+        Key.objects.create(key='secret', group=self.hashed)
+        self.admin = KeyAdmin(Key, admin.site)
+
+    def search(self, term):
+        keys, _ = self.admin.get_search_results(None, Key.objects.all(), term)
+        return set(keys.values_list('pk', flat=True))
+
+    def test_search(self):
+        self.assertEqual(self.search('abc1'), set([Key.objects.get(key='abc1').pk]))
+        self.assertEqual(self.search('abc'), set())
+        self.assertEqual(len(self.search('abc*')), 2)
+        self.assertEqual(self.search(' secret '),
+                         set([Key.objects.get(group=self.hashed).pk]))
+        self.assertEqual(len(self.search('')), 4)
+
+    def test_paginator(self):
+        paginator = EstimatedCountPaginator(Key.objects.all(), 2)
+        paginator.max_count = 3
+        with mock.patch('verification.admin.estimated_count', return_value=None):
+            self.assertEqual(paginator.count, 3)
+        paginator = EstimatedCountPaginator(Key.objects.all(), 2)
+        paginator.max_count = 3
+        with mock.patch('verification.admin.estimated_count', return_value=20000000):
+            with self.assertNumQueries(0):
+                self.assertEqual(paginator.count, 20000000)
+        # Filtered results are counted
+        paginator = EstimatedCountPaginator(Key.objects.filter(group=self.kg), 2)
+        with mock.patch('verification.admin.estimated_count', return_value=20000000):
+            self.assertEqual(paginator.count, 3)
+
+    def test_changelist_queries(self):
+        User = get_user_model()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(user)
+        url = reverse('admin:verification_key_changelist')
+        with CaptureQueriesContext(connections['default']) as few:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for i in range(10):
+            Key.objects.create(key='many%i' % i, group=self.kg, claimed_by=user)
+        with CaptureQueriesContext(connections['default']) as many:
+            response = self.client.get(url + '?q=many*')
+        self.assertContains(response, 'many9')
+        self.assertEqual(len(many), len(few))
+
+
+class KeyPoolTest(test.TestCase):
+
+    def setUp(self):
+        counters.reset()
+        self.kg = KeyGroup.objects.create(name='pin', generator='pin', ttl=10,
+                                          pool_size=10, pool_low_water=4)
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+
+    def test_refill_pool(self):
+        self.assertEqual(self.kg.refill_pool(), 10)
+        self.assertEqual(Key.objects.pooled().count(), 10)
+        self.assertFalse(Key.objects.available().exists())
+        self.assertIsNone(Key.objects.pooled()[0].expires)
+        # Not below the low-water mark
+        Key.objects.pooled()[0].delete()
+        self.assertEqual(self.kg.refill_pool(), 0)
+        Key.objects.pooled().filter(pk__in=Key.objects.pooled().values('pk')[:6]).delete()
+        self.assertEqual(self.kg.refill_pool(), 7)
+        self.assertEqual(Key.objects.pooled().count(), 10)
+
+    def test_no_pool(self):
+        for kg in (KeyGroup.objects.create(name='sms', generator='sms'),
+                   KeyGroup.objects.create(name='hashed', generator='sms',
+                                           hash_keys=True, pool_size=10),
+                   KeyGroup.objects.create(name='signed', generator='signed',
+                                           pool_size=10)):
+            self.assertFalse(kg.pooling)
+            self.assertEqual(kg.refill_pool(), 0)
+        self.assertFalse(Key.objects.exists())
+
+    def test_generate_from_pool(self):
+        self.kg.refill_pool()
+        with self.assertNumQueries(4):  # Savepoint, select, update, release
+            key = Key.generate(self.kg, fact='fact', claimant=self.user)
+        self.assertFalse(key.pooled)
+        self.assertEqual(key.fact, 'fact')
+        self.assertEqual(key.claimed_by, self.user)
+        self.assertTrue(key.expires > tznow())
+        stored = Key.objects.get(pk=key.pk)
+        self.assertEqual((stored.fact, stored.claimed_by, stored.expires),
+                         ('fact', self.user, key.expires))
+        self.assertEqual(Key.objects.pooled().count(), 9)
+        self.assertNotEqual(Key.generate(self.kg), key)
+        self.assertEqual(counters.get(self.kg, 'pool_taken'), 2)
+
+    def test_empty_pool(self):
+        key = Key.generate(self.kg)
+        self.assertFalse(key.pooled)
+        self.assertEqual(counters.get(self.kg, 'pool_empty'), 1)
+
+    def test_pooled_keys_cannot_be_claimed(self):
+        self.kg.refill_pool()
+        keystring = Key.objects.pooled()[0].key
+        with self.assertRaises(KeyDoesNotExist):
+            claim(keystring, self.user, group=self.kg)
+        self.assertFalse(Key.objects.filter_key(keystring, self.kg).exists())
+        request = test.RequestFactory().get('/')
+        request.user = self.user
+        with self.assertRaises(Http404):
+            claim_success(request, group='pin', key=keystring)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('refill_key_pools', stdout=out)
+        self.assertIn('Made 10 keys for the pool of pin', out.getvalue())
+        self.assertEqual(Key.objects.pooled().count(), 10)
+
+
+class ClaimManyTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms')
+        User = get_user_model()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        past = tznow() - datetime.timedelta(days=1)
+        Key.objects.create(key='aaaaaaaa', group=self.kg)
+        Key.objects.create(key='bbbbbbbb', group=self.kg)
+        Key.objects.create(key='cccccccc', group=self.kg, expires=past)
+        Key.objects.create(key='dddddddd', group=self.kg, claimed=past, claimed_by=self.bob)
+        self.claims = []
+        key_claimed.connect(self.on_claimed)
+        self.addCleanup(key_claimed.disconnect, self.on_claimed)
+
+    def on_claimed(self, sender, claimant, group, **kwargs):
+        self.claims.append((sender.key, claimant, group))
+
+    def statuses(self, results):
+        return [(result.keystring, result.status) for result in results]
+
+    def test_claim_many(self):
+        with self.assertNumQueries(4):  # Savepoint, update, select, release
+            results = Key.objects.claim_many([
+                ('aaaaaaaa', self.alice),
+                ('bbbbbbbb', self.bob),
+                ('cccccccc', self.alice),
+                ('dddddddd', self.alice),
+                ('eeeeeeee', self.alice),
+                ('aaaaaaaa', self.bob),
+                ('not valid', self.bob),
+            ], group=self.kg)
+        self.assertEqual(self.statuses(results), [
+            ('aaaaaaaa', CLAIMED),
+            ('bbbbbbbb', CLAIMED),
+            ('cccccccc', EXPIRED),
+            ('dddddddd', ALREADY_CLAIMED),
+            ('eeeeeeee', MISSING),
+            ('aaaaaaaa', ALREADY_CLAIMED),
+            ('not valid', MISSING),
+        ])
+        self.assertEqual(results[0].key.claimed_by, self.alice)
+        self.assertEqual(Key.objects.get(key='bbbbbbbb').claimed_by, self.bob)
+        self.assertIsNone(results[2].key)
+        self.assertEqual(self.claims, [('aaaaaaaa', self.alice, self.kg),
+                                       ('bbbbbbbb', self.bob, self.kg)])
+
+    def test_without_group(self):
+        hashed = KeyGroup.objects.create(name='hashed', hash_keys=True)
+        Key.objects.create(key='secret', group=hashed)
+        results = Key.objects.claim_many([('secret', self.alice), ('aaaaaaaa', self.bob)])
+        self.assertEqual(self.statuses(results), [('secret', CLAIMED), ('aaaaaaaa', CLAIMED)])
+        self.assertEqual(results[0].key.key, 'secret')
+        self.assertEqual(results[0].key.group, hashed)
+        self.assertEqual(Key.objects.filter_key('secret').get().claimed_by, self.alice)
+
+    def test_full_chunk_without_group(self):
+        hashed = KeyGroup.objects.create(name='hashed', generator='sms', hash_keys=True)
+        plain = self.kg.generate_keys(Key, 250)
+        hashed_keys = hashed.generate_keys(Key, 250)
+        keys = plain + hashed_keys
+        results = Key.objects.claim_many([(key.key, self.alice) for key in keys])
+        self.assertEqual(len(results), 500)
+        self.assertEqual(set(result.status for result in results), set([CLAIMED]))
+        self.assertEqual(Key.objects.filter(claimed_by=self.alice).count(), 500)
+
+    def test_chunks(self):
+        results = Key.objects.claim_many([('aaaaaaaa', self.alice), ('bbbbbbbb', self.bob)],
+                                         group=self.kg, chunk_size=1)
+        self.assertEqual([result.status for result in results], [CLAIMED, CLAIMED])
+
+    def test_signed(self):
+        kg = KeyGroup.objects.create(name='signed', generator='signed')
+        keystring = Key.generate(kg).key
+        results = Key.objects.claim_many([(keystring, self.alice), (keystring, self.bob)])
+        self.assertEqual([result.status for result in results], [CLAIMED, ALREADY_CLAIMED])
+        self.assertEqual(results[0].key.group, kg)
+        self.assertTrue(Key.objects.filter(group=kg, claimed_by=self.alice).exists())
+
+    def test_batched_signal(self):
+        batches = []
+
+        def on_keys_claimed(sender, keys, **kwargs):
+            batches.append((sender, [key.key for key in keys]))
+        keys_claimed.connect(on_keys_claimed)
+        self.addCleanup(keys_claimed.disconnect, on_keys_claimed)
+        Key.objects.claim_many([('aaaaaaaa', self.alice), ('bbbbbbbb', self.bob)],
+                               group=self.kg, batched_signal=True)
+        self.assertEqual(batches, [(Key, ['aaaaaaaa', 'bbbbbbbb'])])
+        self.assertEqual(self.claims, [])
+
+    @test.override_settings(VERIFICATION_CLAIM_OUTBOX=True)
+    def test_outbox(self):
+        Key.objects.claim_many([('aaaaaaaa', self.alice), ('bbbbbbbb', self.bob)],
+                               group=self.kg)
+        self.assertEqual(self.claims, [])
+        self.assertEqual(ClaimEvent.objects.count(), 2)
+
+
+@test.override_settings(VERIFICATION_GROUP_COUNTERS=True)
+class GroupCounterTest(test.TestCase):
+
+    def setUp(self):
+        self.kg = KeyGroup.objects.create(name='sms', generator='sms', ttl=10)
+        User = get_user_model()
+        self.user = User.objects.create(username='testuser')
+
+    def assertStats(self, **expected):
+        stats = self.kg.stats()
+        for name, count in expected.items():
+            self.assertEqual(stats[name], count, name)
+
+    def test_generate_and_claim(self):
+        key = Key.generate(self.kg)
+        self.kg.generate_keys(Key, 5, batch_size=2)
+        self.assertStats(issued=6, claimed=0, unclaimed=6)
+        claim(key.key, self.user)
+        self.assertStats(issued=6, claimed=1, unclaimed=5)
+        with self.assertRaises(VerificationError):
+            claim(key.key, self.user)
+        self.assertStats(claimed=1)
+
+    def test_purge(self):
+        keys = self.kg.generate_keys(Key, 4)
+        claim(keys[0].key, self.user)
+        Key.objects.filter(pk__in=[keys[0].pk, keys[1].pk]).update(expires=tznow())
+        self.assertEqual(Key.objects.delete_expired(batch_size=1), 2)
+        self.assertStats(issued=2, claimed=0, expired=2, purged=2)
+        self.assertEqual(self.kg.purge_keys(), 2)
+        self.assertStats(issued=0, claimed=0, expired=2, purged=4)
+
+    def test_archive(self):
+        key = Key.generate(self.kg)
+        claim(key.key, self.user)
+        Key.generate(self.kg)
+        self.kg.archive_after = 0
+        self.assertEqual(sum(self.kg.archivable_keys().archive()), 1)
+        self.assertStats(issued=1, claimed=0, purged=1)
+
+    def test_pool_and_claim_many(self):
+        self.kg.pool_size = 3
+        self.kg.refill_pool()
+        self.assertStats(issued=0)
+        key = Key.generate(self.kg)
+        other = Key.generate(self.kg)
+        self.assertStats(issued=2)
+        Key.objects.claim_many([(key.key, self.user), (other.key, self.user)], group=self.kg)
+        self.assertStats(issued=2, claimed=2)
+
+    def test_signed(self):
+        kg = KeyGroup.objects.create(name='signed', generator='signed')
+        key = Key.generate(kg)
+        self.assertEqual(kg.stats()['issued'], 0)
+        claim(key.key, self.user)
+        self.assertEqual(kg.stats(), {'issued': 1, 'claimed': 1, 'unclaimed': 0,
+                                      'expired': 0, 'purged': 0})
+
+    @unittest.skipIf(django.VERSION < (4, 1), 'Needs the async ORM of Django 4.1+')
+    async def test_aclaim(self):
+        key = await sync_to_async(Key.generate)(self.kg)
+        await aclaim(key.key, self.user)
+        stats = await sync_to_async(self.kg.stats)()
+        self.assertEqual((stats['issued'], stats['claimed']), (1, 1))
+
+    def test_shards(self):
+        with self.settings(VERIFICATION_GROUP_COUNTER_SHARDS=4):
+            for _ in range(20):
+                Key.generate(self.kg)
+        self.assertTrue(1 <= KeyGroupCounter.objects.count() <= 4)
+        self.assertStats(issued=20)
+
+    def test_reconcile(self):
+        key = Key.generate(self.kg)
+        claim(key.key, self.user)
+        Key.objects.create(key='unseen', group=self.kg, claimed=tznow())
+        Key.objects.filter(pk=key.pk).update(expires=tznow())
+        Key.objects.delete_expired()
+        Key.objects.bulk_create([Key(key='bulk', group=self.kg)])
+        self.assertStats(issued=1, claimed=1, purged=1)
+        out = StringIO()
+        call_command('reconcile_group_counters', stdout=out)
+        self.assertIn('sms: 2 issued, 1 claimed, 1 expired, 1 purged', out.getvalue())
+        self.assertEqual(KeyGroupCounter.objects.filter(group=self.kg).count(), 1)
+
+    def test_disabled(self):
+        with self.settings(VERIFICATION_GROUP_COUNTERS=False):
+            Key.generate(self.kg)
+        self.assertFalse(KeyGroupCounter.objects.exists())
+        self.assertStats(issued=0)
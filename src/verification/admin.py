@@ -1,8 +1,52 @@
 from __future__ import unicode_literals
 
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Sum
+from django.utils.functional import cached_property
 
-from .models import Key, KeyGroup
+from .models import ArchivedKey, ClaimEvent, Key, KeyGroup
+
+
+def estimated_count(queryset):
+    """The number of rows in the table of queryset as estimated by the
+    database, or None where there is no estimate"""
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+        params = [connection.ops.quote_name(table)]
+    elif connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s')
+        params = [table]
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    # PostgreSQL says -1 for tables never analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+class EstimatedCountPaginator(Paginator):
+    """Never counts more than max_count rows
+
+    Whole tables larger than that get the estimate of the database, other
+    results are counted up to max_count, so later pages of large filtered
+    results cannot be reached."""
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate > self.max_count:
+                return estimate
+        return queryset.order_by()[:self.max_count].count()
 
 class ClaimedListFilter(admin.SimpleListFilter):
     title = 'Claimed'
@@ -21,16 +65,74 @@ class ClaimedListFilter(admin.SimpleListFilter):
             return queryset.filter(claimed_by=None)
 
 class KeyAdmin(admin.ModelAdmin):
+    """Stays fast on tables with millions of keys
+
+    Searches find a key by its exact value, which also finds hashed keys,
+    or by prefix when ending with "*", like "abc*"."""
     model = Key
     list_display = ('key', 'group', 'pub_date', 'claimed_by', 'expires')
-    list_filter = ('group', ClaimedListFilter)
-    search_fields = ('key', 'claimed_by__username', 'claimed_by__email')
-    date_hierarchy = 'pub_date'
+    list_filter = ('group', ClaimedListFilter, 'pooled')
+    list_select_related = ('group', 'claimed_by')
+    raw_id_fields = ('claimed_by',)
+    search_fields = ('key',)
+    search_help_text = 'An exact key, or the start of one followed by *'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if search_term.endswith('*'):
+            return queryset.filter(key__startswith=search_term[:-1]), False
+        return queryset.filter_key(search_term), False
 
 class KeyGroupAdmin(admin.ModelAdmin):
     model = KeyGroup
-    list_display = ('name', 'ttl', 'generator', 'has_fact')
+    list_display = ('name', 'ttl', 'generator', 'has_fact', 'archive_after', 'pool_size',
+                    'issued', 'claimed')
     list_filter = ('generator', 'has_fact',)
+    readonly_fields = ('key_stats',)
+
+    def get_queryset(self, request):
+        groups = super(KeyGroupAdmin, self).get_queryset(request)
+        return groups.annotate(issued=Sum('key_counters__issued'),
+                               claimed=Sum('key_counters__claimed'))
+
+    @admin.display(ordering='issued')
+    def issued(self, group):
+        return group.issued
+
+    @admin.display(ordering='claimed')
+    def claimed(self, group):
+        return group.claimed
+
+    @admin.display(description='Keys')
+    def key_stats(self, group):
+        if group.pk is None:
+            return '-'
+        return ', '.join('%s: %i' % item for item in sorted(group.stats().items()))
+
+class ArchivedKeyAdmin(admin.ModelAdmin):
+    model = ArchivedKey
+    list_display = ('key', 'group', 'pub_date', 'claimed', 'claimant_pk', 'expires')
+    list_filter = ('group',)
+    search_fields = ('=key', '=claimant_pk')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+class ClaimEventAdmin(admin.ModelAdmin):
+    model = ClaimEvent
+    list_display = ('key_model', 'key_pk', 'created', 'attempts', 'next_attempt')
+    list_filter = ('key_model',)
 
 admin.site.register(Key, KeyAdmin)
 admin.site.register(KeyGroup, KeyGroupAdmin)
+admin.site.register(ClaimEvent, ClaimEventAdmin)
+admin.site.register(ArchivedKey, ArchivedKeyAdmin)
@@ -1,6 +1,12 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.conf import settings
 
 class VerificationConfig(AppConfig):
     name = 'verification'
+
+    def ready(self):
+        if getattr(settings, 'VERIFICATION_INSTRUMENTATION', False):
+            from verification.instrumentation import collector, instrumentation
+            instrumentation.subscribe(collector.record)
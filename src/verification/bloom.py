@@ -0,0 +1,227 @@
+from __future__ import unicode_literals
+
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from verification.counters import counters
+
+__all__ = ['BloomFilter', 'KeyFilterCache', 'key_filter']
+
+
+class BloomFilter(object):
+    """Set membership with false positives but no false negatives
+
+    Items are str or bytes."""
+
+    def __init__(self, size, hashes):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        "A filter with <error_rate> false positives when holding <capacity> items"
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / float(capacity) * math.log(2))))
+        return cls(size, hashes)
+
+    def _indexes(self, item):
+        if isinstance(item, str):
+            item = item.encode('utf-8')
+        digest = hashlib.blake2b(bytes(item), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for i in self._indexes(item):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(item))
+
+
+class KeyFilterCache(object):
+    """Per-group Bloom filters of existing keys, to answer "no such key"
+    without a query
+
+    Settings:
+
+    VERIFICATION_KEY_FILTER_CACHE - Name of a Django cache shared by all
+        processes, with an atomic incr(). Key filters are off unless set.
+    VERIFICATION_KEY_FILTER_ERROR_RATE - Share of missing keys let through
+        to the database, default 0.01.
+    VERIFICATION_KEY_FILTER_TIMEOUT - Seconds new keys are kept in the
+        cache for other processes to pick up, default one day.
+
+    A group has a filter once built with the command build_key_filters,
+    which should be rerun regularly. Keys made later with AbstractKey.save()
+    or KeyGroup.generate_keys() are numbered with incr() and stored in the
+    cache, where each process adds them to its copy of the filter. If they
+    cannot be found the filter answers "maybe". Keys inserted any other way,
+    with bulk_create(), loaddata or SQL, are not added and are rejected
+    until the filter is rebuilt, so rebuild it after such inserts."""
+    prefix = 'verification:keyfilter'
+    # Seconds before a filter, or the lack of one, is loaded again
+    reload = 300
+    # Keys made since the filter was loaded that are fetched, not reloaded
+    max_catch_up = 1000
+
+    def __init__(self):
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def _cache(self):
+        alias = getattr(settings, 'VERIFICATION_KEY_FILTER_CACHE', None)
+        return caches[alias] if alias else None
+
+    def enabled(self):
+        return self._cache() is not None
+
+    def _key(self, name, *parts):
+        return ':'.join((self.prefix, name) + tuple(str(part) for part in parts))
+
+    def _new_keys(self, name, seq, current):
+        return [self._key(name, 'new', n) for n in range(seq + 1, current + 1)]
+
+    @staticmethod
+    def item(group, keystring):
+        "What is stored in the filter for keystring: the key or its digest"
+        from verification.models import key_digest
+
+        return key_digest(keystring) if group.hash_keys else keystring
+
+    def reset(self):
+        "Forget the filters of this process"
+        with self._lock:
+            self._filters.clear()
+
+    def build(self, group, items, capacity):
+        """Replace the filter of group with one holding the items
+
+        The items are read after the numbering of new keys is noted, so
+        a queryset is only run afterwards and misses no new key."""
+        cache = self._cache()
+        name = str(group)
+        seq_key = self._key(name, 'seq')
+        cache.add(seq_key, 0, None)
+        seq = cache.get(seq_key)
+        error_rate = getattr(settings, 'VERIFICATION_KEY_FILTER_ERROR_RATE', 0.01)
+        bloom = BloomFilter.for_capacity(capacity, error_rate)
+        for item in items:
+            bloom.add(item)
+        cache.set(self._key(name, 'filter'), (seq, bloom), None)
+        with self._lock:
+            self._filters[name] = (seq, bloom, time.monotonic())
+        return bloom
+
+    def clear(self, group):
+        "Remove the filter of group"
+        name = str(group)
+        self._cache().delete_many([self._key(name, 'seq'), self._key(name, 'filter')])
+        with self._lock:
+            self._filters.pop(name, None)
+
+    def add(self, group, keystrings):
+        "Add new keys to the filter of group, if it has one"
+        cache = self._cache()
+        if cache is None or not keystrings:
+            return
+        name = str(group)
+        try:
+            end = cache.incr(self._key(name, 'seq'), len(keystrings))
+        except ValueError:  # No filter
+            return
+        timeout = getattr(settings, 'VERIFICATION_KEY_FILTER_TIMEOUT', 86400)
+        new_keys = self._new_keys(name, end - len(keystrings), end)
+        items = [self.item(group, keystring) for keystring in keystrings]
+        cache.set_many(dict(zip(new_keys, items)), timeout)
+
+    def _local(self, name):
+        "The filter of this process, or None if it must be (re)loaded"
+        entry = self._filters.get(name)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[2] > self.reload:
+            return None
+        return entry
+
+    def _loaded(self, name, stored):
+        with self._lock:
+            seq, bloom = stored if stored else (0, None)
+            entry = self._filters[name] = (seq, bloom, time.monotonic())
+        return entry
+
+    def _catch_up(self, name, entry, current, new):
+        """Add the fetched new keys to the filter, in order. Returns the
+        number of the last one added"""
+        seq, bloom, loaded = entry
+        with self._lock:
+            while seq < current:
+                item = new.get(self._key(name, 'new', seq + 1))
+                if item is None:
+                    break
+                bloom.add(item)
+                seq += 1
+            self._filters[name] = (seq, bloom, loaded)
+        return seq
+
+    def _answer(self, group, found):
+        if not found:
+            counters.incr(group, 'filtered')
+        return found
+
+    def might_exist(self, group, keystring):
+        "False if keystring is certainly not a key of group"
+        cache = self._cache()
+        if cache is None or group.signed_keys:
+            return True
+        name = str(group)
+        item = self.item(group, keystring)
+        entry = self._local(name) or self._loaded(name, cache.get(self._key(name, 'filter')))
+        if entry[1] is None or item in entry[1]:
+            return True
+        current = cache.get(self._key(name, 'seq'))
+        if current is None:
+            return True
+        if current - entry[0] > self.max_catch_up:
+            entry = self._loaded(name, cache.get(self._key(name, 'filter')))
+            if entry[1] is None or current - entry[0] > self.max_catch_up:
+                return True
+        if current > entry[0]:
+            new = cache.get_many(self._new_keys(name, entry[0], current))
+            if self._catch_up(name, entry, current, new) < current:
+                return True
+        return self._answer(group, item in entry[1])
+
+    async def amight_exist(self, group, keystring):
+        "Async might_exist()"
+        cache = self._cache()
+        if cache is None or group.signed_keys:
+            return True
+        name = str(group)
+        item = self.item(group, keystring)
+        entry = self._local(name) or self._loaded(name, await cache.aget(self._key(name, 'filter')))
+        if entry[1] is None or item in entry[1]:
+            return True
+        current = await cache.aget(self._key(name, 'seq'))
+        if current is None:
+            return True
+        if current - entry[0] > self.max_catch_up:
+            entry = self._loaded(name, await cache.aget(self._key(name, 'filter')))
+            if entry[1] is None or current - entry[0] > self.max_catch_up:
+                return True
+        if current > entry[0]:
+            new = await cache.aget_many(self._new_keys(name, entry[0], current))
+            if self._catch_up(name, entry, current, new) < current:
+                return True
+        return self._answer(group, item in entry[1])
+
+key_filter = KeyFilterCache()
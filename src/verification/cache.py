@@ -0,0 +1,89 @@
+from __future__ import unicode_literals
+
+import copy
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+__all__ = ['KeyGroupCache', 'group_cache']
+
+
+class KeyGroupCache(object):
+    """Per-process cache of KeyGroups
+
+    Settings:
+
+    VERIFICATION_GROUP_CACHE_TIMEOUT - Seconds a cached group is trusted,
+        default 60. 0 turns the cache off.
+    VERIFICATION_GROUP_CACHE - Name of a Django cache shared by all
+        processes. If set, a version stamp kept there is compared on every
+        lookup, so changes are seen at once by every process instead of
+        after at most the timeout.
+
+    Saving or deleting a KeyGroup invalidates the cache once committed."""
+    version_key = 'verification:keygroup:version'
+
+    def __init__(self):
+        self._groups = {}
+
+    def _shared_cache(self):
+        alias = getattr(settings, 'VERIFICATION_GROUP_CACHE', None)
+        return caches[alias] if alias else None
+
+    def _lookup(self, name, version, now):
+        "Return the cached group <name> if still fresh, else None"
+        timeout = getattr(settings, 'VERIFICATION_GROUP_CACHE_TIMEOUT', 60)
+        entry = self._groups.get(name)
+        if entry is not None:
+            group, entry_version, fetched = entry
+            if entry_version == version and now - fetched < timeout:
+                return group
+        return None
+
+    def _store(self, name, group, version, now):
+        if getattr(settings, 'VERIFICATION_GROUP_CACHE_TIMEOUT', 60):
+            self._groups[name] = (group, version, now)
+
+    def get(self, name):
+        "Get the KeyGroup <name>, raises KeyGroup.DoesNotExist"
+        from verification.models import KeyGroup
+
+        shared = self._shared_cache()
+        version = shared.get(self.version_key) if shared is not None else None
+        now = time.monotonic()
+        group = self._lookup(name, version, now)
+        if group is None:
+            group = KeyGroup._default_manager.get(name=name)
+            self._store(name, group, version, now)
+        return copy.copy(group)
+
+    async def aget(self, name):
+        "Async get(), only awaits the database on a cache miss"
+        from verification.models import KeyGroup
+
+        shared = self._shared_cache()
+        version = await shared.aget(self.version_key) if shared is not None else None
+        now = time.monotonic()
+        group = self._lookup(name, version, now)
+        if group is None:
+            group = await KeyGroup._default_manager.aget(name=name)
+            self._store(name, group, version, now)
+        return copy.copy(group)
+
+    def forget(self, name=None):
+        "Forget the KeyGroup <name>, or all of them, in this process"
+        if name is None:
+            self._groups.clear()
+        else:
+            self._groups.pop(name, None)
+
+    def invalidate(self, name=None):
+        "Forget the KeyGroup <name>, or all of them, in every process"
+        self.forget(name)
+        shared = self._shared_cache()
+        if shared is not None:
+            shared.set(self.version_key, uuid.uuid4().hex, None)
+
+group_cache = KeyGroupCache()
@@ -0,0 +1,50 @@
+from __future__ import unicode_literals
+
+import threading
+from collections import defaultdict
+
+__all__ = ['Counters', 'counters']
+
+
+class Counters(object):
+    """Thread-safe in-process counters per KeyGroup
+
+    Counters are kept per process and are lost on restart, they are meant
+    to be scraped or logged regularly."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+
+    def incr(self, group, name, amount=1):
+        with self._lock:
+            self._counts[(str(group), name)] += amount
+
+    def get(self, group, name):
+        return self._counts.get((str(group), name), 0)
+
+    def snapshot(self):
+        "Return all counters as {group: {name: count}}"
+        with self._lock:
+            items = list(self._counts.items())
+        snapshot = defaultdict(dict)
+        for (group, name), count in items:
+            snapshot[group][name] = count
+        return dict(snapshot)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def estimated_fill(self, group):
+        """Estimate how full the keyspace of group is, from 0.0 to 1.0
+
+        With uniformly random keys the chance of a collision is the
+        fraction of the keyspace already in use, so the share of attempts
+        that collided estimates that fraction."""
+        attempts = self.get(group, 'attempts')
+        if not attempts:
+            return 0.0
+        return self.get(group, 'collisions') / float(attempts)
+
+counters = Counters()
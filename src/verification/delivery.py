@@ -0,0 +1,315 @@
+from __future__ import unicode_literals
+
+import itertools
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core import mail
+from django.utils.module_loading import import_string
+
+__all__ = [
+    'SENT',
+    'FAILED',
+    'QUEUED',
+    'Delivery',
+    'BaseDeliveryBackend',
+    'FuncBackend',
+    'EmailBackend',
+    'LocmemBackend',
+    'FileBackend',
+    'QueuedBackend',
+    'get_backend',
+    'send_many',
+]
+
+_LOG = logging.getLogger(__name__)
+
+SENT = 'sent'
+FAILED = 'failed'
+QUEUED = 'queued'
+
+# Keys sent with the LocmemBackend
+outbox = []
+
+
+class Delivery(object):
+    """A key to send to recipient, and how that went
+
+    status is None until sent, then SENT, FAILED or QUEUED. error holds the
+    exception of a failed delivery."""
+
+    def __init__(self, key, recipient, content=''):
+        self.key = key
+        self.recipient = recipient
+        self.content = content
+        self.status = None
+        self.error = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return '<Delivery %s to %s: %s>' % (self.key, self.recipient, self.status)
+
+    def _finish(self, error=None):
+        self.status = FAILED if error else SENT
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        "Wait until a queued delivery is sent or failed, returns the status"
+        self._done.wait(timeout)
+        return self.status
+
+
+class BaseDeliveryBackend(object):
+    """Sends keys. Subclasses implement deliver()
+
+    A backend is opened once and can then send many keys over the same
+    connection. It is not thread-safe, use one backend per thread."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def deliver(self, delivery):
+        "Send one delivery, raise an exception on failure"
+        raise NotImplementedError
+
+    def send_deliveries(self, deliveries):
+        """Send deliveries, setting the status of each. Returns how many
+        were sent. Failures are logged, not raised."""
+        sent = 0
+        for delivery in deliveries:
+            try:
+                self.deliver(delivery)
+            except Exception as e:
+                _LOG.warning('Could not send key %s to %s: %r',
+                             delivery.key, delivery.recipient, e)
+                delivery._finish(e)
+                continue
+            delivery._finish()
+            sent += 1
+        return sent
+
+
+class FuncBackend(BaseDeliveryBackend):
+    """Calls func(recipient, content), like AbstractKey.send_func
+
+    func may be a callable or a dotted path to one."""
+
+    def __init__(self, func=None, **kwargs):
+        super(FuncBackend, self).__init__(**kwargs)
+        self.func = import_string(func) if isinstance(func, str) else func
+
+    def deliver(self, delivery):
+        self.func(delivery.recipient, delivery.content)
+
+
+class EmailBackend(BaseDeliveryBackend):
+    "Emails keys, over one connection of Django's email backend"
+
+    def __init__(self, subject='', from_email=None, connection=None, **kwargs):
+        super(EmailBackend, self).__init__(**kwargs)
+        self.subject = subject
+        self.from_email = from_email
+        self.connection = connection
+        self._own_connection = connection is None
+
+    def open(self):
+        if self.connection is None:
+            self.connection = mail.get_connection()
+        self.connection.open()
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.connection.close()
+        if self._own_connection:
+            self.connection = None
+
+    def deliver(self, delivery):
+        recipient = ''.join(delivery.recipient.strip().split())
+        message = mail.EmailMessage(self.subject, delivery.content,
+                                    self.from_email, [recipient],
+                                    connection=self.connection)
+        message.send()
+
+
+class LocmemBackend(BaseDeliveryBackend):
+    "Keeps sent deliveries in verification.delivery.outbox, for tests"
+    _lock = threading.Lock()
+
+    def deliver(self, delivery):
+        with self._lock:
+            outbox.append(delivery)
+
+
+class FileBackend(BaseDeliveryBackend):
+    "Appends sent keys to file_path as lines of JSON, for tests"
+
+    def __init__(self, file_path=None, **kwargs):
+        super(FileBackend, self).__init__(**kwargs)
+        self.file_path = file_path
+        self.stream = None
+
+    def open(self):
+        if self.stream is None:
+            self.stream = open(self.file_path, 'a')
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def deliver(self, delivery):
+        line = json.dumps({
+            'key': str(delivery.key),
+            'group': str(delivery.key.group_id),
+            'recipient': delivery.recipient,
+            'content': delivery.content,
+        })
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+class QueuedBackend(BaseDeliveryBackend):
+    """Sends keys in the background with another backend
+
+    deliver() returns at once with the status QUEUED. The keys are sent by
+    a pool of <workers> threads shared by all QueuedBackends with the same
+    settings. A worker takes what is queued, up to batch_size deliveries,
+    and sends it over one opened <backend>. Other keyword arguments are
+    passed on to that backend."""
+    _pools = {}
+    _lock = threading.Lock()
+    # Deliveries sent over one connection at most
+    batch_size = 100
+
+    def __init__(self, backend='verification.delivery.EmailBackend', workers=2, **kwargs):
+        super(QueuedBackend, self).__init__()
+        self.backend = backend
+        self.workers = workers
+        self.options = kwargs
+
+    def _pool(self):
+        "Get the thread pool and queue of these settings"
+        name = (self.backend, self.workers)
+        with self._lock:
+            if name not in self._pools:
+                self._pools[name] = (ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='verification-delivery'), queue.Queue())
+            return self._pools[name]
+
+    def deliver(self, delivery):
+        pool, pending = self._pool()
+        pending.put((self.options, delivery))
+        pool.submit(self._drain, pending)
+
+    def _drain(self, pending):
+        "Send the queued deliveries, one backend per set of options"
+        batches = []
+        for _ in range(self.batch_size):
+            try:
+                options, delivery = pending.get_nowait()
+            except queue.Empty:
+                break
+            for batch_options, batch in batches:
+                if batch_options == options:
+                    batch.append(delivery)
+                    break
+            else:
+                batches.append((options, [delivery]))
+        for options, batch in batches:
+            self._send(options, batch)
+
+    def _send(self, options, deliveries):
+        try:
+            with get_backend(self.backend, **options) as backend:
+                backend.send_deliveries(deliveries)
+        except Exception as e:
+            _LOG.exception('Could not send %i keys', len(deliveries))
+            for delivery in deliveries:
+                if not delivery._done.is_set():
+                    delivery._finish(e)
+
+    def send_deliveries(self, deliveries):
+        "Queue deliveries, returns how many were queued"
+        queued = 0
+        for delivery in deliveries:
+            delivery.status = QUEUED
+            self.deliver(delivery)
+            queued += 1
+        return queued
+
+
+def get_backend(backend=None, **kwargs):
+    """Get a delivery backend instance
+
+    Defaults to VERIFICATION_DELIVERY_BACKEND, with the keyword arguments
+    in VERIFICATION_DELIVERY_OPTIONS."""
+    if backend is None:
+        backend = getattr(settings, 'VERIFICATION_DELIVERY_BACKEND', None)
+        if backend is None:
+            raise ImproperlyConfigured('No delivery backend, set VERIFICATION_DELIVERY_BACKEND')
+        options = dict(getattr(settings, 'VERIFICATION_DELIVERY_OPTIONS', {}))
+        options.update(kwargs)
+        kwargs = options
+    return import_string(backend)(**kwargs)
+
+
+def send_many(deliveries, backend=None, batch_size=100, workers=1, **kwargs):
+    """Send an iterable of Deliveries, for instance made from a queryset
+    of keys, in batches
+
+    Each batch of <batch_size> is sent over one connection, <workers>
+    batches at a time in a thread pool. Each thread opens its own backend,
+    once. Only a few batches are read ahead of the sending, so deliveries
+    can be a generator over millions of keys. This is a generator yielding
+    each batch when sent, with the status of every delivery set."""
+    deliveries = iter(deliveries)
+    local = threading.local()
+    backends = []
+    lock = threading.Lock()
+
+    def send(batch):
+        if not hasattr(local, 'backend'):
+            local.backend = get_backend(backend, **kwargs)
+            local.backend.open()
+            with lock:
+                backends.append(local.backend)
+        local.backend.send_deliveries(batch)
+        return batch
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            pending = set()
+            while True:
+                while len(pending) < workers * 2:
+                    batch = list(itertools.islice(deliveries, batch_size))
+                    if not batch:
+                        break
+                    pending.add(pool.submit(send, batch))
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+    finally:
+        for opened in backends:
+            opened.close()
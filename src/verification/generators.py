@@ -3,10 +3,15 @@ from __future__ import unicode_literals
 
 import datetime
 import hashlib
+import os
 import random
 import re
+import secrets
 import string
 import sys
+import threading
+
+from django.core import signing
 
 
 PY3 = sys.version_info > (3,)
@@ -21,25 +26,64 @@ __all__ = ['Registry', 'GeneratorError']
 class GeneratorError(Exception):
     pass
 
+_system_random = random.SystemRandom()
+
+def _byte_tables(alphabet):
+    """Make tables for mapping random bytes onto <alphabet> with
+    bytes.translate()
+
+    Returns the translation table and the bytes to delete: the bytes above
+    the largest multiple of the alphabet size are rejected, or some
+    characters would be more likely than others. Returns (None, None) for
+    alphabets that are not plain ASCII or are longer than 256 characters."""
+    base = len(alphabet)
+    try:
+        codes = bytearray(alphabet.encode('ascii'))
+    except UnicodeEncodeError:
+        return None, None
+    if not 0 < base <= 256:
+        return None, None
+    limit = 256 - 256 % base
+    table = bytes(bytearray(codes[i % base] for i in range(256)))
+    reject = bytes(bytearray(range(limit, 256)))
+    return table, reject
+
 class AbstractKeyGenerator(object):
     """Do not use directly."""
     length = 0
     name = 'abstract'
+    signed = False
 
     def __init__(self, length=0, seed=None, randomizer=None, name='', **kwargs):
-        self.random = randomizer if randomizer else random
         self.length = length if length else self.length
         self.name = name if name else self.name
         self.seed = seed
-        if self.seed:
-            self.random.seed(self.seed)
+        # Unless seeded or given a randomizer, use the OS' CSPRNG
+        self.secure = not (randomizer or seed)
+        if randomizer:
+            self.random = randomizer
+            if self.seed:
+                self.random.seed(self.seed)
+        elif self.seed:
+            # Own state, never reseed the random module shared by all threads
+            self.random = random.Random(self.seed)
+        else:
+            self.random = random
 
     def generate_one_key(self, *args):
         raise NotImplementedError
 
+    def generate_many(self, n, *args):
+        "Generate <n> keys"
+        return [self.generate_one_key(*args) for _ in range(n)]
+
     def valid_key(self, key):
         raise NotImplementedError
 
+    def keyspace(self):
+        "Number of possible keys, or None if unknown"
+        return None
+
     def sms_safe(self):
         return True if self.length <= 10 else False
 
@@ -63,18 +107,43 @@ class AbstractAlphabetKeyGenerator(AbstractKeyGenerator):
         super(AbstractAlphabetKeyGenerator, self).__init__(**kwargs)
         self.alphabet = alphabet if alphabet else self.alphabet
         self.base = len(self.alphabet)
-        self.valid_re = re.compile('^[%s]{%i}$' % (self.alphabet, self.length))
+        self.valid_re = re.compile(r'^[%s]{%i}\Z' % (self.alphabet, self.length))
+        self._table, self._reject = _byte_tables(self.alphabet)
 
     def generate_one_key(self, *args):
         """Alphabet generators do not use salts or extra in-data"""
+        if self.secure and self._table is not None:
+            return self.generate_many(1)[0]
+        randomizer = _system_random if self.secure else self.random
         key = []
         for i in range(self.length):
-            key.append(self.alphabet[self.random.randint(0, self.base-1)])
+            key.append(self.alphabet[randomizer.randint(0, self.base-1)])
         return ''.join(key)
 
+    def generate_many(self, n, *args):
+        """Generate <n> keys
+
+        Unseeded generators draw all the randomness needed from
+        os.urandom() at once and map the bytes onto the alphabet with a
+        lookup table, dropping bytes that would bias the result."""
+        if not (self.secure and self._table is not None):
+            return super(AbstractAlphabetKeyGenerator, self).generate_many(n)
+        needed = n * self.length
+        accepted = 256 - len(self._reject)
+        chars = b''
+        while len(chars) < needed:
+            missing = needed - len(chars)
+            buf = os.urandom(missing * 256 // accepted + 8)
+            chars += buf.translate(self._table, self._reject)
+        chars = chars[:needed].decode('ascii')
+        return [chars[i:i+self.length] for i in range(0, needed, self.length)]
+
     def valid_key(self, key):
         return self.valid_re.search(key)
 
+    def keyspace(self):
+        return self.base ** self.length
+
 class SMSKeyGenerator(AbstractAlphabetKeyGenerator):
     name = 'sms'
     alphabet = SAFE_ALPHABET
@@ -118,18 +187,25 @@ class HashedHexKeyGenerator(AbstractAlphabetKeyGenerator):
         self.length = len(self.hasher().hexdigest())
         if self.alphabet != self.hex_alphabet:
             self.alphabet = self.alphabet[:16]
+        # The keys are hexdigests whatever the alphabet
+        self.valid_re = re.compile(r'^[%s]{%i}\Z' % (self.hex_alphabet, self.length))
+
+    def generate_many(self, n, *args):
+        "Hashed keys are made one at a time, from the randomizer and <args>"
+        return AbstractKeyGenerator.generate_many(self, n, *args)
 
     def generate_one_key(self, *args):
+        randomizer = _system_random if self.secure else self.random
         if not args:
-            args = [self.random.random()]
+            args = [randomizer.random()]
         args = [str(arg) for arg in args]
         if PY3:
-            saltbase = str(self.random.random()).encode('ascii')
+            saltbase = str(randomizer.random()).encode('ascii')
             salt = self.hasher(saltbase).hexdigest()[:5]
             hashbase = salt + u''.join(args)
             return self.hasher(hashbase.encode('ascii')).hexdigest()
         else:
-            salt = self.hasher(str(self.random.random())).hexdigest()[:5]
+            salt = self.hasher(str(randomizer.random())).hexdigest()[:5]
             return self.hasher(salt+''.join(args)).hexdigest()
 
 class MD5HexKeyGenerator(HashedHexKeyGenerator):
@@ -156,15 +232,41 @@ class SHA512HexKeyGenerator(HashedHexKeyGenerator):
     name = 'sha512-hex'
     hasher = hashlib.sha512
 
+class SignedKeyGenerator(AbstractKeyGenerator):
+    """The keys carry their own data and are signed with SECRET_KEY, so
+    they can be checked without being looked up. See KeyGroup."""
+    name = 'signed'
+    signed = True
+    salt = 'verification.signed'
+    # \Z, as $ also matches before a trailing newline
+    valid_re = re.compile(r'^[A-Za-z0-9_\-:.]{1,255}\Z')
+
+    def generate_one_key(self, *args):
+        "Sign <args>, with a nonce added so that no two keys are the same"
+        payload = list(args) + [secrets.token_urlsafe(6)]
+        return signing.Signer(salt=self.salt).sign_object(payload, compress=True)
+
+    def load_key(self, key):
+        "Return the args <key> was made from. Raises signing.BadSignature"
+        return signing.Signer(salt=self.salt).unsign_object(key)[:-1]
+
+    def valid_key(self, key):
+        return self.valid_re.search(key)
+
 class Registry(object):
     _generators = {}
+    _instances = {}
+    _lock = threading.Lock()
 
     def register(self, name, generator):
-        self._generators[name] = generator
+        with self._lock:
+            self._generators[name] = generator
+            self._instances.pop(name, None)
 
     def unregister(self, name):
-        if name in self.available():
-            del self._generators[name]
+        with self._lock:
+            self._generators.pop(name, None)
+            self._instances.pop(name, None)
 
     def available(self):
         return self._generators.keys()
@@ -175,6 +277,24 @@ class Registry(object):
             raise GeneratorError('Invalid generator')
         return generator
 
+    def instance(self, name):
+        """Return a shared, unseeded instance of the generator <name>
+
+        Unseeded generators keep no random state of their own so an
+        instance can be used by any number of threads."""
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        generator = self.get(name)
+        instance = generator
+        if not isinstance(generator, AbstractKeyGenerator):
+            instance = generator()
+        with self._lock:
+            if self._generators.get(name) is not generator:
+                return instance
+            return self._instances.setdefault(name, instance)
+
     def reset(self):
         reset()
 
@@ -191,6 +311,7 @@ DEFAULT_GENERATORS = (
     SHA256HexKeyGenerator,
     SHA384HexKeyGenerator,
     SHA512HexKeyGenerator,
+    SignedKeyGenerator,
 )
 
 DEFAULT_GENERATOR_NAMES = []
@@ -0,0 +1,226 @@
+from __future__ import unicode_literals
+
+import logging
+import math
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+__all__ = [
+    'Instrumentation',
+    'instrumentation',
+    'Histogram',
+    'HistogramCollector',
+    'collector',
+    'BaseExporter',
+    'TextExporter',
+    'PrometheusExporter',
+    'get_exporter',
+]
+
+_LOG = logging.getLogger(__name__)
+
+
+class _NoopTimer(object):
+    "What Instrumentation.timer() returns when nobody listens"
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+_NOOP = _NoopTimer()
+
+
+class _Timer(object):
+    __slots__ = ('_instrumentation', 'operation', 'group', 'outcome', '_start')
+
+    def __init__(self, instrumentation, operation, group):
+        self._instrumentation = instrumentation
+        self.operation = operation
+        self.group = group
+        self.outcome = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        outcome = self.outcome
+        if outcome is None:
+            outcome = 'ok' if exc_type is None else exc_type.__name__
+        self._instrumentation.record(self.operation, self.group, outcome, seconds)
+        return False
+
+
+class Instrumentation(object):
+    """Times the hot paths and passes the timings on to callbacks
+
+    The operations are "claim", "claim_many", "generate", "send", "lookup"
+    and "signal", the sending of key_claimed within a claim. Callbacks are
+    called as callback(operation, group, outcome, seconds), where outcome
+    is "ok", a status, or the name of the exception raised. With no
+    callbacks, timer() costs a method call and an empty with-block."""
+
+    def __init__(self):
+        self._callbacks = ()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self._callbacks)
+
+    def subscribe(self, callback):
+        with self._lock:
+            if callback not in self._callbacks:
+                self._callbacks = self._callbacks + (callback,)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._callbacks = tuple(c for c in self._callbacks if c != callback)
+
+    def timer(self, operation, group=None):
+        """Context manager timing operation. Set group and outcome on it
+        when only known at the end"""
+        if not self._callbacks:
+            return _NOOP
+        return _Timer(self, operation, group)
+
+    def record(self, operation, group, outcome, seconds):
+        group = str(group) if group is not None else ''
+        for callback in self._callbacks:
+            try:
+                callback(operation, group, outcome, seconds)
+            except Exception:
+                _LOG.exception('Instrumentation callback %r failed', callback)
+
+instrumentation = Instrumentation()
+
+
+class Histogram(object):
+    """Latencies in buckets growing by a factor 2**(1/4), about 19%
+
+    Memory does not grow with the number of samples, and percentiles are
+    upper bounds of buckets, off by at most a bucket."""
+    resolution = 4
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        index = math.ceil(math.log2(seconds) * self.resolution) if seconds > 0 else None
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        "Latency in seconds that <fraction> of the samples did not exceed"
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        none_last = lambda index: float('-inf') if index is None else index
+        for index in sorted(self.buckets, key=none_last):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return 0.0 if index is None else 2 ** (index / float(self.resolution))
+        return None
+
+
+class HistogramCollector(object):
+    """A Histogram per operation, group and outcome, in this process
+
+    Subscribe its record() to instrumentation, which is done when the
+    setting VERIFICATION_INSTRUMENTATION is True."""
+    percentiles = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, operation, group, outcome, seconds):
+        name = (operation, group, outcome)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Return [(operation, group, outcome, count, sum, {percentile:
+        seconds})], sorted"""
+        with self._lock:
+            items = sorted(self._histograms.items())
+            return [(operation, group, outcome, histogram.count, histogram.sum,
+                     dict((p, histogram.percentile(p)) for p in self.percentiles))
+                    for (operation, group, outcome), histogram in items]
+
+collector = HistogramCollector()
+
+
+class BaseExporter(object):
+    "Formats the histograms of a collector. Subclasses implement export()"
+    content_type = 'text/plain; charset=utf-8'
+
+    def export(self, collector):
+        raise NotImplementedError
+
+
+class TextExporter(BaseExporter):
+    "One line per operation, group and outcome, for people"
+
+    def export(self, collector):
+        lines = []
+        for operation, group, outcome, count, total, percentiles in collector.snapshot():
+            quantiles = ' '.join('p%i=%.3fms' % (round(p * 100), 1000 * value)
+                                 for p, value in sorted(percentiles.items()))
+            lines.append('%s %s %s count=%i %s' % (operation, group or '-', outcome,
+                                                   count, quantiles))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter(BaseExporter):
+    "A summary in the Prometheus text format"
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    name = 'verification_operation_seconds'
+
+    def _escape(self, value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def export(self, collector):
+        lines = [
+            '# HELP %s Time spent in verification operations' % self.name,
+            '# TYPE %s summary' % self.name,
+        ]
+        for operation, group, outcome, count, total, percentiles in collector.snapshot():
+            labels = 'operation="%s",group="%s",outcome="%s"' % (
+                self._escape(operation), self._escape(group), self._escape(outcome))
+            for p, value in sorted(percentiles.items()):
+                lines.append('%s{%s,quantile="%s"} %.9g' % (self.name, labels, p, value))
+            lines.append('%s_sum{%s} %.9g' % (self.name, labels, total))
+            lines.append('%s_count{%s} %i' % (self.name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+def get_exporter(exporter=None):
+    """Get an exporter instance, by dotted path. Defaults to
+    VERIFICATION_INSTRUMENTATION_EXPORTER or the PrometheusExporter"""
+    from django.conf import settings
+
+    if exporter is None:
+        exporter = getattr(settings, 'VERIFICATION_INSTRUMENTATION_EXPORTER',
+                           'verification.instrumentation.PrometheusExporter')
+    return import_string(exporter)()
@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+
+import gzip
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from verification.models import KeyGroup
+
+
+class Command(BaseCommand):
+    help = ('Move claimed and expired keys older than their group\'s archive_after '
+            'to the archive table, or a file, in small batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', action='append', dest='groups', default=[],
+                            help='Only archive keys of this group. Can be repeated.')
+        parser.add_argument('--model', default='verification.Key',
+                            help='The key model, as app_label.ModelName. Default: %(default)s')
+        parser.add_argument('--file',
+                            help='Append the keys as JSON lines to this file instead, '
+                                 'gzipped if it ends with .gz')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Keys moved per batch. Default: %(default)s')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to sleep between batches. Default: %(default)s')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the keys that would be archived.')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        groups = KeyGroup.objects.exclude(archive_after=None)
+        if options['groups']:
+            groups = groups.filter(name__in=options['groups'])
+        stream = None
+        if options['file'] and not options['dry_run']:
+            opener = gzip.open if options['file'].endswith('.gz') else open
+            stream = opener(options['file'], 'at')
+        try:
+            self.archive(model, groups, stream, options)
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def archive(self, model, groups, stream, options):
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        for group in groups:
+            total = 0
+            start = time.time()
+            keys = group.archivable_keys(model)
+            chunks = keys.archive(options['batch_size'], options['sleep'],
+                                  options['dry_run'], stream)
+            for moved in chunks:
+                total += moved
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s %i keys of %s, %i so far' % (verb, moved, group, total))
+            elapsed = time.time() - start
+            self.stdout.write('%s %i keys of %s in %.2fs' % (verb, total, group, elapsed))
@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from verification.bloom import key_filter
+from verification.models import KeyGroup
+
+
+class Command(BaseCommand):
+    help = 'Build the filters that reject keys that do not exist without a query'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', action='append', dest='groups', default=[],
+                            help='Only build the filter of this group. Can be repeated.')
+        parser.add_argument('--model', default='verification.Key',
+                            help='The key model, as app_label.ModelName. Default: %(default)s')
+        parser.add_argument('--clear', action='store_true',
+                            help='Remove the filters instead.')
+
+    def handle(self, *args, **options):
+        if not key_filter.enabled():
+            raise CommandError('Set VERIFICATION_KEY_FILTER_CACHE to use key filters')
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        groups = KeyGroup.objects.all()
+        if options['groups']:
+            groups = groups.filter(name__in=options['groups'])
+        for group in groups:
+            if group.signed_keys:
+                continue
+            if options['clear']:
+                key_filter.clear(group)
+                self.stdout.write('Removed the filter of %s' % group)
+                continue
+            start = time.time()
+            count = group.build_key_filter(model)
+            self.stdout.write('Built the filter of %s from %i keys in %.2fs'
+                              % (group, count, time.time() - start))
@@ -0,0 +1,42 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from verification.models import ClaimEvent
+
+
+class Command(BaseCommand):
+    help = 'Send key_claimed for claims stored in the outbox, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Events sent per batch. Default: %(default)s')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Give up on an event after this many failures. Default: %(default)s')
+        parser.add_argument('--retry-delay', type=float, default=60.0,
+                            help='Seconds before the first retry, doubled per retry. Default: %(default)s')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, looking for new events every --sleep seconds.')
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='Seconds to sleep when there are no events. Default: %(default)s')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = self.drain(options)
+            if sent or failed or not options['loop']:
+                self.stdout.write('Sent %i claim events, %i failed' % (sent, failed))
+            if not options['loop']:
+                return
+            time.sleep(options['sleep'])
+
+    def drain(self, options):
+        total_sent = total_failed = 0
+        batches = ClaimEvent.objects.process(options['batch_size'],
+                                             options['max_attempts'],
+                                             options['retry_delay'])
+        for sent, failed in batches:
+            total_sent += sent
+            total_failed += failed
+        return total_sent, total_failed
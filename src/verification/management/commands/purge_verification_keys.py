@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Delete expired keys, or all keys of some groups, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', action='append', dest='groups', default=[],
+                            help='Only purge keys of this group. Can be repeated.')
+        parser.add_argument('--all', action='store_true',
+                            help='Purge all keys of the groups, not just the expired ones.')
+        parser.add_argument('--model', default='verification.Key',
+                            help='The key model, as app_label.ModelName. Default: %(default)s')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Keys deleted per batch. Default: %(default)s')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to sleep between batches. Default: %(default)s')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the keys that would be deleted.')
+
+    def handle(self, *args, **options):
+        if options['all'] and not options['groups']:
+            raise CommandError('--all needs at least one --group')
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        keys = model._default_manager.all()
+        if options['groups']:
+            keys = keys.filter(group__in=options['groups'])
+        if not options['all']:
+            keys = keys.expired()
+
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        total = 0
+        start = time.time()
+        chunks = keys.purge(options['batch_size'], options['sleep'], options['dry_run'])
+        for deleted in chunks:
+            total += deleted
+            if options['verbosity'] > 1:
+                self.stdout.write('%s %i keys, %i so far' % (verb, deleted, total))
+        elapsed = time.time() - start
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write('%s %i keys in %.2fs (%.0f keys/s)' % (verb, total, elapsed, rate))
@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from verification.models import KeyGroup
+
+
+class Command(BaseCommand):
+    help = 'Recount the keys of each group into the group counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', action='append', dest='groups', default=[],
+                            help='Only recount the keys of this group. Can be repeated.')
+        parser.add_argument('--model', default='verification.Key',
+                            help='The key model, as app_label.ModelName. Default: %(default)s')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        groups = KeyGroup.objects.all()
+        if options['groups']:
+            groups = groups.filter(name__in=options['groups'])
+        for group in groups:
+            stats = group.reconcile_counters(model)
+            self.stdout.write('%s: %i issued, %i claimed, %i expired, %i purged'
+                              % (group, stats['issued'], stats['claimed'],
+                                 stats['expired'], stats['purged']))
@@ -0,0 +1,41 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from verification.models import KeyGroup
+
+
+class Command(BaseCommand):
+    help = 'Refill the pools of keys made in advance that are running low'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', action='append', dest='groups', default=[],
+                            help='Only refill the pool of this group. Can be repeated.')
+        parser.add_argument('--model', default='verification.Key',
+                            help='The key model, as app_label.ModelName. Default: %(default)s')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Keys inserted per query. Default: %(default)s')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking the pools every --sleep seconds.')
+        parser.add_argument('--sleep', type=float, default=10.0,
+                            help='Seconds between checks with --loop. Default: %(default)s')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        while True:
+            groups = KeyGroup.objects.exclude(pool_size=None)
+            if options['groups']:
+                groups = groups.filter(name__in=options['groups'])
+            for group in groups:
+                made = group.refill_pool(model, batch_size=options['batch_size'])
+                if made or not options['loop']:
+                    self.stdout.write('Made %i keys for the pool of %s' % (made, group))
+            if not options['loop']:
+                return
+            time.sleep(options['sleep'])
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import verification.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='key',
+            name='digest',
+            field=verification.models.DigestField(blank=True, max_length=32, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='keygroup',
+            name='hash_keys',
+            field=models.BooleanField(default=False, verbose_name='Store keys hashed'),
+        ),
+        migrations.AlterField(
+            model_name='key',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='verification.keygroup'),
+        ),
+        migrations.AlterField(
+            model_name='key',
+            name='key',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='key',
+            name='pub_date',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
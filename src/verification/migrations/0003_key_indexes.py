@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """AddIndex that does not lock the table for writes on PostgreSQL
+
+    Needs a non-atomic migration. Other databases get a plain AddIndex."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AddIndexConcurrently, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AddIndexConcurrently, self).database_backwards(
+                app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('verification', '0002_hashed_keys'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='key',
+            index=models.Index(fields=['group', 'claimed', 'expires'], name='verification_key_state'),
+        ),
+        AddIndexConcurrently(
+            model_name='key',
+            index=models.Index(condition=models.Q(('claimed', None)), fields=['group', 'expires'], name='verification_key_available'),
+        ),
+        AddIndexConcurrently(
+            model_name='key',
+            index=models.Index(fields=['pub_date'], name='verification_key_pub_date'),
+        ),
+    ]
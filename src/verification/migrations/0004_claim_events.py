@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification', '0003_key_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClaimEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_model', models.CharField(max_length=100)),
+                ('key_pk', models.CharField(max_length=64)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ('pk',),
+                'indexes': [models.Index(fields=['next_attempt'], name='verification_event_next')],
+            },
+        ),
+    ]
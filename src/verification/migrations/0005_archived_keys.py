@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import verification.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification', '0004_claim_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('digest', verification.models.DigestField(blank=True, db_index=True, max_length=32, null=True)),
+                ('group', models.CharField(db_index=True, max_length=32)),
+                ('fact', models.TextField(blank=True, null=True)),
+                ('pub_date', models.DateTimeField()),
+                ('expires', models.DateTimeField(blank=True, null=True)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('claimant_pk', models.CharField(blank=True, db_index=True, max_length=64, null=True)),
+            ],
+            options={
+                'ordering': ('-pub_date',),
+            },
+        ),
+        migrations.AddField(
+            model_name='keygroup',
+            name='archive_after',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Archive used keys after, in days'),
+        ),
+    ]
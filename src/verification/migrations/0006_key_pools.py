@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification', '0005_archived_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='key',
+            name='pooled',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='keygroup',
+            name='pool_low_water',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Refill the pool below'),
+        ),
+        migrations.AddField(
+            model_name='keygroup',
+            name='pool_size',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Keys made in advance'),
+        ),
+    ]
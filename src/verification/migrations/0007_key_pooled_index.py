@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+AddIndexConcurrently = import_module(
+    'verification.migrations.0003_key_indexes').AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('verification', '0006_key_pools'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='key',
+            index=models.Index(condition=models.Q(('pooled', True)), fields=['group'], name='verification_key_pooled'),
+        ),
+    ]
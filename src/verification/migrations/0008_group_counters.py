@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification', '0007_key_pooled_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyGroupCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('issued', models.BigIntegerField(default=0)),
+                ('claimed', models.BigIntegerField(default=0)),
+                ('expired', models.BigIntegerField(default=0)),
+                ('purged', models.BigIntegerField(default=0)),
+                ('reconciled', models.DateTimeField(blank=True, null=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='key_counters', to='verification.keygroup')),
+            ],
+            options={
+                'unique_together': {('group', 'shard')},
+            },
+        ),
+    ]
@@ -1,49 +1,490 @@
 from __future__ import unicode_literals
 
-from datetime import timedelta
+import hashlib
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-from django.db import models
+from asgiref.sync import sync_to_async
+
+from django.apps import apps
+from django.db import IntegrityError, connections, models, router, transaction
+from django.utils import timezone
 from django.utils.timezone import now as tznow
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db.models.deletion import Collector
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.db.models.sql import UpdateQuery
+from django.dispatch import receiver
+from django.core import signing
+from django.utils.crypto import salted_hmac
+from django.utils.encoding import force_bytes
 
-from verification.signals import key_claimed
+from verification.bloom import key_filter
+from verification.cache import group_cache
+from verification.counters import counters
+from verification.delivery import BaseDeliveryBackend, Delivery
+from verification.delivery import get_backend as get_delivery_backend
+from verification.instrumentation import instrumentation
+from verification.signals import key_claimed, keys_claimed
+from verification.throttling import throttle
 from verification.generators import registry as generators
+from verification.generators import GeneratorError, SignedKeyGenerator
 
 __all__ = [
     'VerificationError', 
+    'KeyDoesNotExist',
     'KeyQuerySet',
     'KeyGroup',
     'AbstractKey',
+    'ArchivedKey',
+    'ClaimEvent',
+    'KeyGroupCounter',
     'claim',
+    'aclaim',
+    'ClaimResult',
+    'CLAIMED',
+    'MISSING',
+    'EXPIRED',
+    'ALREADY_CLAIMED',
+    'key_digest',
+    'key_indexes',
 ]
 
+_LOG = logging.getLogger(__name__)
+
 Q = models.Q
 
 class VerificationError(Exception):
     pass
 
-def claim(keystring, claimant):
-    """Claims a specific key for claimant, returns True if successful,
-    raises an exception otherwise"""
+class KeyDoesNotExist(VerificationError):
+    "The key does not exist, or could not exist"
+    pass
+
+def _can_update_returning(connection):
+    "PostgreSQL and SQLite 3.35+ can return columns from an UPDATE"
+    return (connection.vendor in ('postgresql', 'sqlite')
+            and connection.features.can_return_columns_from_insert)
+
+def _from_db_value(connection, field, value):
+    "Convert a raw column value the same way the ORM would"
+    col = field.get_col(field.model._meta.db_table)
+    converters = connection.ops.get_db_converters(col) + col.get_db_converters(connection)
+    for converter in converters:
+        value = converter(value, col, connection)
+    return value
+
+def _update_returning(queryset, **values):
+    """Run a single UPDATE ... RETURNING on queryset, return the first
+    updated row as a model instance or None if no row was updated"""
+    model = queryset.model
+    using = queryset.db
+    connection = connections[using]
+    query = queryset.order_by().query.chain(UpdateQuery)
+    query.add_update_values(values)
+    sql, params = query.get_compiler(using).as_sql()
+    fields = model._meta.concrete_fields
+    returning = ', '.join(connection.ops.quote_name(f.column) for f in fields)
+    with transaction.mark_for_rollback_on_error(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute('%s RETURNING %s' % (sql, returning), params)
+            row = cursor.fetchone()
+    if row is None:
+        return None
+    row = [_from_db_value(connection, f, v) for f, v in zip(fields, row)]
+    return model.from_db(using, [f.attname for f in fields], row)
+
+def _filter_key(queryset, keystring, group=None):
+    "queryset.filter_key(), or the key queryset is limited to if <keystring> is None"
+    if keystring is None:
+        return queryset.filter(pooled=False)
+    return queryset.filter_key(keystring, group)
+
+def _available_key(queryset, keystring, now, group=None):
+    available = _filter_key(queryset, keystring, group).filter(claimed=None)
+    return available.filter(Q(expires=None)|Q(expires__gt=now))
+
+def _claim_key(queryset, keystring, claimant, now, group=None):
+    """Mark an available key as claimed with one conditional UPDATE.
+
+    Returns the claimed key, or None if no key was available."""
+    available = _available_key(queryset, keystring, now, group)
+    if _can_update_returning(connections[queryset.db]):
+        return _update_returning(available, claimed=now, claimed_by=claimant)
+    if not available.update(claimed=now, claimed_by=claimant):
+        return None
+    if group is None:
+        queryset = queryset.select_related('group')
+    return _filter_key(queryset, keystring, group).get()
+
+def _claim_failed(queryset, keystring, now, group=None):
+    "Find out why a key could not be claimed. Only used on failure."
+    row = _filter_key(queryset.order_by(), keystring, group).values_list('expires', 'claimed')[:1]
+    if not row:
+        raise KeyDoesNotExist('Key %s does not exist, typo?' % keystring)
+    expires, claimed = row[0]
+    if expires and expires <= now:
+        raise VerificationError('Key expired on %s' % expires)
+    if claimed:
+        raise VerificationError('Key has already been claimed')
+    raise KeyDoesNotExist('Key %s does not exist, typo?' % keystring)
+
+def claim(keystring, claimant, group=None, queryset=None):
+    """Claims a specific key for claimant, returns the key if successful,
+    raises an exception otherwise
+
+    The key is claimed with a single conditional UPDATE so that two
+    concurrent claims of the same key cannot both succeed. If <group> is
+    given, only keys in that KeyGroup can be claimed, and keys that the
+    group's generator could not have made are rejected without a query."""
+    if queryset is None:
+        queryset = Key.objects.all()
+    if group is not None and not group.valid_key(keystring):
+        counters.incr(group, 'rejected')
+        raise KeyDoesNotExist('Key %s is not a valid key for %s' % (keystring, group))
+    return _claim(queryset, keystring, claimant, group)
+
+def _claim_signed(queryset, keystring, claimant, group):
+    """Claim a signed key by storing it. The key is checked without
+    a query, the unique key column stops it from being claimed twice."""
+    key = group.load_signed_key(queryset.model, keystring)
     now = tznow()
-    try:
-        key = Key.objects.get(key=keystring)
-    except Key.DoesNotExist:
-        raise VerificationError('Key %s does not exist, typo?' % keystring)
     if key.expires and key.expires <= now:
         raise VerificationError('Key expired on %s' % key.expires)
-    if key.claimed:
-        raise VerificationError('Key has already been claimed')
     key.claimed_by = claimant
     key.claimed = now
-    key.save()
-    key_claimed.send_robust(sender=key, claimant=claimant, group=key.group)
+    using = router.db_for_write(queryset.model)
+    try:
+        with transaction.atomic(using=using):
+            _insert_signed(key, using, group.hash_keys)
+    except IntegrityError:
+        if not queryset.filter_key(keystring, group).exists():
+            raise
+        raise VerificationError('Key has already been claimed')
     return key
 
+def _insert_signed(key, using, hash_keys):
+    """Insert the signed key as loaded, skipping AbstractKey.save() which
+    would set pub_date and expires anew. The database sets the pk"""
+    keystring = key.key
+    if hash_keys:
+        key.digest, key.key = key_digest(keystring), None
+    try:
+        models.Model.save(key, force_insert=True, using=using)
+    finally:
+        key.key = keystring
+
+def _signed_group_name(keystring):
+    "Get the group name in a signed key, or None if it is not a signed key"
+    if ':' not in keystring:
+        return None
+    try:
+        return signing.Signer(salt=SignedKeyGenerator.salt).unsign_object(keystring)[0]
+    except (signing.BadSignature, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def _signed_key_group(keystring):
+    "Get the KeyGroup of a signed key, or None if it is not a signed key"
+    name = _signed_group_name(keystring)
+    if name is None:
+        return None
+    try:
+        group = KeyGroup.objects.get_cached(name)
+    except KeyGroup.DoesNotExist:
+        return None
+    return group if group.signed_keys else None
+
+def _claim_outbox():
+    "Whether claims write a ClaimEvent instead of sending key_claimed"
+    return getattr(settings, 'VERIFICATION_CLAIM_OUTBOX', False)
+
+def _claim(queryset, keystring, claimant, group=None):
+    with instrumentation.timer('claim', group) as timer:
+        if not _claim_outbox():
+            key = _claim_row(queryset, keystring, claimant, group)
+            timer.group = key.group
+            with instrumentation.timer('signal', key.group):
+                key_claimed.send_robust(sender=key, claimant=claimant, group=key.group)
+            return key
+        # The event is only stored if the claim is
+        using = router.db_for_write(queryset.model)
+        with transaction.atomic(using=using):
+            key = _claim_row(queryset, keystring, claimant, group)
+            ClaimEvent.objects.using(using).create(
+                key_model=key._meta.label, key_pk=str(key.pk))
+        timer.group = key.group
+        return key
+
+def _claim_row(queryset, keystring, claimant, group=None):
+    """Claim the key without telling anyone. With <keystring> None the
+    key queryset is limited to is claimed, see AbstractKey.claim()"""
+    if group is None:
+        group = _signed_key_group(keystring)
+    # A stored signed key has been claimed, the UPDATE below finds that out
+    signed = keystring is not None and group is not None and group.signed_keys
+    if signed:
+        key = _claim_signed(queryset, keystring, claimant, group)
+    else:
+        if (group is not None and keystring is not None
+                and not key_filter.might_exist(group, keystring)):
+            raise KeyDoesNotExist('Key %s does not exist, typo?' % keystring)
+        now = tznow()
+        key = _claim_key(queryset, keystring, claimant, now, group)
+        if key is None:
+            _claim_failed(queryset, keystring, now, group)
+    if keystring is not None:
+        # The key may be stored hashed
+        key.key = keystring
+    key.claimed_by = claimant
+    if group is None:
+        group = key.get_group()
+    key.group = group
+    # Signed keys are stored when claimed
+    _count_keys(group, issued=int(signed), claimed=1)
+    return key
+
+async def aclaim(keystring, claimant, group=None, queryset=None):
+    """Async claim(), on Django's async ORM
+
+    key_claimed is sent with asend_robust() where Django has it (5.0+),
+    so async receivers are awaited on the event loop. Sync receivers run
+    in a thread, as with any other async sender."""
+    if queryset is None:
+        queryset = Key.objects.all()
+    if group is not None and not group.valid_key(keystring):
+        counters.incr(group, 'rejected')
+        raise KeyDoesNotExist('Key %s is not a valid key for %s' % (keystring, group))
+    return await _aclaim(queryset, keystring, claimant, group)
+
+async def _aclaim_key(queryset, keystring, claimant, now, group=None):
+    "Async _claim_key()"
+    available = _available_key(queryset, keystring, now, group)
+    if _can_update_returning(connections[queryset.db]):
+        # The async ORM has no UPDATE ... RETURNING, run it like it runs queries
+        return await sync_to_async(_update_returning)(
+            available, claimed=now, claimed_by=claimant)
+    if not await available.aupdate(claimed=now, claimed_by=claimant):
+        return None
+    if group is None:
+        queryset = queryset.select_related('group')
+    return await _filter_key(queryset, keystring, group).aget()
+
+async def _asigned_key_group(keystring):
+    "Async _signed_key_group()"
+    name = _signed_group_name(keystring)
+    if name is None:
+        return None
+    try:
+        group = await KeyGroup.objects.aget_cached(name)
+    except KeyGroup.DoesNotExist:
+        return None
+    return group if group.signed_keys else None
+
+async def _aclaim(queryset, keystring, claimant, group=None):
+    if _claim_outbox():
+        # Claim and event share a transaction, which the async ORM cannot do
+        return await sync_to_async(_claim)(queryset, keystring, claimant, group)
+    with instrumentation.timer('claim', group) as timer:
+        key = await _aclaim_row(queryset, keystring, claimant, group)
+        timer.group = key.group
+        with instrumentation.timer('signal', key.group):
+            if hasattr(key_claimed, 'asend_robust'):
+                await key_claimed.asend_robust(sender=key, claimant=claimant, group=key.group)
+            else:   # Django < 5.0
+                await sync_to_async(key_claimed.send_robust)(
+                    sender=key, claimant=claimant, group=key.group)
+    return key
+
+async def _aclaim_row(queryset, keystring, claimant, group=None):
+    "Async _claim_row()"
+    if group is None:
+        group = await _asigned_key_group(keystring)
+    signed = keystring is not None and group is not None and group.signed_keys
+    if signed:
+        # Needs a transaction, which the async ORM cannot do
+        key = await sync_to_async(_claim_signed)(queryset, keystring, claimant, group)
+    else:
+        if (group is not None and keystring is not None
+                and not await key_filter.amight_exist(group, keystring)):
+            raise KeyDoesNotExist('Key %s does not exist, typo?' % keystring)
+        now = tznow()
+        key = await _aclaim_key(queryset, keystring, claimant, now, group)
+        if key is None:
+            await sync_to_async(_claim_failed)(queryset, keystring, now, group)
+    if keystring is not None:
+        # The key may be stored hashed
+        key.key = keystring
+    key.claimed_by = claimant
+    if group is None:
+        group = await key.aget_group()
+    key.group = group
+    await _acount_keys(group, issued=int(signed), claimed=1)
+    return key
+
+CLAIMED = 'claimed'
+MISSING = 'missing'
+EXPIRED = 'expired'
+ALREADY_CLAIMED = 'already_claimed'
+
+class ClaimResult(object):
+    """What became of one claim of KeyQuerySet.claim_many()
+
+    status is CLAIMED, MISSING, EXPIRED or ALREADY_CLAIMED. key is the
+    claimed key, or None."""
+
+    def __init__(self, keystring, claimant, status=MISSING, key=None):
+        self.keystring = keystring
+        self.claimant = claimant
+        self.status = status
+        self.key = key
+
+    def __repr__(self):
+        return '<ClaimResult %s: %s>' % (self.keystring, self.status)
+
+def _key_lookup(keystring, group=None):
+    "A Q finding the key <keystring>, see KeyQuerySet.filter_key()"
+    if group is None:
+        return Q(key=keystring)|Q(digest=key_digest(keystring))
+    if group.hash_keys:
+        return Q(group=group, digest=key_digest(keystring))
+    return Q(group=group, key=keystring)
+
+def _claim_many(queryset, claims, group, batched_signal, chunk_size):
+    results = [ClaimResult(keystring, claimant) for keystring, claimant in claims]
+    plain, signed = [], []
+    for result in results:
+        key_group = group if group is not None else _signed_key_group(result.keystring)
+        if key_group is not None and key_group.signed_keys:
+            signed.append((result, key_group))
+        elif group is not None and not group.valid_key(result.keystring):
+            counters.incr(group, 'rejected')
+        elif group is None or key_filter.might_exist(group, result.keystring):
+            plain.append(result)
+    using = router.db_for_write(queryset.model)
+    outbox = _claim_outbox()
+    with transaction.atomic(using=using):
+        for i in range(0, len(plain), chunk_size):
+            _claim_chunk(queryset, plain[i:i+chunk_size], group)
+        for result, key_group in signed:
+            _claim_many_signed(queryset, result, key_group)
+        claimed = [result.key for result in results if result.status == CLAIMED]
+        for key_group, keys in _by_group(claimed).items():
+            signed_keys = len(keys) if key_group.signed_keys else 0
+            _count_keys(key_group, issued=signed_keys, claimed=len(keys))
+        if outbox and claimed:
+            ClaimEvent.objects.using(using).bulk_create([
+                ClaimEvent(key_model=key._meta.label, key_pk=str(key.pk)) for key in claimed])
+    if outbox or not claimed:
+        return results
+    if batched_signal:
+        keys_claimed.send_robust(sender=queryset.model, keys=claimed)
+    else:
+        for key in claimed:
+            key_claimed.send_robust(sender=key, claimant=key.claimed_by, group=key.group)
+    return results
+
+def _claim_chunk(queryset, results, group):
+    "Claim the keys of <results> with one UPDATE, then set their status"
+    now = tznow()
+    keystrings = [result.keystring for result in results]
+    claimants = [models.Value(_pk(result.claimant)) for result in results]
+    keys = queryset.order_by().filter(pooled=False)
+    if group is not None:
+        keys = keys.filter(group=group)
+    plain = group is None or not group.hash_keys
+    hashed = group is None or group.hash_keys
+    lookup, whens, digests = Q(), [], []
+    # When() takes the first match, so the first claim of a key wins
+    if plain:
+        lookup |= Q(key__in=keystrings)
+        whens += [models.When(key=k, then=c) for k, c in zip(keystrings, claimants)]
+    if hashed:
+        digests = [bytes(key_digest(k)) for k in keystrings]
+        lookup |= Q(digest__in=digests)
+        whens += [models.When(digest=d, then=c) for d, c in zip(digests, claimants)]
+    keys = keys.filter(lookup)
+    claimant_field = queryset.model._meta.get_field('claimed_by').target_field
+    available = keys.filter(claimed=None).filter(Q(expires=None)|Q(expires__gt=now))
+    available.update(claimed=now, claimed_by=models.Case(*whens, output_field=claimant_field))
+    by_key, by_digest = {}, {}
+    for key in keys:
+        if key.key is not None:
+            by_key[key.key] = key
+        if key.digest is not None:
+            by_digest[bytes(key.digest)] = key
+    seen = set()
+    for i, result in enumerate(results):
+        key = by_key.get(result.keystring) if plain else None
+        if key is None and hashed:
+            key = by_digest.get(digests[i])
+        if key is None:
+            continue
+        if (key.pk not in seen and key.claimed == now
+                and key.claimed_by_id == _pk(result.claimant)):
+            seen.add(key.pk)
+            # The key may be stored hashed
+            key.key = result.keystring
+            key.claimed_by = result.claimant
+            key.group = group if group is not None else key.get_group()
+            result.status, result.key = CLAIMED, key
+        elif key.expires and key.expires <= now:
+            result.status = EXPIRED
+        elif key.claimed:
+            result.status = ALREADY_CLAIMED
+
+def _claim_many_signed(queryset, result, group):
+    try:
+        result.key = _claim_signed(queryset, result.keystring, result.claimant, group)
+    except KeyDoesNotExist:
+        return
+    except VerificationError:
+        key = group.load_signed_key(queryset.model, result.keystring)
+        expired = key.expires and key.expires <= tznow()
+        result.status = EXPIRED if expired else ALREADY_CLAIMED
+        return
+    result.key.group = group
+    result.status = CLAIMED
+
+def _pk(instance):
+    return instance.pk if instance is not None else None
+
+def _by_group(keys):
+    groups = {}
+    for key in keys:
+        groups.setdefault(key.group, []).append(key)
+    return groups
+
+def key_digest(keystring):
+    """The keyed digest stored instead of the key by groups that hash keys
+
+    The digest is keyed with VERIFICATION_KEY_DIGEST_SECRET, falling back to
+    SECRET_KEY."""
+    secret = getattr(settings, 'VERIFICATION_KEY_DIGEST_SECRET', None)
+    return salted_hmac('verification.key_digest', keystring,
+                       secret=secret, algorithm='sha256').digest()
+
+class DigestField(models.BinaryField):
+    "Binary column for key digests, fixed-width where the database has it"
+
+    def db_type(self, connection):
+        if connection.vendor == 'mysql':
+            return 'binary(%i)' % self.max_length
+        return super(DigestField, self).db_type(connection)
+
 class KeyQuerySet(QuerySet):
 
+    def filter_key(self, keystring, group=None):
+        """Get the key <keystring>, whether stored as is or hashed
+
+        Without a KeyGroup both forms must be looked for. Pooled keys,
+        not yet handed out, are never found."""
+        return self.filter(pooled=False).filter(_key_lookup(keystring, group))
+
     def expired(self):
         "Get keys that have expired"
         now = tznow()
@@ -52,19 +493,148 @@ class KeyQuerySet(QuerySet):
     def available(self):
         "Get still available keys"
         now = tznow()
-        return self.filter(Q(expires__gt=now)|Q(expires=None)).filter(claimed=None)
+        keys = self.filter(Q(expires__gt=now)|Q(expires=None)).filter(claimed=None)
+        return keys.filter(pooled=False)
+
+    def pooled(self):
+        "Get keys made in advance and not yet handed out, see KeyGroup.pool_size"
+        return self.filter(pooled=True)
 
     def claimed(self):
         "Get claimed keys"
         return self.exclude(claimed=None)
 
-    def delete_expired(self):
-        """Removes expired keys"""
+    def delete_expired(self, batch_size=1000):
+        """Removes expired keys, returns how many"""
         now = tznow()
-        self.filter(expires__lte=now).delete()
+        return sum(self.filter(expires__lte=now)._purge(batch_size, expired=True))
+
+    def purge(self, batch_size=1000, sleep=0, dry_run=False):
+        """Delete the keys in chunks of <batch_size> consecutive primary keys
+
+        This is a generator yielding how many keys were deleted per chunk,
+        or would have been if <dry_run>. Sleeps <sleep> seconds between
+        chunks. Keys are deleted without being loaded unless cascades or
+        delete-signals need them."""
+        return self._purge(batch_size, sleep, dry_run)
+
+    def _purge(self, batch_size=1000, sleep=0, dry_run=False, expired=False):
+        "purge(), counting the keys as <expired> in the group counters"
+        using = router.db_for_write(self.model)
+        for keys, size in self._chunks(batch_size, sleep):
+            if dry_run:
+                yield size
+            elif not _group_counters():
+                yield keys._delete(using)
+            else:
+                with transaction.atomic(using=using):
+                    removed = keys._count_removed(expired)
+                    deleted = keys._delete(using)
+                    removed()
+                yield deleted
+
+    def _count_removed(self, expired=False):
+        """Count the keys per group before they are removed. Returns
+        a function that updates the group counters once they are"""
+        if not _group_counters():
+            return lambda: None
+        counts = list(self.order_by().filter(pooled=False).values_list('group')
+                      .annotate(models.Count('pk'), models.Count('claimed')))
+
+        def removed():
+            for group, n, claimed in counts:
+                _count_keys(group, issued=-n, claimed=-claimed, purged=n,
+                            expired=n if expired else 0)
+        return removed
+
+    def _chunks(self, batch_size, sleep):
+        """Yield (keys, count) per chunk of <batch_size> consecutive primary
+        keys, sleeping <sleep> seconds between full chunks"""
+        queryset = self.order_by()
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        lower = None
+        while True:
+            chunk = pks if lower is None else pks.filter(pk__gt=lower)
+            chunk = list(chunk[:batch_size])
+            if not chunk:
+                return
+            keys = queryset.filter(pk__lte=chunk[-1])
+            if lower is not None:
+                keys = keys.filter(pk__gt=lower)
+            lower = chunk[-1]
+            yield keys, len(chunk)
+            if sleep and len(chunk) == batch_size:
+                time.sleep(sleep)
+
+    def _delete(self, using):
+        "Delete without loading the keys unless cascades or signals need them"
+        if Collector(using=using).can_fast_delete(self):
+            return self._raw_delete(using)
+        return self.delete()[1].get(self.model._meta.label, 0)
 
-    def claim(self, *args):
-        return claim(*args)
+    def archive(self, batch_size=1000, sleep=0, dry_run=False, stream=None):
+        """Move the keys to ArchivedKey in chunks, like purge()
+
+        With a text <stream> the keys are written to it as lines of JSON
+        instead. Each chunk is copied and deleted in one transaction."""
+        using = router.db_for_write(self.model)
+        fields = ['pk', 'key', 'digest', 'group_id', 'fact', 'pub_date',
+                  'expires', 'claimed', 'claimed_by_id']
+        for keys, size in self._chunks(batch_size, sleep):
+            if dry_run:
+                yield size
+                continue
+            with transaction.atomic(using=using):
+                removed = keys._count_removed()
+                rows = list(keys.values_list(*fields))
+                archived = [ArchivedKey.from_row(*row[1:]) for row in rows]
+                if stream is None:
+                    ArchivedKey.objects.using(using).bulk_create(archived)
+                else:
+                    for key in archived:
+                        stream.write(key.to_json() + '\n')
+                moved = self.model._default_manager.using(using)
+                moved = moved.filter(pk__in=[row[0] for row in rows])._delete(using)
+                removed()
+            yield moved
+
+    def claim(self, keystring, claimant, group=None):
+        "Claim the key <keystring> in this queryset for claimant"
+        return claim(keystring, claimant, group=group, queryset=self)
+
+    def claim_many(self, claims, group=None, batched_signal=False, chunk_size=500):
+        """Claim many keys in one transaction, returns a ClaimResult per
+        (keystring, claimant) in <claims>, in the same order
+
+        Keys are claimed with one UPDATE and checked with one SELECT per
+        <chunk_size> keys, except signed keys which are claimed one by one.
+        If a keystring is given more than once, only the first claim of it
+        can succeed. key_claimed is sent per claimed key after the
+        transaction, or with <batched_signal> keys_claimed is sent once
+        with all of them. With VERIFICATION_CLAIM_OUTBOX a ClaimEvent is
+        stored per claimed key instead."""
+        with instrumentation.timer('claim_many', group):
+            return _claim_many(self, claims, group, batched_signal, chunk_size)
+
+    async def aavailable(self):
+        "Get still available keys, as a list"
+        return [key async for key in self.available()]
+
+    async def aclaim(self, keystring, claimant, group=None):
+        "Async claim()"
+        return await aclaim(keystring, claimant, group=group, queryset=self)
+
+
+class KeyGroupManager(models.Manager):
+
+    def get_cached(self, name):
+        """Get the KeyGroup <name> from the per-process cache, see
+        verification.cache. Raises KeyGroup.DoesNotExist"""
+        return group_cache.get(name)
+
+    async def aget_cached(self, name):
+        "Async get_cached(), only awaits the database on a cache miss"
+        return await group_cache.aget(name)
 
 
 class KeyGroup(models.Model):
@@ -74,39 +644,472 @@ class KeyGroup(models.Model):
                 "pub_date" + "ttl", or will not expire of ttl is None
     generator - The name of a key generator
     has_fact  - Whether Key.fact must be set
+    hash_keys - Whether to store only a digest of the keys. Cannot be
+                changed while the group has keys that can be claimed, as
+                keys are only looked up in the form the group stores.
+    archive_after - Days after which claimed and expired keys are moved to
+                ArchivedKey, or None to keep them. Signed keys are kept
+                until expired.
+    pool_size - Keys made in advance and kept ready for generate_one_key(),
+                or None to make each key when needed. Not for signed or
+                hashed keys.
+    pool_low_water - Refill the pool when it holds fewer keys than this,
+                default half of pool_size.
     """
     name = models.SlugField(max_length=32, primary_key=True)
     ttl = models.IntegerField('Time to live, in minutes', blank=True, null=True)
     generator = models.CharField(max_length=64)
     has_fact = models.BooleanField(default=False)
+    hash_keys = models.BooleanField('Store keys hashed', default=False)
+    archive_after = models.IntegerField('Archive used keys after, in days', blank=True, null=True)
+    pool_size = models.IntegerField('Keys made in advance', blank=True, null=True)
+    pool_low_water = models.IntegerField('Refill the pool below', blank=True, null=True)
+
+    objects = KeyGroupManager()
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        self._check_hash_keys()
+
+    def save(self, *args, **kwargs):
+        self._check_hash_keys()
+        super(KeyGroup, self).save(*args, **kwargs)
+
+    def _check_hash_keys(self):
+        """Raise ValidationError if hash_keys is changed while keys of
+        the group could still be claimed"""
+        stored = type(self)._default_manager.filter(pk=self.pk)
+        stored = stored.values_list('hash_keys', flat=True).first()
+        if stored is None or stored == self.hash_keys:
+            return
+        now = tznow()
+        keys = self.keys.model._default_manager.filter(group=self, claimed=None)
+        if keys.filter(Q(expires=None)|Q(expires__gt=now)).exists():
+            raise ValidationError({'hash_keys': 'Cannot be changed while the group '
+                                   'has unclaimed keys'})
+
     def get_generator(self):
         if self.generator in generators.available():
             return generators.get(self.generator)
 
-    def purge_keys(self):
-        "Delete all keys belonging to this group"
-        model = self.keys.model
-        model.objects.filter(group=self).delete()
-
-    def generate_one_key(self, keycls, seed=None, fact=None, *args):
-        "Generate and return a new key of class <keycls>"
-        Generator = self.get_generator()
-        generator = Generator(seed=seed)
-        keystring = generator.generate_one_key(*args)
-        key = keycls(group=self, key=keystring)
+    def valid_key(self, keystring):
+        """Check that <keystring> could have been made by the generator
+
+        Keys are assumed to be valid if the generator is unknown or cannot
+        check keys."""
+        try:
+            return bool(generators.instance(self.generator).valid_key(keystring))
+        except (GeneratorError, NotImplementedError):
+            return True
+
+    @property
+    def signed_keys(self):
+        "Whether the keys are signed, and only stored when claimed"
+        try:
+            return generators.instance(self.generator).signed
+        except GeneratorError:
+            return False
+
+    def load_signed_key(self, keycls, keystring):
+        """Make an unsaved key of class <keycls> from the signed <keystring>
+
+        The fact of such a key is a hash of the original fact. Raises
+        VerificationError if the key was not signed for this group."""
+        try:
+            payload = self.get_generator_instance().load_key(keystring)
+            name, pub_date, expires, claimant, fact = payload
+        except (signing.BadSignature, GeneratorError, TypeError, ValueError):
+            raise KeyDoesNotExist('Key %s is not a valid key for %s' % (keystring, self))
+        if name != self.name:
+            raise KeyDoesNotExist('Key %s is not a valid key for %s' % (keystring, self))
+        return keycls(group=self, key=keystring, fact=fact,
+                      pub_date=_from_timestamp(pub_date),
+                      expires=_from_timestamp(expires), claimed_by_id=claimant)
+
+    def _make_signed_key(self, keycls, generator, fact=None, claimant=None, pub_date=None):
+        "Make an unsaved key of class <keycls> holding its own data"
+        pub_date = pub_date or tznow()
+        expires = None
+        if self.ttl:
+            expires = pub_date + timedelta(minutes=self.ttl)
+        fact_hash = None
         if fact:
-            key.fact = fact
-        key.save()
+            fact_hash = hashlib.sha256(force_bytes(fact)).hexdigest()[:16]
+        keystring = generator.generate_one_key(
+            self.name, _to_timestamp(pub_date), _to_timestamp(expires),
+            claimant.pk if claimant is not None else None, fact_hash)
+        key = keycls(group=self, key=keystring, fact=fact, pub_date=pub_date, expires=expires)
+        if claimant is not None:
+            key.claimed_by = claimant
         return key
 
+    def build_key_filter(self, keycls=None):
+        """Build the key filter of this group from its keys of class
+        <keycls>, default Key. Returns the number of keys. See
+        verification.bloom"""
+        keycls = keycls or Key
+        keys = keycls._default_manager.filter(group=self)
+        field = 'digest' if self.hash_keys else 'key'
+        keys = keys.exclude(**{field: None})
+        count = keys.count()
+        # Room for the keys made until the filter is rebuilt
+        capacity = max(2 * count, 1024)
+        items = keys.values_list(field, flat=True).order_by().iterator(chunk_size=10000)
+        key_filter.build(self, items, capacity)
+        return count
+
+    def get_generator_instance(self, seed=None):
+        "Return a generator for this group, a shared one unless seeded"
+        if seed:
+            return generators.get(self.generator)(seed=seed)
+        return generators.instance(self.generator)
+
+    def archivable_keys(self, keycls=None):
+        """Claimed and expired keys older than archive_after
+
+        Claimed signed keys are only archived once expired, as their row is
+        what stops them from being claimed again."""
+        keycls = keycls or self.keys.model
+        keys = keycls._default_manager.filter(group=self)
+        if self.archive_after is None:
+            return keys.none()
+        cutoff = tznow() - timedelta(days=self.archive_after)
+        if self.signed_keys:
+            return keys.filter(expires__lte=cutoff)
+        return keys.filter(Q(claimed__lte=cutoff)|Q(expires__lte=cutoff))
+
+    def purge_keys(self, batch_size=1000):
+        "Delete all keys belonging to this group, returns how many"
+        model = self.keys.model
+        return sum(model.objects.filter(group=self).purge(batch_size))
+
+    def generate_one_key(self, keycls, seed=None, fact=None, *args, claimant=None):
+        """Generate and return a new key of class <keycls>
+
+        If the generated key already exists a new one is generated, up to
+        VERIFICATION_KEY_RETRIES times. Signed keys are not saved. Raises
+        Throttled if too many keys are made for claimant or fact."""
+        with instrumentation.timer('generate', self):
+            return self._generate_one_key(keycls, seed, fact, *args, claimant=claimant)
+
+    def _generate_one_key(self, keycls, seed=None, fact=None, *args, claimant=None):
+        throttle.check_issue(self, claimant, fact)
+        if self.pooling and not (seed or args):
+            key = self._take_pooled_key(keycls, fact, claimant)
+            if key is not None:
+                return key
+            counters.incr(self, 'pool_empty')
+        generator = self.get_generator_instance(seed)
+        if generator.signed:
+            return self._make_signed_key(keycls, generator, fact, claimant)
+        manager = keycls._default_manager
+        retries = _key_retries()
+        for attempt in range(retries + 1):
+            keystring = generator.generate_one_key(*args)
+            key = keycls(group=self, key=keystring)
+            if fact:
+                key.fact = fact
+            if claimant is not None:
+                key.claimed_by = claimant
+            counters.incr(self, 'attempts')
+            try:
+                with transaction.atomic(using=router.db_for_write(keycls)):
+                    key.save()
+                return key
+            except IntegrityError:
+                if not _existing_keystrings(manager, [keystring], self):
+                    raise
+            self._collided(1, attempt < retries)
+        raise GeneratorError('No unused key found in %i attempts' % (retries + 1))
+
+    def stats(self):
+        """Get the counts of the keys of this group, without counting them
+
+        "issued" and "claimed" are the keys in the key table and those of
+        them that are claimed, "unclaimed" is the difference and includes
+        expired keys not yet purged. "expired" and "purged" are how many
+        keys have been deleted as expired and at all, archived included.
+        Needs VERIFICATION_GROUP_COUNTERS, see KeyGroupCounter."""
+        names = ('issued', 'claimed', 'expired', 'purged')
+        totals = self.key_counters.aggregate(*[models.Sum(name) for name in names])
+        stats = dict((name, totals['%s__sum' % name] or 0) for name in names)
+        stats['unclaimed'] = stats['issued'] - stats['claimed']
+        return stats
+
+    def reconcile_counters(self, keycls=None):
+        """Recount "issued" and "claimed" from the keys of class <keycls>,
+        default Key, keeping "expired" and "purged". Returns stats()"""
+        keycls = keycls or Key
+        using = router.db_for_write(KeyGroupCounter)
+        keys = keycls._default_manager.filter(group=self, pooled=False)
+        with transaction.atomic(using=using):
+            shards = KeyGroupCounter.objects.using(using).select_for_update()
+            shards = list(shards.filter(group=self))
+            counts = keys.aggregate(issued=models.Count('pk'), claimed=models.Count('claimed'))
+            KeyGroupCounter.objects.using(using).filter(group=self).delete()
+            KeyGroupCounter.objects.using(using).create(
+                group=self, shard=0, reconciled=tznow(),
+                expired=sum(shard.expired for shard in shards),
+                purged=sum(shard.purged for shard in shards), **counts)
+        return self.stats()
+
+    @property
+    def pooling(self):
+        "Whether keys are made in advance, see pool_size"
+        return bool(self.pool_size) and not self.hash_keys and not self.signed_keys
+
+    def _take_pooled_key(self, keycls, fact=None, claimant=None, attempts=5):
+        """Hand out a pooled key of class <keycls>, or return None if the
+        pool is empty
+
+        Where the database can, the key is locked with SELECT ... FOR UPDATE
+        SKIP LOCKED so concurrent requests take different keys. Elsewhere a
+        conditional UPDATE makes sure a key is only handed out once."""
+        using = router.db_for_write(keycls)
+        skip_locked = connections[using].features.has_select_for_update_skip_locked
+        manager = keycls._default_manager.db_manager(using)
+        for _ in range(attempts):
+            now = tznow()
+            values = {'pooled': False, 'pub_date': now, 'expires': None,
+                      'fact': fact or None, 'claimed_by': claimant}
+            if self.ttl:
+                values['expires'] = now + timedelta(minutes=self.ttl)
+            with transaction.atomic(using=using):
+                pooled = manager.filter(group=self).pooled().order_by('pk')
+                if skip_locked:
+                    pooled = pooled.select_for_update(skip_locked=True)
+                key = pooled.first()
+                if key is None:
+                    return None
+                if manager.filter(pk=key.pk, pooled=True).update(**values):
+                    for name, value in values.items():
+                        setattr(key, name, value)
+                    key.group = self
+                    _count_keys(self, issued=1)
+                    counters.incr(self, 'pool_taken')
+                    return key
+        return None
+
+    def refill_pool(self, keycls=None, batch_size=1000):
+        """Fill the pool of keys of class <keycls>, default Key, up to
+        pool_size if it holds fewer than pool_low_water. Returns how many
+        keys were made"""
+        if not self.pooling:
+            return 0
+        keycls = keycls or Key
+        pooled = keycls._default_manager.filter(group=self).pooled().count()
+        low_water = self.pool_low_water
+        if low_water is None:
+            low_water = self.pool_size // 2
+        if pooled >= max(low_water, 1):
+            return 0
+        made = self.iter_generate_keys(keycls, self.pool_size - pooled,
+                                       batch_size=batch_size, pooled=True)
+        return sum(len(batch) for batch in made)
+
+    def generate_keys(self, keycls, n, facts=None, claimants=None, batch_size=1000,
+                      progress=None):
+        """Generate and return <n> new keys of class <keycls>, inserted
+        with bulk_create() <batch_size> at a time
+
+        <facts> and <claimants> are optional iterables with one item per key.
+        <progress> is called with the number of keys made so far after each
+        batch. Signed keys are not saved. To make more keys than fit in
+        memory, use iter_generate_keys()."""
+        keys = []
+        for batch in self.iter_generate_keys(keycls, n, facts, claimants, batch_size):
+            keys.extend(batch)
+            if progress is not None:
+                progress(len(keys))
+        return keys
+
+    def iter_generate_keys(self, keycls, n, facts=None, claimants=None, batch_size=1000,
+                           pooled=False):
+        """generate_keys(), yielding each batch once inserted, so millions
+        of keys can be made without holding them all in memory. Nothing is
+        made until iterated. <pooled> keys are kept for generate_one_key()
+        to hand out, see refill_pool()."""
+        generator = self.get_generator_instance()
+        facts = iter(facts) if facts is not None else None
+        claimants = iter(claimants) if claimants is not None else None
+        manager = keycls._default_manager
+        retries = _key_retries()
+        remaining = n
+        while remaining > 0:
+            size = min(batch_size, remaining)
+            pub_date = tznow()
+            expires = None
+            if self.ttl and not pooled:
+                expires = pub_date + timedelta(minutes=self.ttl)
+            if generator.signed:
+                batch = [self._make_signed_key(keycls, generator,
+                                               next(facts, None) if facts else None,
+                                               next(claimants, None) if claimants else None,
+                                               pub_date)
+                         for _ in range(size)]
+                remaining -= size
+                yield batch
+                continue
+            batch = []
+            for keystring in _unique_keystrings(generator, size):
+                key = keycls(group=self, key=keystring, pub_date=pub_date,
+                             expires=expires, pooled=pooled)
+                if facts is not None:
+                    key.fact = next(facts, None)
+                if claimants is not None:
+                    key.claimed_by = next(claimants, None)
+                batch.append(key)
+            counters.incr(self, 'attempts', size)
+            for attempt in range(retries + 1):
+                try:
+                    with transaction.atomic(using=router.db_for_write(keycls)):
+                        _bulk_create(manager, batch, batch_size, self.hash_keys)
+                        if not pooled:
+                            _count_keys(self, issued=len(batch))
+                    _keys_made(self, [key.key for key in batch], router.db_for_write(keycls))
+                    break
+                except IntegrityError:
+                    existing = _existing_keystrings(manager, [key.key for key in batch], self)
+                    if not existing:
+                        raise
+                self._collided(len(existing), attempt < retries)
+                if attempt == retries:
+                    raise GeneratorError('No unused keys found in %i attempts' % (retries + 1))
+                in_use = set(key.key for key in batch)
+                fresh = _unique_keystrings(generator, len(existing), in_use)
+                for key in batch:
+                    if key.key in existing:
+                        key.key = fresh.pop()
+                counters.incr(self, 'attempts', len(existing))
+            remaining -= size
+            yield batch
+
+    def _collided(self, collisions, retry):
+        counters.incr(self, 'collisions', collisions)
+        if retry:
+            counters.incr(self, 'retries')
+        _LOG.info('%i key collision(s) in group %s, keyspace is an estimated %.1f%% full',
+                  collisions, self, 100 * counters.estimated_fill(self))
+
+
+def _to_timestamp(value):
+    if value is None:
+        return None
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return int(value.timestamp())
+
+def _from_timestamp(value):
+    if value is None:
+        return None
+    value = datetime.fromtimestamp(value, tz=dt_timezone.utc)
+    if not settings.USE_TZ:
+        value = timezone.make_naive(value)
+    return value
+
+def _key_retries():
+    return getattr(settings, 'VERIFICATION_KEY_RETRIES', 5)
+
+def _unique_keystrings(generator, n, exclude=()):
+    "Make <n> keystrings with no duplicates among them or in <exclude>"
+    keystrings = {}
+    for _ in range(10):
+        for keystring in generator.generate_many(n - len(keystrings)):
+            if keystring not in exclude:
+                keystrings[keystring] = None
+        if len(keystrings) == n:
+            return list(keystrings)
+    raise GeneratorError('Could not make %i unique keys' % n)
+
+def _existing_keystrings(manager, keystrings, group, chunk_size=500):
+    "Return those of <keystrings> that are already in use"
+    existing = set()
+    for i in range(0, len(keystrings), chunk_size):
+        chunk = keystrings[i:i+chunk_size]
+        if group.hash_keys:
+            digests = dict((bytes(key_digest(k)), k) for k in chunk)
+            found = manager.filter(digest__in=list(digests)).values_list('digest', flat=True)
+            existing.update(digests[bytes(digest)] for digest in found)
+        else:
+            existing.update(manager.filter(key__in=chunk).values_list('key', flat=True))
+    return existing
+
+def _group_counters():
+    return getattr(settings, 'VERIFICATION_GROUP_COUNTERS', False)
+
+def _counter_shard(group):
+    "The counters of group to update, a random one of its shards"
+    shards = getattr(settings, 'VERIFICATION_GROUP_COUNTER_SHARDS', 8)
+    return {'group_id': getattr(group, 'pk', group), 'shard': random.randrange(shards)}
+
+def _increments(amounts):
+    return dict((name, models.F(name) + n) for name, n in amounts.items())
+
+def _count_keys(group, **amounts):
+    """Add <amounts> to the counters of group, see KeyGroupCounter"""
+    if not _group_counters() or not any(amounts.values()):
+        return
+    shard = _counter_shard(group)
+    if not KeyGroupCounter.objects.filter(**shard).update(**_increments(amounts)):
+        _new_counter(shard, amounts)
+
+async def _acount_keys(group, **amounts):
+    "Async _count_keys()"
+    if not _group_counters() or not any(amounts.values()):
+        return
+    shard = _counter_shard(group)
+    if not await KeyGroupCounter.objects.filter(**shard).aupdate(**_increments(amounts)):
+        await sync_to_async(_new_counter)(shard, amounts)
+
+def _new_counter(shard, amounts):
+    "Make the missing shard, or update it if made meanwhile"
+    try:
+        with transaction.atomic(using=router.db_for_write(KeyGroupCounter)):
+            KeyGroupCounter.objects.create(**dict(shard, **amounts))
+    except IntegrityError:
+        KeyGroupCounter.objects.filter(**shard).update(**_increments(amounts))
+
+def _keys_made(group, keystrings, using):
+    "Add new keys to the group's key filter once they are committed"
+    if key_filter.enabled() and not group.signed_keys:
+        transaction.on_commit(lambda: key_filter.add(group, keystrings), using=using)
+
+def _bulk_create(manager, keys, batch_size, hash_keys):
+    "bulk_create() <keys>, storing only their digests if <hash_keys>"
+    if not hash_keys:
+        return manager.bulk_create(keys, batch_size=batch_size)
+    keystrings = [key.key for key in keys]
+    for key in keys:
+        key.digest, key.key = key_digest(key.key), None
+    try:
+        return manager.bulk_create(keys, batch_size=batch_size)
+    finally:
+        for key, keystring in zip(keys, keystrings):
+            key.key = keystring
+
+
+def key_indexes(prefix):
+    """The indexes of a subclass of AbstractKey, named <prefix>_state,
+    _available, _pub_date and _pooled. Index names are limited to 30
+    characters, so keep <prefix> to 20"""
+    return [
+        # available(), expired() and claimed() per group
+        models.Index(fields=['group', 'claimed', 'expires'], name='%s_state' % prefix),
+        # Only the keys that can still be claimed, where supported
+        models.Index(fields=['group', 'expires'], condition=Q(claimed=None),
+                     name='%s_available' % prefix),
+        models.Index(fields=['pub_date'], name='%s_pub_date' % prefix),
+        # Taking a key from the pool
+        models.Index(fields=['group'], condition=Q(pooled=True), name='%s_pooled' % prefix),
+    ]
+
 
 class AbstractKey(models.Model):
     """
-    key         - Generated by the group.
+    key         - Generated by the group. Empty if the group hashes keys.
+    digest      - Keyed digest of the key, if the group hashes keys.
     group       - Groups the keys into the same type, provides a generator
     fact        - Some fact that is claimed/verified by the claimant. Can be empty.
     pub_date    - When the key was generated
@@ -152,15 +1155,22 @@ class AbstractKey(models.Model):
 
             def claim(self, your_args):
                 return claim(self.key, yourargs)
+
+            class Meta(AbstractKey.Meta):
+                indexes = key_indexes('yourapp_key')
+
+    Subclasses declare their own indexes, see key_indexes().
     """
     send_func = None
 
-    key = models.CharField(unique=True, max_length=255)
+    key = models.CharField(unique=True, max_length=255, blank=True, null=True)
+    digest = DigestField(unique=True, max_length=32, blank=True, null=True)
     group = models.ForeignKey(KeyGroup, on_delete=models.CASCADE, related_name='keys')
     fact = models.TextField(blank=True, null=True)
     pub_date = models.DateTimeField(default=tznow, editable=False, blank=True)
     expires = models.DateTimeField(blank=True, null=True)
     claimed = models.DateTimeField(blank=True, null=True)
+    pooled = models.BooleanField(default=False, editable=False)
 
     objects = KeyQuerySet.as_manager()
 
@@ -170,7 +1180,7 @@ class AbstractKey(models.Model):
         get_latest_by = 'pub_date'
 
     def __str__(self):
-        return self.key
+        return self.key or ''
 
     def pprint(self):
         "Show info about a key"
@@ -179,37 +1189,303 @@ class AbstractKey(models.Model):
     def save(self, *args, **kwargs):
         "Save key and set ttl if the group has it"
         now = tznow()
+        group = self.get_group()
+        adding = self._state.adding
         if not self.pk:
             self.pub_date = now
-            if self.group.ttl:
-                add_minutes = timedelta(minutes=self.group.ttl)
+            if group.ttl:
+                add_minutes = timedelta(minutes=group.ttl)
                 self.expires = self.pub_date + add_minutes
-        super(AbstractKey, self).save(*args, **kwargs)
+        if self.key and group.hash_keys:
+            # Store only the digest but keep the key on the instance
+            keystring = self.key
+            self.digest, self.key = key_digest(keystring), None
+            try:
+                super(AbstractKey, self).save(*args, **kwargs)
+            finally:
+                self.key = keystring
+        else:
+            super(AbstractKey, self).save(*args, **kwargs)
+        if adding and not self.pooled:
+            _count_keys(group, issued=1, claimed=int(self.claimed is not None))
+        if adding and self.key:
+            _keys_made(group, [self.key], self._state.db)
 
     def clean(self):
         """Verify that facts is filled if the group demands it"""
-        if self.group.has_fact == True and not self.fact:
+        if self.get_group().has_fact == True and not self.fact:
             raise ValidationError('This key must have a fact but none is provided')
 
     @classmethod
-    def generate(cls, group, seed=None, fact=None, *args):
+    def generate(cls, group, seed=None, fact=None, *args, claimant=None):
         "Generate and return a new key"
-        key = group.generate_one_key(cls, seed, fact, *args)
+        key = group.generate_one_key(cls, seed, fact, *args, claimant=claimant)
         return key
 
+    def _claim_args(self):
+        """The queryset and keystring to claim this key with. A key loaded
+        from a group that hashes keys has no keystring, it is claimed by pk"""
+        queryset = type(self)._default_manager.all()
+        if not self.key:
+            return queryset.filter(pk=self.pk), None
+        return queryset, self.key
+
     def claim(self, user):
         "Claim this key for user"
-        self = claim(self.key, user)
-        return self
+        # Straight from the database, no need to check the format
+        return _claim(*self._claim_args(), claimant=user, group=self.get_group())
+
+    async def aclaim(self, user):
+        "Async claim()"
+        group = await self.aget_group()
+        return await _aclaim(*self._claim_args(), claimant=user, group=group)
+
+    def get_group(self):
+        "Get the group, from the KeyGroup cache unless already fetched"
+        if not type(self).group.is_cached(self):
+            self.group = KeyGroup.objects.get_cached(self.group_id)
+        return self.group
+
+    async def aget_group(self):
+        "Async get_group()"
+        if not type(self).group.is_cached(self):
+            self.group = await KeyGroup.objects.aget_cached(self.group_id)
+        return self.group
 
     def send_key(self, *args, **kwargs):
-        "Send this key with <send_func>"
-        if callable(self.send_func):
-            return self.send_func(*args, **kwargs)
-        raise TypeError('Key.send_func is not a callable')
+        """Send this key with <send_func>, or else with the delivery backend
+        in VERIFICATION_DELIVERY_BACKEND, see deliver()"""
+        with instrumentation.timer('send', self.group_id) as timer:
+            if callable(self.send_func):
+                return self.send_func(*args, **kwargs)
+            if getattr(settings, 'VERIFICATION_DELIVERY_BACKEND', None):
+                delivery = self.deliver(*args, **kwargs)
+                timer.outcome = delivery.status
+                return delivery
+            raise TypeError('Key.send_func is not a callable')
+
+    def deliver(self, recipient, content='', backend=None):
+        """Send this key to recipient, returns a Delivery with the status
+
+        backend is the dotted path of a delivery backend, or an opened
+        backend to share its connection with other keys. Defaults to
+        VERIFICATION_DELIVERY_BACKEND."""
+        delivery = Delivery(self, recipient, content)
+        if isinstance(backend, BaseDeliveryBackend):
+            backend.send_deliveries([delivery])
+        else:
+            with get_delivery_backend(backend) as backend:
+                backend.send_deliveries([delivery])
+        return delivery
 
 class Key(AbstractKey):
     """Standard key, claimable by AUTH_USER_MODEL"""
     claimed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, blank=True, null=True, related_name='verification_keys')
 
     objects = KeyQuerySet.as_manager()
+
+    class Meta(AbstractKey.Meta):
+        indexes = key_indexes('verification_key')
+
+
+class KeyGroupCounter(models.Model):
+    """Counts of the keys of a KeyGroup, kept up to date as keys are
+    made, claimed and deleted, see KeyGroup.stats()
+
+    Only kept with the setting VERIFICATION_GROUP_COUNTERS = True. Each
+    update goes to one of VERIFICATION_GROUP_COUNTER_SHARDS rows per group,
+    default 8, picked at random so that concurrent claims seldom wait for
+    each other. Keys created or deleted other ways than through this app
+    are missed until KeyGroup.reconcile_counters() or the command
+    reconcile_group_counters is run."""
+    group = models.ForeignKey(KeyGroup, on_delete=models.CASCADE, related_name='key_counters')
+    shard = models.PositiveSmallIntegerField(default=0)
+    issued = models.BigIntegerField(default=0)
+    claimed = models.BigIntegerField(default=0)
+    expired = models.BigIntegerField(default=0)
+    purged = models.BigIntegerField(default=0)
+    reconciled = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ('group', 'shard')
+
+    def __str__(self):
+        return '%s %i' % (self.group_id, self.shard)
+
+
+class ArchivedKeyQuerySet(QuerySet):
+
+    def filter_key(self, keystring, group=None):
+        "Get the archived key <keystring>, whether stored as is or hashed"
+        keys = self.filter(Q(key=keystring)|Q(digest=key_digest(keystring)))
+        if group is not None:
+            keys = keys.filter(group=str(group))
+        return keys
+
+
+class ArchivedKey(models.Model):
+    """A claimed or expired key moved out of the key table, for audits
+
+    group and claimant are kept by name and primary key, so archived keys
+    outlive their group and claimant."""
+    key = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    digest = DigestField(max_length=32, blank=True, null=True, db_index=True)
+    group = models.CharField(max_length=32, db_index=True)
+    fact = models.TextField(blank=True, null=True)
+    pub_date = models.DateTimeField()
+    expires = models.DateTimeField(blank=True, null=True)
+    claimed = models.DateTimeField(blank=True, null=True)
+    claimant_pk = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+
+    objects = ArchivedKeyQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('-pub_date',)
+
+    def __str__(self):
+        return self.key or ''
+
+    @classmethod
+    def from_row(cls, key, digest, group, fact, pub_date, expires, claimed, claimant_pk):
+        if digest is not None:
+            digest = bytes(digest)
+        if claimant_pk is not None:
+            claimant_pk = str(claimant_pk)
+        return cls(key=key, digest=digest, group=group, fact=fact, pub_date=pub_date,
+                   expires=expires, claimed=claimed, claimant_pk=claimant_pk)
+
+    def to_json(self):
+        def timestamp(value):
+            return value.isoformat() if value else None
+        return json.dumps({
+            'key': self.key,
+            'digest': self.digest.hex() if self.digest else None,
+            'group': self.group,
+            'fact': self.fact,
+            'pub_date': timestamp(self.pub_date),
+            'expires': timestamp(self.expires),
+            'claimed': timestamp(self.claimed),
+            'claimant_pk': self.claimant_pk,
+        }, sort_keys=True)
+
+
+class ClaimEventQuerySet(QuerySet):
+
+    def pending(self, max_attempts=5):
+        "Get events due to be sent"
+        return self.filter(next_attempt__lte=tznow(), attempts__lt=max_attempts)
+
+    def failed(self, max_attempts=5):
+        "Get events that will not be retried"
+        return self.filter(attempts__gte=max_attempts)
+
+    def process(self, batch_size=100, max_attempts=5, retry_delay=60, lease=300):
+        """Send key_claimed for the pending events, oldest first
+
+        This is a generator yielding (sent, failed) per batch of
+        <batch_size> events. Sent events are deleted. An event whose
+        receivers raised is retried after <retry_delay> seconds, doubled
+        per attempt, at most <max_attempts> times. A batch is leased for
+        <lease> seconds before it is sent, so several workers can run at
+        once and a crashed worker's batch is picked up again. Receivers
+        may thus see a claim more than once."""
+        using = router.db_for_write(self.model)
+        while True:
+            events = self._lease(using, batch_size, max_attempts, lease)
+            if not events:
+                return
+            yield self._send(using, events, retry_delay)
+
+    def _lease(self, using, batch_size, max_attempts, lease):
+        now = tznow()
+        with transaction.atomic(using=using):
+            events = self.using(using).pending(max_attempts).order_by('pk')
+            if connections[using].features.has_select_for_update_skip_locked:
+                events = events.select_for_update(skip_locked=True)
+            events = list(events[:batch_size])
+            leased = self.model._default_manager.using(using)
+            leased = leased.filter(pk__in=[event.pk for event in events])
+            leased.update(next_attempt=now + timedelta(seconds=lease))
+        return events
+
+    def _send(self, using, events, retry_delay):
+        by_model = {}
+        for event in events:
+            by_model.setdefault(event.key_model, []).append(event)
+        done, failed = [], 0
+        for label, model_events in by_model.items():
+            pks = {}
+            for event in model_events:
+                try:
+                    pks[event.pk] = apps.get_model(label)._meta.pk.to_python(event.key_pk)
+                except (LookupError, ValidationError) as e:
+                    # A bad row must not hold up the rest
+                    event.last_error = repr(e)
+                    _LOG.warning('Cannot send claim event %s: %s', event, event.last_error)
+                    event.retry(retry_delay, using)
+                    failed += 1
+            if not pks:
+                continue
+            keys = apps.get_model(label)._default_manager.using(using)
+            keys = keys.select_related('claimed_by').in_bulk(list(pks.values()))
+            for event in model_events:
+                if event.pk not in pks:
+                    continue
+                key = keys.get(pks[event.pk])
+                if key is not None and not event.send(key):
+                    event.retry(retry_delay, using)
+                    failed += 1
+                    continue
+                # Sent, or the key is gone
+                done.append(event.pk)
+        self.model._default_manager.using(using).filter(pk__in=done).delete()
+        return len(done), failed
+
+
+class ClaimEvent(models.Model):
+    """A claimed key whose key_claimed is yet to be sent
+
+    Written in the claim's transaction when VERIFICATION_CLAIM_OUTBOX is
+    set, sent by the command process_claim_events."""
+    key_model = models.CharField(max_length=100)
+    key_pk = models.CharField(max_length=64)
+    created = models.DateTimeField(default=tznow)
+    next_attempt = models.DateTimeField(default=tznow)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = ClaimEventQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('pk',)
+        indexes = [
+            models.Index(fields=['next_attempt'], name='verification_event_next'),
+        ]
+
+    def __str__(self):
+        return '%s %s' % (self.key_model, self.key_pk)
+
+    def send(self, key):
+        "Send key_claimed for key, returns whether every receiver succeeded"
+        responses = key_claimed.send_robust(
+            sender=key, claimant=key.claimed_by, group=key.get_group())
+        errors = [error for _, error in responses if isinstance(error, Exception)]
+        if errors:
+            self.last_error = '\n'.join(repr(error) for error in errors)
+            _LOG.warning('key_claimed failed for %s: %s', self, self.last_error)
+        return not errors
+
+    def retry(self, delay, using=None):
+        "Try again later, waiting twice as long after every attempt"
+        self.attempts += 1
+        self.next_attempt = tznow() + timedelta(seconds=delay * 2 ** (self.attempts - 1))
+        self.save(using=using, update_fields=['attempts', 'next_attempt', 'last_error'])
+
+
+@receiver(post_save, sender=KeyGroup)
+@receiver(post_delete, sender=KeyGroup)
+def _invalidate_cached_group(sender, instance, using, **kwargs):
+    name = instance.pk
+    group_cache.forget(name)
+    # Until committed other processes would cache the old group anew
+    transaction.on_commit(lambda: group_cache.invalidate(name), using=using)
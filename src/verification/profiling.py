@@ -0,0 +1,223 @@
+from __future__ import unicode_literals
+
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from verification.instrumentation import instrumentation
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+__all__ = ['Profile', 'profile', 'ProfilingMiddleware']
+
+_LOG = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('verification_profile', default=None)
+
+# Profiles running in this process. Timings are only subscribed to while
+# there are any, so that instrumentation.timer() is a no-op otherwise.
+_active = 0
+_active_lock = threading.Lock()
+
+
+class Profile(object):
+    """Where the time of one request went
+
+    timings holds seconds per part: "db" for all queries, "lookup", "claim"
+    and "signal" from verification.instrumentation, and "render"."""
+
+    def __init__(self):
+        self.queries = 0
+        self.timings = {}
+        self.total = None
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        data = dict(('%s_ms' % name, round(1000 * seconds, 3))
+                    for name, seconds in self.timings.items())
+        data['queries'] = self.queries
+        if self.total is not None:
+            data['total_ms'] = round(1000 * self.total, 3)
+        return data
+
+    def server_timing(self):
+        "The value of a Server-Timing header"
+        metrics = []
+        for name, seconds in sorted(self.timings.items()):
+            metric = 'verification-%s;dur=%.3f' % (name, 1000 * seconds)
+            if name == 'db':
+                metric += ';desc="%i queries"' % self.queries
+            metrics.append(metric)
+        if self.total is not None:
+            metrics.append('verification;dur=%.3f' % (1000 * self.total))
+        return ', '.join(metrics)
+
+
+def _execute(execute, sql, params, many, context):
+    current = _current.get()
+    if current is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        current.queries += 1
+        current.add('db', time.perf_counter() - start)
+
+
+def _install(connection):
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+@receiver(connection_created)
+def _connection_created(sender, connection, **kwargs):
+    _install(connection)
+
+
+def _record(operation, group, outcome, seconds):
+    current = _current.get()
+    if current is not None:
+        current.add(operation, seconds)
+
+
+def _started():
+    global _active
+    with _active_lock:
+        _active += 1
+        if _active == 1:
+            instrumentation.subscribe(_record)
+
+
+def _stopped():
+    global _active
+    with _active_lock:
+        _active -= 1
+        if not _active:
+            instrumentation.unsubscribe(_record)
+
+
+@contextmanager
+def profile():
+    """Profile the block, yielding the Profile
+
+    Queries are counted on every database connection, in this thread and
+    in the threads of sync_to_async()."""
+    for connection in connections.all():
+        _install(connection)
+    current = Profile()
+    token = _current.set(current)
+    _started()
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.total = time.perf_counter() - start
+        _stopped()
+        _current.reset(token)
+
+
+class ProfilingMiddleware(object):
+    """Profiles a sample of the requests to the verification views
+
+    Settings:
+
+    VERIFICATION_PROFILING_SAMPLE_RATE - Share of requests profiled,
+        default 1.0. Lower it to keep the middleware on in production.
+    VERIFICATION_PROFILING_HEADER - Whether to add a Server-Timing header,
+        default True. Every profiled request is also logged as JSON to the
+        logger "verification.profiling", at level INFO.
+
+    The profile of a request is at request.verification_profile."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _sampled(self):
+        rate = getattr(settings, 'VERIFICATION_PROFILING_SAMPLE_RATE', 1.0)
+        return rate >= 1 or random.random() < rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self._sampled():
+            return self.get_response(request)
+        with profile() as current:
+            request.verification_profile = current
+            response = self.get_response(request)
+        return self._finish(request, response, current)
+
+    async def __acall__(self, request):
+        if not self._sampled():
+            return await self.get_response(request)
+        with profile() as current:
+            request.verification_profile = current
+            response = await self.get_response(request)
+        return self._finish(request, response, current)
+
+    def _view_name(self, request):
+        "Name of the view if it is a verification view, otherwise None"
+        from verification.views import KeyLookupMixin
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return None
+        view = getattr(match.func, 'view_class', match.func)
+        if isinstance(view, type):
+            if not issubclass(view, KeyLookupMixin):
+                return None
+        elif not getattr(view, '__module__', '').startswith('verification.'):
+            return None
+        return '%s.%s' % (view.__module__, view.__name__)
+
+    def process_template_response(self, request, response):
+        current = getattr(request, 'verification_profile', None)
+        if current is None:
+            return response
+        render = response.render
+
+        def timed_render():
+            start = time.perf_counter()
+            try:
+                return render()
+            finally:
+                current.add('render', time.perf_counter() - start)
+        response.render = timed_render
+        return response
+
+    def _finish(self, request, response, current):
+        view = self._view_name(request)
+        if view is None:
+            return response
+        if getattr(settings, 'VERIFICATION_PROFILING_HEADER', True):
+            header = current.server_timing()
+            if response.has_header('Server-Timing'):
+                header = '%s, %s' % (response['Server-Timing'], header)
+            response['Server-Timing'] = header
+        data = current.as_dict()
+        data.update(view=view, path=request.path, status=response.status_code)
+        _LOG.info(json.dumps(data, sort_keys=True), extra={'verification_profile': data})
+        return response
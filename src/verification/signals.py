@@ -2,7 +2,10 @@ from __future__ import unicode_literals
 
 import django.dispatch
 
-__all__ = ['key_claimed']
+__all__ = ['key_claimed', 'keys_claimed']
 
 # provides args "claimant", "group"
 key_claimed = django.dispatch.Signal()
+
+# provides arg "keys", sent by KeyQuerySet.claim_many(batched_signal=True)
+keys_claimed = django.dispatch.Signal()
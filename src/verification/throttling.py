@@ -0,0 +1,138 @@
+from __future__ import unicode_literals
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from verification.counters import counters
+
+__all__ = ['Throttled', 'Throttle', 'throttle', 'parse_rate']
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class Throttled(Exception):
+    "Too many attempts. retry_after is in seconds"
+
+    def __init__(self, group, scope, retry_after):
+        self.group = group
+        self.scope = scope
+        self.retry_after = retry_after
+        super(Throttled, self).__init__('Too many attempts for %s (%s), retry in %is'
+                                        % (group, scope, retry_after))
+
+
+def parse_rate(rate):
+    "Parse '10/m' or '100/5m' into (10, 60) or (100, 300)"
+    limit, period = rate.split('/')
+    multiplier = period[:-1] or '1'
+    return int(limit), int(multiplier) * _PERIODS[period[-1]]
+
+
+class Throttle(object):
+    """Limits claims and issuance per KeyGroup, with counters in a cache
+
+    Settings:
+
+    VERIFICATION_THROTTLES - Rates per group name, '*' for all other
+        groups. A rate is "<limit>/<period>", period is s, m, h or d,
+        optionally with a number, like '100/5m'. Unlimited by default.
+
+            VERIFICATION_THROTTLES = {
+                'pin': {
+                    'claim_ip': '10/m',      # claims per client IP
+                    'claim_prefix': '20/h',  # claims of keys sharing a prefix
+                    'claim_prefix_length': 2,
+                    'claim_group': '1000/m', # claims in the group
+                    'issue': '5/h',          # keys per claimant and per fact
+                },
+            }
+
+    VERIFICATION_THROTTLE_CACHE - Name of the cache holding the counters,
+        default 'default'. It must be shared by all processes and have an
+        atomic incr(), like redis, memcached or the database cache.
+
+    Every limit allows <limit> attempts in each period, counted from the
+    start of the period. Throttled attempts are counted per group and
+    scope as "throttled_<scope>" in verification.counters."""
+    prefix = 'verification:throttle'
+
+    def _rates(self, group):
+        throttles = getattr(settings, 'VERIFICATION_THROTTLES', None)
+        if not throttles:
+            return {}
+        return throttles.get(str(group), throttles.get('*', {}))
+
+    def _cache(self):
+        return caches[getattr(settings, 'VERIFICATION_THROTTLE_CACHE', 'default')]
+
+    def _buckets(self, group, hits):
+        "Get (cache key, limit, period, scope) of the limited hits"
+        rates = self._rates(group)
+        now = time.time()
+        for scope, ident in hits:
+            rate = rates.get(scope)
+            if not rate:
+                continue
+            limit, period = parse_rate(rate)
+            window = int(now // period)
+            ident = hashlib.md5(str(ident).encode('utf-8')).hexdigest()
+            key = '%s:%s:%s:%s:%i' % (self.prefix, group, scope, ident, window)
+            yield key, limit, period, scope
+
+    def _check(self, group, scope, count, limit, period):
+        if count > limit:
+            counters.incr(group, 'throttled_%s' % scope)
+            raise Throttled(group, scope, period - time.time() % period)
+
+    def hit(self, group, *hits):
+        "Count the (scope, ident) hits, raise Throttled if any is over its limit"
+        cache = self._cache()
+        for key, limit, period, scope in self._buckets(group, hits):
+            cache.add(key, 0, period)
+            try:
+                count = cache.incr(key)
+            except ValueError:  # Expired since add()
+                cache.add(key, 1, period)
+                count = 1
+            self._check(group, scope, count, limit, period)
+
+    async def ahit(self, group, *hits):
+        "Async hit()"
+        cache = self._cache()
+        for key, limit, period, scope in self._buckets(group, hits):
+            await cache.aadd(key, 0, period)
+            try:
+                count = await cache.aincr(key)
+            except ValueError:  # Expired since add()
+                await cache.aadd(key, 1, period)
+                count = 1
+            self._check(group, scope, count, limit, period)
+
+    def _claim_hits(self, group, keystring, ip):
+        length = self._rates(group).get('claim_prefix_length', 3)
+        hits = [('claim_group', ''), ('claim_prefix', keystring[:length])]
+        if ip:
+            hits.append(('claim_ip', ip))
+        return hits
+
+    def check_claim(self, group, keystring, ip=None):
+        "Count an attempt to claim keystring, raise Throttled if too many"
+        self.hit(group, *self._claim_hits(group, keystring, ip))
+
+    async def acheck_claim(self, group, keystring, ip=None):
+        "Async check_claim()"
+        await self.ahit(group, *self._claim_hits(group, keystring, ip))
+
+    def check_issue(self, group, claimant=None, fact=None):
+        "Count a key made for claimant and fact, raise Throttled if too many"
+        hits = []
+        if claimant is not None:
+            hits.append(('issue', 'claimant:%s' % claimant.pk))
+        if fact:
+            hits.append(('issue', 'fact:%s' % fact))
+        self.hit(group, *hits)
+
+throttle = Throttle()
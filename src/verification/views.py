@@ -3,7 +3,9 @@ from __future__ import unicode_literals
 import logging
 _LOG = logging.getLogger(__name__)
 
-from django.http import HttpResponseRedirect
+from asgiref.sync import sync_to_async
+
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 try:
     from django.urls import reverse
 except ImportError:   # Django < 1.9
@@ -13,21 +15,63 @@ from django.views.generic.base import ContextMixin
 from django.views.generic import TemplateView, FormView, View
 from django.shortcuts import get_object_or_404
 
-from verification.models import Key, KeyGroup, VerificationError
+from verification.bloom import key_filter
+from verification.counters import counters
+from verification.models import Key, KeyGroup, KeyDoesNotExist, VerificationError
 from verification.forms import LookupKeyForm
+from verification.instrumentation import collector, get_exporter, instrumentation
+from verification.throttling import Throttled, throttle
+
+def too_many_requests(throttled):
+    response = HttpResponse('Too many attempts, try again later', status=429)
+    response['Retry-After'] = '%i' % (throttled.retry_after + 1)
+    return response
 
 class KeyLookupMixin(object):
     model = Key
     keygroup = ''
+    # Fetched with the key in the same query
+    select_related = ('claimed_by',)
 
     def get_group_from_string(self, group=''):
-        self.group = get_object_or_404(KeyGroup, name=group)
+        try:
+            self.group = KeyGroup.objects.get_cached(group)
+        except KeyGroup.DoesNotExist:
+            raise Http404('No such group: %s' % group)
         return self.group
 
+    def check_key(self, key, group):
+        """Reject keys the group could not have made. Returns signed keys,
+        which need no query, otherwise None"""
+        if not group.valid_key(key):
+            counters.incr(group, 'rejected')
+            raise Http404('Not a valid key for %s' % group)
+        if group.signed_keys:
+            try:
+                return group.load_signed_key(self.model, key)
+            except VerificationError:
+                raise Http404('Not a valid key for %s' % group)
+        return None
+
+    def get_client_ip(self):
+        return self.request.META.get('REMOTE_ADDR')
+
+    def get_key_queryset(self, key, group):
+        keys = self.model._default_manager.select_related(*self.select_related)
+        return keys.filter_key(key, group)
+
     def get_key_from_string(self, key, group=''):
-        group = self.get_group_from_string(group if group else self.keygroup)
-        self.key = get_object_or_404(self.model, key=key, group=group)
-        return self.key
+        group = group if group else self.keygroup
+        with instrumentation.timer('lookup', group):
+            group = self.get_group_from_string(group)
+            self.key = self.check_key(key, group)
+            if self.key is None:
+                if not key_filter.might_exist(group, key):
+                    raise Http404('No such key')
+                self.key = get_object_or_404(self.get_key_queryset(key, group))
+                self.key.key = key
+                self.key.group = group
+            return self.key
 
 class ArgLookupMixin(object):
     """Gets key and group from request:
@@ -56,35 +100,53 @@ class ArgLookupMixin(object):
         return urlgroup
 
 class ClaimContextMixin(KeyLookupMixin, ArgLookupMixin, ContextMixin):
-    """Adds key and group to context"""
+    """Adds key and group to context. Lookups are throttled as claims, so
+    pages showing keys cannot be used to guess them"""
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ClaimContextMixin, self).dispatch(request, *args, **kwargs)
+        except Throttled as e:
+            return too_many_requests(e)
 
     def get_context_data(self, **kwargs):
         context = super(ClaimContextMixin, self).get_context_data(**kwargs)
         keyarg = self.get_key_arg()
         grouparg = self.get_group_arg()
+        throttle.check_claim(grouparg, keyarg, self.get_client_ip())
         key = self.get_key_from_string(key=keyarg, group=grouparg)
         context['key'] = key
         context['group'] = key.group
         return context
 
 class ClaimMixin(KeyLookupMixin):
+    """Claims keys. Claim attempts are throttled per group, see
+    verification.throttling, and answered with 429 when over the limit"""
     success_url = 'verification-success'
 
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ClaimMixin, self).dispatch(request, *args, **kwargs)
+        except Throttled as e:
+            return too_many_requests(e)
+
     def claim(self, key, group=''):
-        key = self.get_key_from_string(key, group)
-        group = key.group
+        throttle.check_claim(group or self.keygroup, key, self.get_client_ip())
         user = self.request.user
         if user.is_authenticated and user.is_active:
-            # Logged in user claims key
-            claimant = user
-        elif key.claimed_by is not None:
-            # Pre-stored user claims key
-            claimant = key.claimed_by
-        else:
+            # Logged in user claims key, no need to look it up first
+            group = self.get_group_from_string(group if group else self.keygroup)
+            try:
+                self.key = self.model._default_manager.claim(key, user, group=group)
+            except KeyDoesNotExist:
+                raise Http404('No such key')
+            return self.key
+        key = self.get_key_from_string(key, group)
+        if key.claimed_by is None:
             raise VerificationError('No valid user to claim the key')
-        key.claim(claimant)
-        self.key = key
-        return key
+        # Pre-stored user claims key
+        self.key = key.claim(key.claimed_by)
+        return self.key
 
     def get_success_url(self):
         if self.success_url:
@@ -152,3 +214,154 @@ class ClaimSuccessView(ClaimContextMixin, TemplateView):
     template_name = 'verification/success.html'
     http_method_names = ['get', 'head', 'options', 'trace']
 claim_success = ClaimSuccessView.as_view()
+
+
+# Async views, for ASGI. Keys are looked up and claimed on the async ORM.
+
+async def _aget_user(request):
+    "Get request.user without a blocking query on the event loop"
+    if hasattr(request, 'auser'):   # Django 5.0+
+        return await request.auser()
+
+    def get_user():
+        user = request.user
+        user.is_active  # Load a lazy user while queries are allowed
+        return user
+    return await sync_to_async(get_user)()
+
+async def _aget_claimant(key):
+    """Get key.claimed_by without a blocking query on the event loop.
+    Signed keys only come with claimed_by_id"""
+    field = type(key)._meta.get_field('claimed_by')
+    if key.claimed_by_id is None:
+        return None
+    if not field.is_cached(key):
+        try:
+            key.claimed_by = await field.related_model._default_manager.aget(
+                pk=key.claimed_by_id)
+        except field.related_model.DoesNotExist:
+            return None
+    return key.claimed_by
+
+class AsyncKeyLookupMixin(KeyLookupMixin):
+
+    async def aget_group_from_string(self, group=''):
+        try:
+            self.group = await KeyGroup.objects.aget_cached(group)
+        except KeyGroup.DoesNotExist:
+            raise Http404('No such group: %s' % group)
+        return self.group
+
+    async def aget_key_from_string(self, key, group=''):
+        group = group if group else self.keygroup
+        with instrumentation.timer('lookup', group):
+            group = await self.aget_group_from_string(group)
+            self.key = self.check_key(key, group)
+            if self.key is None:
+                if not await key_filter.amight_exist(group, key):
+                    raise Http404('No such key')
+                try:
+                    self.key = await self.get_key_queryset(key, group).aget()
+                except self.model.DoesNotExist:
+                    raise Http404('No such key')
+                self.key.key = key
+                self.key.group = group
+            return self.key
+
+class AsyncClaimContextMixin(AsyncKeyLookupMixin, ArgLookupMixin, ContextMixin):
+    """Adds key and group to context, see ClaimContextMixin"""
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            return await super(AsyncClaimContextMixin, self).dispatch(request, *args, **kwargs)
+        except Throttled as e:
+            return too_many_requests(e)
+
+    async def aget_context_data(self, **kwargs):
+        keyarg = self.get_key_arg()
+        grouparg = self.get_group_arg()
+        await throttle.acheck_claim(grouparg, keyarg, self.get_client_ip())
+        key = await self.aget_key_from_string(key=keyarg, group=grouparg)
+        context = self.get_context_data(**kwargs)
+        context['key'] = key
+        context['group'] = key.group
+        return context
+
+class AsyncClaimMixin(AsyncKeyLookupMixin, ClaimMixin):
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            return await super(ClaimMixin, self).dispatch(request, *args, **kwargs)
+        except Throttled as e:
+            return too_many_requests(e)
+
+    async def aclaim(self, key, group=''):
+        await throttle.acheck_claim(group or self.keygroup, key, self.get_client_ip())
+        user = await _aget_user(self.request)
+        if user.is_authenticated and user.is_active:
+            # Logged in user claims key, no need to look it up first
+            group = await self.aget_group_from_string(group if group else self.keygroup)
+            try:
+                self.key = await self.model._default_manager.aclaim(key, user, group=group)
+            except KeyDoesNotExist:
+                raise Http404('No such key')
+            return self.key
+        key = await self.aget_key_from_string(key, group)
+        claimant = await _aget_claimant(key)
+        if claimant is None:
+            raise VerificationError('No valid user to claim the key')
+        # Pre-stored user claims key
+        self.key = await key.aclaim(claimant)
+        return self.key
+
+class AsyncUrlClaimMixin(AsyncClaimMixin, AsyncClaimContextMixin):
+    async def _aclaim(self):
+        key = self.get_key_arg()
+        group = self.get_group_arg()
+        await self.aclaim(key, group)
+        url = self.get_success_url()
+        return HttpResponseRedirect(url)
+
+class AsyncClaimOnGetView(AsyncUrlClaimMixin, View):
+    """Async ClaimOnGetView"""
+    http_method_names = ['get', 'head', 'options', 'trace']
+
+    async def get(self, request, *args, **kwargs):
+        return await self._aclaim()
+aclaim_get = AsyncClaimOnGetView.as_view()
+
+class AsyncClaimOnPostUrlView(AsyncUrlClaimMixin, TemplateView):
+    """Async ClaimOnPostUrlView"""
+    http_method_names = ['get', 'post', 'head', 'options', 'trace']
+    template_name = 'verification/claim_verify.html'
+
+    async def get(self, request, *args, **kwargs):
+        context = await self.aget_context_data(**kwargs)
+        return self.render_to_response(context)
+
+    async def post(self, request, *args, **kwargs):
+        return await self._aclaim()
+aclaim_post_url = AsyncClaimOnPostUrlView.as_view()
+
+class AsyncClaimSuccessView(AsyncClaimContextMixin, TemplateView):
+    """Async ClaimSuccessView"""
+    template_name = 'verification/success.html'
+    http_method_names = ['get', 'head', 'options', 'trace']
+
+    async def get(self, request, *args, **kwargs):
+        context = await self.aget_context_data(**kwargs)
+        return self.render_to_response(context)
+aclaim_success = AsyncClaimSuccessView.as_view()
+
+class MetricsView(View):
+    """The latency histograms of this process, as formatted by <exporter>
+
+    Defaults to VERIFICATION_INSTRUMENTATION_EXPORTER. Not in
+    verification.urls, add it where only your metrics scraper can reach it."""
+    exporter = None
+    http_method_names = ['get', 'head', 'options']
+
+    def get(self, request, *args, **kwargs):
+        exporter = get_exporter(self.exporter)
+        return HttpResponse(exporter.export(collector), content_type=exporter.content_type)
+metrics = MetricsView.as_view()